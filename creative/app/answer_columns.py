@@ -0,0 +1,83 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Dictionary encodes the answer columns of query results as Arrow.
+
+Creatives send the answers of a respondent as a "1:A|2:BC|4:D" string: one
+"question:options" part per question shown. The app does not parse these
+strings: the receiver also stores them as Answers, and the queries module's
+SQL returns one AnswerN column per question. Every read path turns those rows
+into Arrow columns through encode_batch().
+"""
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import queries
+
+MAX_QUESTIONS = queries.MAX_QUESTIONS
+# Prefix of the segments of surveys created with the default segmentation.
+DEFAULT_SEGMENT_PREFIX = 'default_'
+CATEGORY = pa.dictionary(pa.int32(), pa.string())
+
+
+def get_question_count(survey_info):
+  """Returns the number of the last question the survey asks.
+
+  Surveys that cannot be read are assumed to ask MAX_QUESTIONS questions.
+  """
+  if survey_info is None:
+    return MAX_QUESTIONS
+  asked = [i for i in range(1, MAX_QUESTIONS + 1)
+           if survey_info.get(f'question{i}')]
+  return asked[-1] if asked else 0
+
+
+def segment_name(segmentation):
+  """Returns the segment without the default segmentation's prefix."""
+  if segmentation.startswith(DEFAULT_SEGMENT_PREFIX):
+    return segmentation[len(DEFAULT_SEGMENT_PREFIX):]
+  return segmentation
+
+
+def encode_segments(segmentation, strip_default=True):
+  """Dictionary encodes a segmentation array, optionally dropping "default_".
+
+  Only the dictionary is rewritten, so stripping costs nothing per row.
+  """
+  encoded = pc.dictionary_encode(pa.array(segmentation).cast(pa.string()))
+  if not strip_default:
+    return encoded
+  names = [segment_name(name) for name in encoded.dictionary.to_pylist()]
+  uniques = list(dict.fromkeys(names))
+  remap = pa.array([uniques.index(name) for name in names], pa.int32())
+  return pa.DictionaryArray.from_arrays(
+      pc.take(remap, encoded.indices), pa.array(uniques, pa.string()))
+
+
+def encode_batch(batch, question_count, strip_default=False):
+  """Returns CreatedAt, Segmentation and Answer1.. columns for a batch.
+
+  The batch has the CreatedAt, Segmentation and AnswerN columns of the
+  queries module. CreatedAt becomes a timestamp and the other columns are
+  dictionary encoded.
+  """
+  answers = [
+      pc.dictionary_encode(batch.column(f'Answer{i}').cast(pa.string()))
+      for i in range(1, question_count + 1)]
+  arrays = [batch.column('CreatedAt').cast(pa.timestamp('us')),
+            encode_segments(batch.column('Segmentation'), strip_default)]
+  return pa.RecordBatch.from_arrays(
+      arrays + answers,
+      names=['CreatedAt', 'Segmentation'] +
+      [f'Answer{i}' for i in range(1, question_count + 1)])
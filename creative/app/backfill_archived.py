@@ -0,0 +1,34 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Marks surveys created before archiving existed as active.
+
+Usage:
+
+  GOOGLE_CLOUD_PROJECT=PROJECT_ID python backfill_archived.py
+
+Firestore queries cannot match documents that lack a field, so surveys
+without `archived` do not show up on the dashboard, which lists active
+surveys only. This sets `archived` to false on every such survey. It is safe
+to run more than once.
+"""
+
+import logging
+
+import survey_collection
+
+if __name__ == '__main__':
+  logging.basicConfig(level=logging.INFO)
+  logging.info('Marked %d surveys as active.',
+               survey_collection.backfill_archived())
@@ -0,0 +1,150 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Times the dashboard aggregation and render for growing survey counts.
+
+The old dashboard filtered the response counts once per survey and searched
+the whole stats list three times per table row, so its cost grew with the
+square of the number of surveys. Run from creative/app:
+
+  FIRESTORE_EMULATOR_HOST=localhost:1 GOOGLE_CLOUD_PROJECT=benchmark PYTHONPATH=. \
+      python benchmark/bench_dashboard.py --surveys 500 1000 2000 4000
+
+Firestore and BigQuery are not used: surveys and counts are synthetic. The
+"legacy" column is capped by --legacy-max-surveys because it gets slow.
+"""
+
+import argparse
+import time
+from unittest import mock
+
+import flask
+import pandas
+
+import main
+import survey_service
+
+# The response count cells of the old index.html.
+LEGACY_CELLS = """
+{% for survey in all_surveys %}
+<td style="background-color:{%for item in stat_array%}{% if item['id']==survey.id %}{{item['color']}}{%endif%}{%endfor%}">
+{% for item in stat_array %}{% if item['id'] == survey.id %}
+{% for seg in item['stats'] %}{{seg['Segmentation']}}:{{ seg['response_count'] }}<br>{% endfor %}
+{% endif %}{% endfor %}
+</td>
+<td style="background-color:{%for item in stat_array%}{% if item['id']==survey.id %}{{item['color']}}{%endif%}{%endfor%}">
+{% for item in stat_array %}{% if item['id'] == survey.id %}{{ item['last_change'] }}{% endif %}{% endfor %}
+</td>
+<td style="background-color:{%for item in stat_array%}{% if item['id']==survey.id %}{{item['color']}}{%endif%}{%endfor%}">
+{% for item in stat_array %}{% if item['id'] == survey.id %}{{ item['status'] }}{% endif %}{% endfor %}
+</td>
+{% endfor %}
+"""
+
+# The same cells rendered from the stats dict.
+CURRENT_CELLS = """
+{% for survey in all_surveys %}
+{% set item = stats.get(survey.id, no_stats) %}
+<td style="background-color:{{item['color']}}">
+{% for seg in item['stats'] %}{{seg['Segmentation']}}:{{ seg['response_count'] }}<br>{% endfor %}
+</td>
+<td style="background-color:{{item['color']}}">{{ item['last_change'] }}</td>
+<td style="background-color:{{item['color']}}">{{ item['status'] }}</td>
+{% endfor %}
+"""
+
+
+class FakeSurvey(object):
+
+  def __init__(self, survey_id):
+    self.id = survey_id
+    self._fields = {'surveyname': survey_id, 'question1': 'Question?'}
+
+  def to_dict(self):
+    return self._fields
+
+  def get(self, field, default=None):
+    return self._fields.get(field, default)
+
+
+def make_data(surveys, segments=2):
+  all_surveys = [FakeSurvey('survey-%06d' % i) for i in range(surveys)]
+  counts = pandas.DataFrame({
+      'ID': [survey.id for survey in all_surveys for _ in range(segments)],
+      'Segmentation': ['segment-%d' % s for _ in all_surveys
+                       for s in range(segments)],
+      'response_count': 100,
+      'days_since_response': 2,
+  })
+  return all_surveys, counts
+
+
+def legacy_stats(all_surveys, tmp_stats):
+  """The aggregation of the old main.index, kept for comparison."""
+  stat_array = []
+  for survey in all_surveys:
+    df = tmp_stats.loc[tmp_stats['ID'] == survey.id]
+    segmentation_rows = df.to_dict()
+    segs = []
+    for x in segmentation_rows['ID']:
+      segs.append({
+          'Segmentation': segmentation_rows['Segmentation'][x],
+          'response_count': segmentation_rows['response_count'][x],
+          'days_since_response': segmentation_rows['days_since_response'][x]
+      })
+    stat_array.append(dict(main.survey_status(segs), id=survey.id))
+  return stat_array
+
+
+def timed(fn):
+  start = time.perf_counter()
+  fn()
+  return 1000 * (time.perf_counter() - start)
+
+
+def run_benchmark():
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument('--surveys', type=int, nargs='+',
+                      default=[500, 1000, 2000, 4000])
+  parser.add_argument('--legacy-max-surveys', type=int, default=2000)
+  args = parser.parse_args()
+
+  print('%8s %12s %12s %12s %14s' % ('surveys', 'legacy ms', 'current ms',
+                                     'page ms', 'page us/survey'))
+  for surveys in args.surveys:
+    all_surveys, counts = make_data(surveys)
+    # The whole synthetic history is shown on one page.
+    with main.app.test_request_context(
+        '/index', query_string={'page_size': surveys}), \
+        mock.patch.object(main, 'MAX_DASHBOARD_PAGE_SIZE', surveys), \
+        mock.patch.object(survey_service, 'get_page',
+                          return_value=all_surveys), \
+        mock.patch.object(survey_service, 'get_all_response_counts',
+                          return_value=counts):
+      legacy = float('nan')
+      if surveys <= args.legacy_max_surveys:
+        legacy = timed(lambda: flask.render_template_string(
+            LEGACY_CELLS, all_surveys=all_surveys,
+            stat_array=legacy_stats(all_surveys, counts)))
+      current = timed(lambda: flask.render_template_string(
+          CURRENT_CELLS, all_surveys=all_surveys,
+          stats=main.get_survey_stats(counts),
+          no_stats=main.survey_status([])))
+      page = timed(main.index)
+    print('%8d %12.1f %12.1f %12.1f %14.1f' %
+          (surveys, legacy, current, page, 1000 * page / surveys))
+
+
+if __name__ == '__main__':
+  run_benchmark()
@@ -0,0 +1,130 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Times writing a CSV download: pandas str.split vs AnswerN batches.
+
+The old download read the raw Response, split it on "|" into positional
+columns with pandas, cut the "N:" prefix off each (which also put answers
+after a skipped question in the wrong column) and wrote the frame as CSV.
+Now BigQuery returns one AnswerN column per question, and the download
+streams record batches through survey_service's CSV writer, which dictionary
+encodes them with answer_columns.encode_batch. Splitting the responses
+happens in BigQuery and is not timed. Run from creative/app:
+
+  FIRESTORE_EMULATOR_HOST=localhost:1 GOOGLE_CLOUD_PROJECT=benchmark PYTHONPATH=. \
+      python benchmark/bench_export.py --responses 1000000
+
+Responses are synthetic five question strings where one respondent in five
+skips question 2 and one in ten has not answered the last question yet. The
+pandas path is only run up to --legacy-max-responses, as it needs several
+GiB at 10M responses. Parquet, which the old code could not write, is timed
+through the same writers for reference.
+"""
+
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+import survey_service
+
+QUESTION_HEADERS = [f'Response {i}' for i in range(1, 6)]
+
+
+def make_batch(responses, seed=0):
+  """Returns the raw Response and the AnswerN columns of synthetic rows."""
+  rng = np.random.default_rng(seed)
+  options = pa.array(['A', 'B', 'C', 'D', 'AC'])
+  answers = [pc.take(options, rng.integers(len(options), size=responses))
+             for _ in range(5)]
+  # Question 2 is skipped by a branch, question 5 not answered yet.
+  skipped = pa.array(rng.random(responses) < 0.2)
+  answers[1] = pc.if_else(skipped, pa.nulls(responses, pa.string()),
+                          answers[1])
+  answers[4] = pc.if_else(pa.array(rng.random(responses) < 0.1),
+                          pa.nulls(responses, pa.string()), answers[4])
+  parts = [
+      pc.binary_join_element_wise(f'{i}', pc.fill_null(answer, ''), ':')
+      for i, answer in enumerate(answers, start=1)]
+  response = pc.if_else(
+      skipped,
+      pc.binary_join_element_wise(parts[0], *parts[2:], '|'),
+      pc.binary_join_element_wise(*parts, '|'))
+  segmentation = pc.take(pa.array(['default_expose', 'default_control']),
+                         rng.integers(2, size=responses))
+  created_at = pa.array(
+      np.full(responses, np.datetime64('2024-05-01T10:00:00', 'us')))
+  return pa.RecordBatch.from_arrays(
+      [created_at, segmentation, response] + answers,
+      names=['CreatedAt', 'Segmentation', 'Response'] +
+      [f'Answer{i}' for i in range(1, 6)])
+
+
+def legacy_csv(df):
+  """The CSV download of the old read paths, kept for comparison."""
+  responselist = df['Response'].str.split(pat=('|'), expand=True)
+  for i in list(responselist):
+    responselist[i] = responselist[i].str.slice(start=2)
+  df = pd.concat([df[['CreatedAt', 'Segmentation']], responselist], axis=1)
+  df.replace(regex='default_', value='', inplace=True)
+  return df.to_csv(index=False)
+
+
+def export(batch, batch_rows, export_format):
+  """Streams the AnswerN columns of batch as a download, returning its size."""
+  query_columns = batch.select(
+      ['CreatedAt', 'Segmentation'] + [f'Answer{i}' for i in range(1, 6)])
+  batches = (query_columns.slice(start, batch_rows)
+             for start in range(0, batch.num_rows, batch_rows))
+  # pylint: disable=protected-access
+  sink = survey_service._ChunkSink(text=export_format == 'csv')
+  writer = survey_service._open_writer(sink, QUESTION_HEADERS, export_format)
+  chunks = survey_service._stream_batches(batches, sink, writer)
+  return sum(len(chunk) for chunk in chunks)
+
+
+def timed(fn):
+  start = time.perf_counter()
+  fn()
+  return 1000 * (time.perf_counter() - start)
+
+
+def run_benchmark():
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument('--responses', type=int, nargs='+', default=[1000000])
+  parser.add_argument('--legacy-max-responses', type=int, default=2000000)
+  parser.add_argument('--batch-rows', type=int, default=100000,
+                      help='rows per record batch read from BigQuery')
+  args = parser.parse_args()
+
+  print('%10s %12s %12s %12s %10s' % ('responses', 'pandas ms', 'csv ms',
+                                      'parquet ms', 'speedup'))
+  for responses in args.responses:
+    batch = make_batch(responses)
+    legacy_ms = float('nan')
+    if responses <= args.legacy_max_responses:
+      frame = batch.select(
+          ['CreatedAt', 'Segmentation', 'Response']).to_pandas()
+      legacy_ms = timed(lambda: legacy_csv(frame))
+      del frame
+    csv_ms = timed(lambda: export(batch, args.batch_rows, 'csv'))
+    parquet_ms = timed(lambda: export(batch, args.batch_rows, 'parquet'))
+    print('%10d %12.1f %12.1f %12.1f %9.1fx' %
+          (responses, legacy_ms, csv_ms, parquet_ms, legacy_ms / csv_ms))
+
+if __name__ == '__main__':
+  run_benchmark()
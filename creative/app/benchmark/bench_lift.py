@@ -0,0 +1,158 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Times brand lift: pivot_table loop on responses vs lift_engine on counts.
+
+The old report downloaded every response and built one pivot table per
+question. The report now reads the rows of the 'lift_counts' query, which
+BigQuery has already grouped by settled, segment, question and option, and
+adds them up with lift_engine.count_rows before bootstrapping the interval
+and computing the lift. Run from creative/app:
+
+  FIRESTORE_EMULATOR_HOST=localhost:1 GOOGLE_CLOUD_PROJECT=benchmark PYTHONPATH=. \
+      python benchmark/bench_lift.py --responses 1000000 10000000
+
+Responses are synthetic: three answered questions out of five, one answer in
+ten skipped, one in twenty choosing two options and one in ten too recent to
+be settled. The query rows are built from the same responses the way the
+query groups them; that work happens in BigQuery and is not timed. The old
+code gave multiple option answers a column of their own, and its pivot tables
+also counted the other questions' columns, so the two implementations are
+first checked to agree on a single question of single option answers.
+"""
+
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+import lift_engine
+import survey_service
+
+
+def make_responses(responses, questions=3, multiple=0.05, seed=0):
+  rng = np.random.default_rng(seed)
+  options = np.array(['A', 'B', 'C', 'D', 'AC'], dtype=object)
+  single = (1 - multiple) / 4
+  frame = pd.DataFrame({
+      'Segmentation': rng.choice(
+          np.array(['default_expose', 'default_control'], dtype=object),
+          responses),
+  })
+  for i in range(1, lift_engine.MAX_QUESTIONS + 1):
+    column = options[rng.choice(
+        len(options), responses, p=4 * [single] + [multiple])]
+    if i > questions:
+      column = np.full(responses, None, dtype=object)
+    else:
+      column[rng.random(responses) < 0.1] = None
+    frame[f'Answer{i}'] = column
+  frame['Settled'] = rng.random(responses) >= 0.1
+  return frame
+
+
+def make_query_rows(responses):
+  """Groups responses into the rows the 'lift_counts' query returns."""
+  answers = responses.melt(
+      id_vars=['Settled', 'Segmentation'],
+      value_vars=[
+          f'Answer{i}' for i in range(1, lift_engine.MAX_QUESTIONS + 1)],
+      var_name='Question', value_name='AnswerId').dropna()
+  rows = answers.groupby(
+      ['Settled', 'Segmentation', 'Question', 'AnswerId'],
+      as_index=False).size()
+  rows['Segment'] = rows['Segmentation'].str.replace('default_', '')
+  rows['Question'] = rows['Question'].str.slice(len('Answer')).astype(int)
+  rows['Option'] = rows['AnswerId'].map(lambda answer: [''] + list(answer))
+  rows = rows.explode('Option')
+  return rows.groupby(['Settled', 'Segment', 'Question', 'Option'],
+                      as_index=False)['size'].sum().rename(
+                          columns={'size': 'Responses'})
+
+
+def legacy_lift(df):
+  """The brand lift of the old survey_service, kept for comparison."""
+  answers = df[[f'Answer{i}' for i in range(1, lift_engine.MAX_QUESTIONS + 1)]]
+  answered = [i for i, column in enumerate(answers)
+              if answers[column].notna().any()]
+  answers = answers.iloc[:, :answered[-1] + 1 if answered else 0]
+  answers.columns = range(len(answers.columns))
+  df = pd.concat([df[['Segmentation']], answers], axis=1)
+  df.replace(regex='default_', value='', inplace=True)
+
+  output = []
+  for i in range(len(df.columns) - 1):
+    pivot = df.pivot_table(
+        index='Segmentation', columns=i, aggfunc=len, fill_value=0)
+    pivot = pivot.reindex(['expose', 'control'])
+    pivot = pivot.div(pivot.sum(axis=1), axis=0)
+    matrix = pivot.to_numpy()
+    lift = []
+    for col in matrix.T:
+      lift.append((col[0] - col[1]) / col[1])
+    output.append(np.vstack([matrix, lift]))
+  return output
+
+
+def engine_lift(rows, bootstrap=True):
+  """Counts the query rows and computes lift as get_brand_lift_results."""
+  settled = rows['Settled'].to_numpy(dtype=bool)
+  answers, respondents = lift_engine.count_rows(rows[settled])
+  tail_answers, tail_respondents = lift_engine.count_rows(rows[~settled])
+  answers += tail_answers
+  respondents += tail_respondents
+  significance = None
+  if bootstrap:
+    significance = lift_engine.bootstrap(
+        answers, respondents, samples=survey_service.LIFT_BOOTSTRAP_SAMPLES,
+        confidence=survey_service.LIFT_CONFIDENCE, seed=0)
+  return lift_engine.lift(answers, respondents, significance)
+
+
+def timed(fn):
+  start = time.perf_counter()
+  result = fn()
+  return 1000 * (time.perf_counter() - start), result
+
+
+def check():
+  frame = make_responses(10000, questions=1, multiple=0)
+  for old, new in zip(legacy_lift(frame.copy()),
+                      engine_lift(make_query_rows(frame), bootstrap=False)):
+    np.testing.assert_allclose(old, new)
+
+
+def run_benchmark():
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument('--responses', type=int, nargs='+',
+                      default=[1000000, 10000000])
+  parser.add_argument('--legacy-max-responses', type=int, default=10000000)
+  args = parser.parse_args()
+
+  check()
+  print('%10s %10s %12s %12s %10s' % ('responses', 'query rows', 'pivot ms',
+                                      'engine ms', 'speedup'))
+  for responses in args.responses:
+    frame = make_responses(responses)
+    rows = make_query_rows(frame)
+    legacy_ms = float('nan')
+    if responses <= args.legacy_max_responses:
+      legacy_ms, _ = timed(lambda: legacy_lift(frame.copy()))
+    engine_ms, _ = timed(lambda: engine_lift(rows))
+    print('%10d %10d %12.1f %12.1f %9.1fx' %
+          (responses, len(rows), legacy_ms, engine_ms, legacy_ms / engine_ms))
+
+if __name__ == '__main__':
+  run_benchmark()
@@ -0,0 +1,69 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Process-wide BigQuery and BigQuery Storage clients.
+
+Building a client looks up credentials and opens new HTTP connections or a
+gRPC channel, so one of each is created on first use and shared by every
+request. Both clients are safe to use from several threads.
+
+Tests can replace the clients with set_clients() and drop them with reset().
+"""
+
+import os
+import threading
+
+from google.cloud import bigquery
+from google.cloud import bigquery_storage
+
+_bigquery_client = None
+_bqstorage_client = None
+_lock = threading.Lock()
+
+
+def get_bigquery_client():
+  """Returns the shared bigquery.Client, creating it on first use."""
+  global _bigquery_client
+
+  if _bigquery_client is None:
+    with _lock:
+      if _bigquery_client is None:
+        _bigquery_client = bigquery.Client(
+            project=os.environ.get('PROJECT_ID'))
+  return _bigquery_client
+
+
+def get_bqstorage_client():
+  """Returns the shared BigQueryReadClient, creating it on first use."""
+  global _bqstorage_client
+
+  if _bqstorage_client is None:
+    with _lock:
+      if _bqstorage_client is None:
+        _bqstorage_client = bigquery_storage.BigQueryReadClient()
+  return _bqstorage_client
+
+
+def set_clients(bigquery_client=None, bqstorage_client=None):
+  """Installs the given clients, for example fakes in tests."""
+  global _bigquery_client, _bqstorage_client
+
+  with _lock:
+    _bigquery_client = bigquery_client
+    _bqstorage_client = bqstorage_client
+
+
+def reset():
+  """Drops the shared clients so the next call creates new ones."""
+  set_clients()
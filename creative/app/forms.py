@@ -28,6 +28,7 @@ from wtforms.validators import Length
 
 BRAND_TRACK = 'brand_track'
 BRAND_LIFT = 'brand_lift'
+SURVEY_TYPE_CHOICES = [(BRAND_TRACK, 'Brand Track'), (BRAND_LIFT, 'Brand Lift')]
 ANSWERS_ORDERED = 'ORDERED'
 ANSWERS_SHUFFLED = 'SHUFFLED'
 RESPONSES_AT_END = "Submit Responses at End of Survey"
@@ -278,8 +279,7 @@ class QuestionForm(FlaskForm):
   language = SelectField('language', choices=('en', 'es', 'fr', 'ms', 'zh', 'ja', 'ko'))
 
   # make BRAND_TRACK to be the default
-  surveytype = SelectField('surveyType', choices=[(
-    BRAND_TRACK, 'Brand Track'), (BRAND_LIFT, 'Brand Lift'), ])
+  surveytype = SelectField('surveyType', choices=SURVEY_TYPE_CHOICES)
     
   surveyname = StringField('surveyName', validators=[DataRequired()])
 
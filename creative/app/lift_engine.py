@@ -0,0 +1,165 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Counts survey answers and computes brand lift with NumPy array operations.
+
+Counts are kept in two arrays: `answers`, indexed by (question, segment,
+option), and `respondents`, indexed by (question, segment), which counts the
+responses that answered each question. Segments and options are encoded as
+small integer codes and every question is counted in one `np.bincount` pass,
+where option code 0 stands for "answered the question" and codes 1.. for the
+options in ANSWER_IDS.
+"""
+
+import concurrent.futures
+
+import numpy as np
+import pandas as pd
+import answer_columns
+import queries
+
+MAX_QUESTIONS = queries.MAX_QUESTIONS
+# Segments compared by the brand lift report, in the order of its rows.
+SEGMENTS = ['expose', 'control']
+# The options of a question. A multiple option answer such as "AC" counts
+# towards each option chosen.
+ANSWER_IDS = ['A', 'B', 'C', 'D']
+
+SHAPE = (MAX_QUESTIONS, len(SEGMENTS), len(ANSWER_IDS))
+
+
+def empty_counts():
+  """Returns zeroed (answers, respondents) arrays."""
+  return (np.zeros(SHAPE, dtype=np.int64),
+          np.zeros(SHAPE[:2], dtype=np.int64))
+
+
+def segment_codes(segmentation):
+  """Returns the index in SEGMENTS of each value, or -1 for other segments.
+
+  The "default_" prefix of the segments of default surveys is ignored.
+  """
+  codes, uniques = pd.factorize(pd.Series(segmentation, dtype=object))
+  names = [answer_columns.segment_name(segment)
+           if isinstance(segment, str) else None for segment in uniques]
+  lookup = np.array(
+      [SEGMENTS.index(name) if name in SEGMENTS else -1 for name in names] +
+      [-1], dtype=np.int64)
+  # Missing values are coded -1, which picks the trailing -1 of lookup.
+  return lookup[codes]
+
+
+def _split(counts):
+  """Splits a (question, segment, option code) array into the count arrays."""
+  return counts[:, :, 1:].copy(), counts[:, :, 0].copy()
+
+
+def count_rows(df):
+  """Adds up rows of the 'lift_counts' query.
+
+  Each row has a Segment, a 1-based Question, an Option (empty for the count
+  of responses that answered the question) and its number of Responses.
+  """
+  segments = segment_codes(df['Segment'])
+  questions = df['Question'].to_numpy(dtype=np.int64) - 1
+  options = pd.Index([''] + ANSWER_IDS).get_indexer(df['Option'])
+  valid = ((segments >= 0) & (options >= 0) & (questions >= 0) &
+           (questions < MAX_QUESTIONS))
+  width = len(ANSWER_IDS) + 1
+  flat = (questions * len(SEGMENTS) + segments) * width + options
+  counts = np.bincount(
+      flat[valid], weights=df['Responses'].to_numpy()[valid],
+      minlength=MAX_QUESTIONS * len(SEGMENTS) * width)
+  return _split(counts.astype(np.int64).reshape(
+      MAX_QUESTIONS, len(SEGMENTS), width))
+
+
+def _bootstrap_question(answers, respondents, samples, confidence, seed):
+  """Bootstraps the lift of one question's (segment, option) counts.
+
+  Returns a (3, option) array of the lift interval bounds and p-values.
+  """
+  rng = np.random.default_rng(seed)
+  with np.errstate(divide='ignore', invalid='ignore'):
+    shares = np.nan_to_num(answers / respondents[:, np.newaxis], posinf=1)
+    # The binomial is the per-option marginal of the multinomial bootstrap;
+    # it also holds when a response chooses several options.
+    resampled = rng.binomial(
+        respondents[:, np.newaxis, np.newaxis],
+        shares[:, :, np.newaxis],
+        size=shares.shape + (samples,)) / respondents[:, np.newaxis, np.newaxis]
+    difference = resampled[0] - resampled[1]
+    # A resample in which neither segment chose the option shows no lift.
+    lifts = np.where(difference == 0, 0, difference / resampled[1])
+
+  tail = (1 - confidence) / 2
+  # 'nearest' keeps infinite lifts from turning interpolated bounds into NaN.
+  low, high = np.quantile(lifts, [tail, 1 - tail], axis=-1, method='nearest')
+  p_values = np.minimum(1, 2 * np.minimum((difference <= 0).mean(axis=-1),
+                                          (difference >= 0).mean(axis=-1)))
+  result = np.stack([low, high, p_values])
+  # Without responses in both segments there is nothing to compare.
+  result[:, :] = np.where(respondents.all(), result, np.nan)
+  return result
+
+
+def bootstrap(answers, respondents, samples=2000, confidence=0.95, seed=None,
+              processes=None):
+  """Bootstrap confidence intervals and p-values of each option's lift.
+
+  Each segment's option counts are resampled from the shares they were
+  observed with, `samples` times at once, so only the counts are needed.
+  The p-value is the two-sided share of resamples on the far side of no
+  difference between the segments. With `processes`, questions are
+  bootstrapped in a process pool.
+
+  Returns a (question, 3, option) array of the lower and upper interval
+  bounds and the p-values; suitable as the `significance` of lift().
+  """
+  seeds = np.random.SeedSequence(seed).spawn(len(answers))
+  args = [(answers[question], respondents[question], samples, confidence,
+           seeds[question]) for question in range(len(answers))]
+  if processes:
+    with concurrent.futures.ProcessPoolExecutor(processes) as executor:
+      results = list(executor.map(_bootstrap_question, *zip(*args)))
+  else:
+    results = [_bootstrap_question(*arg) for arg in args]
+  return np.stack(results)
+
+
+def lift(answers, respondents, significance=None):
+  """Returns the expose, control and lift rows of each question.
+
+  Shares are of the responses that answered the question. A share is NaN for
+  a segment without such responses; lift is infinite when an option was
+  never chosen by the control segment but was by the exposed one, and NaN
+  when neither chose it. Questions after the last one anybody answered, and
+  options after the last one anybody chose, are left out. The rows of
+  `significance`, a (question, row, option) array, are appended to each
+  question's rows.
+  """
+  with np.errstate(divide='ignore', invalid='ignore'):
+    shares = answers / respondents[:, :, np.newaxis]
+    lifts = (shares[:, 0] - shares[:, 1]) / shares[:, 1]
+
+  answered = np.flatnonzero(respondents.sum(axis=1))
+  output = []
+  for question in range(answered[-1] + 1 if len(answered) else 0):
+    chosen = np.flatnonzero(answers[question].sum(axis=0))
+    width = chosen[-1] + 1 if len(chosen) else 0
+    rows = [shares[question, :, :width], lifts[question, :width]]
+    if significance is not None:
+      rows.append(significance[question, :, :width])
+    output.append(np.vstack(rows))
+  return output
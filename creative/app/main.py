@@ -14,9 +14,13 @@
 """Import of required packages/libraries."""
 
 # OS imports
+import collections
 import datetime
+import math
 import os
 import datetime
+import unicodedata
+import urllib.parse
 
 # Flask imports
 from flask import flash
@@ -25,10 +29,10 @@ from flask import redirect
 from flask import render_template
 from flask import request
 from flask import Response
-from flask import send_file
 from flask import url_for
 from flask_basicauth import BasicAuth
 from flask_bootstrap import Bootstrap
+from werkzeug.http import quote_header_value
 
 # local file imports
 import forms
@@ -60,6 +64,8 @@ OLD_COLOR = '#d9534f'
 OLD_TEXT = 'Timed Out'
 INDETERMINATE_COLOR = '#a0a0a0'
 MRC_INIT = 999999999
+DASHBOARD_PAGE_SIZE = 50
+MAX_DASHBOARD_PAGE_SIZE = 500
 
 
 @app.route('/')
@@ -67,51 +73,85 @@ def root():
   return redirect(url_for('index'))
 
 
-@app.route('/index')
-def index():
-  all_surveys = survey_service.get_all()
-  stat_array = []
-  tmp_stats = survey_service.get_all_response_counts()
-  
-  for survey in all_surveys:
-    # filter down to just this survey.id in DataFrame & convert into a dict
-    df = tmp_stats.loc[tmp_stats["ID"]==survey.id]
-    segmentation_rows = df.to_dict()
-
-    # set high number for last update
-    most_recent_change = MRC_INIT
-
-    # build an array with stats for each segmentation
-    segs = []
-    for x in segmentation_rows['ID']:
-        a = {'Segmentation':segmentation_rows['Segmentation'][x],
-             'response_count':segmentation_rows['response_count'][x],
-             'days_since_response':segmentation_rows['days_since_response'][x] }
-
-        if segmentation_rows['days_since_response'][x] < most_recent_change:
-            most_recent_change = segmentation_rows['days_since_response'][x]
-
-        segs.append(a)
-
-    if most_recent_change <= ACTIVE_DAYS:
-        color = ACTIVE_COLOR
-        status_text = ACTIVE_TEXT
-    elif most_recent_change <= WARNING_DAYS:
-        color = WARNING_COLOR
-        status_text = WARNING_TEXT
-    elif most_recent_change > WARNING_DAYS:
-        color = OLD_COLOR
-        status_text = OLD_TEXT
-    else:
-        color = INDETERMINATE_COLOR
+def survey_status(segs):
+  """Returns the dashboard stats, colour and status for one survey."""
+  most_recent_change = min(
+      (seg['days_since_response'] for seg in segs), default=MRC_INIT)
+
+  if most_recent_change <= ACTIVE_DAYS:
+    color = ACTIVE_COLOR
+    status_text = ACTIVE_TEXT
+  elif most_recent_change <= WARNING_DAYS:
+    color = WARNING_COLOR
+    status_text = WARNING_TEXT
+  elif most_recent_change > WARNING_DAYS:
+    color = OLD_COLOR
+    status_text = OLD_TEXT
+  else:
+    color = INDETERMINATE_COLOR
+    status_text = ''
+
+  if most_recent_change == MRC_INIT:
+    most_recent_change = -1
+
+  return {'stats': segs, 'color': color, 'last_change': most_recent_change,
+          'status': status_text}
+
 
-    if most_recent_change == MRC_INIT:
-        most_recent_change = -1
+def get_survey_stats(response_counts):
+  """Groups the response counts by survey id in a single pass."""
+  segs_by_id = collections.defaultdict(list)
+  for survey_id, segmentation, count, days in zip(
+      response_counts['ID'], response_counts['Segmentation'],
+      response_counts['response_count'],
+      response_counts['days_since_response']):
+    segs_by_id[survey_id].append({'Segmentation': segmentation,
+                                  'response_count': count,
+                                  'days_since_response': days})
+  return {survey_id: survey_status(segs)
+          for survey_id, segs in segs_by_id.items()}
 
-    stat_array.append({'id':survey.id,'stats':segs,'color':color,'last_change':most_recent_change,'status':status_text})
 
-  all_surveys = survey_service.get_all()
-  return render_template('index.html', all_surveys=all_surveys, stat_array=stat_array, title=title)
+def get_dashboard_filters(args):
+  """Reads the dashboard filters from the query string.
+
+  Only active surveys are listed unless archived is "true" or "all".
+  """
+  archived = {'true': True, 'all': None}.get(args.get('archived'), False)
+  return {
+      'surveytype': args.get('surveytype') or None,
+      'archived': archived,
+      'name_prefix': args.get('name') or None,
+  }
+
+
+@app.route('/index')
+def index():
+  filters = get_dashboard_filters(request.args)
+  page_size = request.args.get('page_size', DASHBOARD_PAGE_SIZE, type=int)
+  page_size = min(max(page_size, 1), MAX_DASHBOARD_PAGE_SIZE)
+  # One extra survey tells us whether there is a next page.
+  all_surveys = survey_service.get_page(
+      page_size + 1, start_after=request.args.get('start_after'), **filters)
+
+  next_url = None
+  if len(all_surveys) > page_size:
+    all_surveys = all_surveys[:page_size]
+    args = request.args.to_dict()
+    args['start_after'] = all_surveys[-1].id
+    next_url = url_for('index', **args)
+  first_url = None
+  if request.args.get('start_after'):
+    args = request.args.to_dict()
+    del args['start_after']
+    first_url = url_for('index', **args)
+
+  stats = get_survey_stats(survey_service.get_all_response_counts(
+      [survey.id for survey in all_surveys]))
+  return render_template('index.html', all_surveys=all_surveys, stats=stats,
+                         no_stats=survey_status([]), next_url=next_url,
+                         first_url=first_url, filters=request.args,
+                         survey_types=forms.SURVEY_TYPE_CHOICES, title=title)
 
 
 @app.route('/survey/create', methods=['GET', 'POST'])
@@ -190,6 +230,20 @@ def edit():
   return render_template('questions.html', form=form)
 
 
+@app.route('/survey/archive/<string:survey_id>', methods=['POST'])
+def archive(survey_id):
+  """Archive survey."""
+  survey_service.set_archived(survey_id, True)
+  return redirect(url_for('index'))
+
+
+@app.route('/survey/unarchive/<string:survey_id>', methods=['POST'])
+def unarchive(survey_id):
+  """Restore an archived survey to the dashboard."""
+  survey_service.set_archived(survey_id, False)
+  return redirect(url_for('index', archived='true'))
+
+
 @app.route('/survey/download_zip/<string:survey_id>', methods=['GET'])
 def download_zip(survey_id):
   """Download zip of survey creative(s)."""
@@ -201,21 +255,61 @@ def download_zip(survey_id):
   # this is the standard survey
   filename, data = survey_service.zip_file(survey_id, survey_doc.to_dict())
 
-  return send_file(
+  # Each segment's zip is sent as soon as it is rendered.
+  return Response(
       data,
       mimetype='application/zip',
-      etag=False,
-      max_age=0,
-      last_modified=datetime.datetime.now(),
-      as_attachment=True,
-      download_name=filename)
+      headers={'Content-disposition': content_disposition(filename),
+               'Cache-Control': 'no-cache'})
+
+
+def content_disposition(filename):
+  """Returns an attachment header for filename, as send_file() writes it.
+
+  Names that are not ASCII get an ASCII filename and an RFC 5987 filename*.
+  """
+  try:
+    filename.encode('ascii')
+    return 'attachment; filename=%s' % quote_header_value(filename)
+  except UnicodeEncodeError:
+    simple = unicodedata.normalize('NFKD', filename).encode(
+        'ascii', 'ignore').decode('ascii')
+    quoted = urllib.parse.quote(filename, safe="!#$&+^`|~")
+    return "attachment; filename=%s; filename*=UTF-8''%s" % (
+        quote_header_value(simple), quoted)
+
+
+def export_responses(survey_id, filename, with_context):
+  """Streams the ?format=parquet|arrow download of the survey responses.
+
+  ?compression picks one of the format's compressions in
+  survey_service.EXPORT_FORMATS.
+  """
+  export_format = request.args.get('format')
+  if export_format not in survey_service.EXPORT_FORMATS:
+    return 'Unsupported format: %s' % export_format, 400
+  mimetype, extension, compressions, _ = survey_service.EXPORT_FORMATS[
+      export_format]
+  compression = request.args.get('compression')
+  if compression and compression not in compressions:
+    return 'Unsupported compression: %s' % compression, 400
+  data = survey_service.export_responses(
+      survey_id, export_format, compression, with_context=with_context)
+  return Response(
+      data,
+      mimetype=mimetype,
+      headers={'Content-disposition':
+               f'attachment; filename={filename}.{extension}'})
 
 
 @app.route('/survey/download_responses/<string:survey_id>', methods=['GET'])
 def download_responses(survey_id):
   """Download survey responses."""
   if request.method == 'GET':
+    if request.args.get('format', 'csv') != 'csv':
+      return export_responses(survey_id, 'surveydata', with_context=False)
     csv = survey_service.download_responses(survey_id)
+    # The CSV is streamed to the client as it is read from BigQuery.
     return Response(
         csv,
         mimetype='text/csv',
@@ -226,6 +320,9 @@ def download_responses(survey_id):
 def download_responses_context(survey_id):
   """Download survey responses with context"""
   if request.method == 'GET':
+    if request.args.get('format', 'csv') != 'csv':
+      return export_responses(
+          survey_id, 'surveydata_context', with_context=True)
     csv = survey_service.download_responses_with_context(survey_id)
     return Response(
         csv,
@@ -233,6 +330,33 @@ def download_responses_context(survey_id):
         headers={'Content-disposition': 'attachment; filename=surveydata_context.csv'})
 
 
+@app.route('/survey/download_responses_bulk', methods=['GET'])
+def download_responses_bulk():
+  """Download a zip of the responses of every ?survey_id in ?format."""
+  survey_ids = list(dict.fromkeys(request.args.getlist('survey_id')))
+  if not survey_ids:
+    return 'No survey_id given', 400
+  if len(survey_ids) > survey_service.MAX_BULK_EXPORT_SURVEYS:
+    return 'At most %d surveys can be downloaded at once' % (
+        survey_service.MAX_BULK_EXPORT_SURVEYS), 400
+  export_format = request.args.get('format', 'csv')
+  compression = request.args.get('compression')
+  if export_format != 'csv':
+    if export_format not in survey_service.EXPORT_FORMATS:
+      return 'Unsupported format: %s' % export_format, 400
+    if compression and compression not in survey_service.EXPORT_FORMATS[
+        export_format][2]:
+      return 'Unsupported compression: %s' % compression, 400
+  elif compression:
+    return 'Unsupported compression: %s' % compression, 400
+  data = survey_service.export_bulk(survey_ids, export_format, compression)
+  return Response(
+      data,
+      mimetype='application/zip',
+      headers={'Content-disposition':
+               'attachment; filename=surveydata_bulk.zip'})
+
+
 @app.route('/survey/reporting/<string:survey_id>', methods=['GET'])
 def reporting(survey_id):
   """Survey reporting."""
@@ -240,10 +364,16 @@ def reporting(survey_id):
 
   if survey_doc.exists:
     survey_info = survey_doc.to_dict()
+    if survey_info.get('archived'):
+      flash('Survey is archived - restore it to see its reporting')
+      return redirect(url_for('index', archived='true'))
     results = survey_service.get_brand_lift_results(survey_id)
+    latency = survey_service.get_response_latency(survey_id)
     return render_template(
         'reporting.html',
         results=results,
+        confidence=survey_service.LIFT_CONFIDENCE,
+        latency=latency,
         survey=survey_info,
         survey_id=survey_id)
   else:
@@ -265,9 +395,18 @@ def get_all_question_text(survey):
 
 @app.template_filter('format_percentage')
 def format_percentage(num):
+  if math.isnan(num):
+    return '-'
   return '{:.2%}'.format(num)
 
 
+@app.template_filter('format_p_value')
+def format_p_value(num):
+  if math.isnan(num):
+    return '-'
+  return '{:.3f}'.format(num)
+
+
 @app.template_filter('has_reporting')
 def is_brand_track(survey):
   return survey.to_dict().get('surveytype', '') != BRAND_TRACK
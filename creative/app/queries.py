@@ -0,0 +1,247 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Named BigQuery queries over one survey's responses, and a result cache.
+
+Every query takes the survey id as the @survey_id parameter, except
+'bulk_answers', which reads the surveys of the @survey_ids array. Results are
+cached by query name, survey id and a freshness token made of the survey's
+row count and latest CreatedAt, so a result is reused until responses arrive
+or are compacted away. The token itself is reused for a few seconds, so a
+burst of requests for one survey runs no query at all.
+"""
+
+import collections
+import os
+import threading
+import time
+
+from google.cloud import bigquery
+
+import clients
+
+# Surveys have at most this many questions (question1 .. question5).
+MAX_QUESTIONS = 5
+
+# Projects one AnswerN column per question from the Answers records the
+# receiver parses at ingestion time. Rows written before the receiver parsed
+# responses have no Answers, so their answer is extracted from Response.
+ANSWER_COLUMNS = ',\n'.join(
+    f"""IF(ARRAY_LENGTH(Answers) > 0,
+           (SELECT AnswerId FROM UNNEST(Answers)
+            WHERE QuestionId = {i} LIMIT 1),
+           NULLIF(REGEXP_EXTRACT(Response, r'(?:^|\\|){i}:([^|]*)'), ''))
+        AS Answer{i}""" for i in range(1, MAX_QUESTIONS + 1))
+ANSWER_STRUCTS = ', '.join(
+    f'STRUCT({i} AS Question, Answer{i} AS AnswerId)'
+    for i in range(1, MAX_QUESTIONS + 1))
+
+# Responses created before @horizon are final for the lift counts, provided
+# the receiver's compaction has already removed the partial submissions they
+# supersede. The counters table records how far the last compaction got (the
+# counters are refreshed right after it), so the horizon never passes that.
+LIFT_HORIZON = """
+    GREATEST(@since, LEAST(@horizon, IFNULL(
+        (SELECT MAX(CountedThrough) FROM `{counters_table_id}`), @since)))"""
+
+# Responses whose first question was skipped are left out of every report.
+QUERIES = {
+    'answers': """
+        SELECT CreatedAt, Segmentation, {answer_columns}
+        FROM `{table_id}`
+        WHERE ID = @survey_id
+        AND NOT STARTS_WITH(Response, '1:|')
+    """,
+    # Counts per settled flag, segment, question and option. The row with an
+    # empty Option counts the responses that answered the question; a multiple
+    # option answer such as "AC" adds to both A and C. Responses are settled
+    # when created before the Horizon, see LIFT_HORIZON.
+    'lift_counts': """
+        SELECT Horizon, Settled, Segment, a.Question, Option,
+               COUNT(*) AS Responses
+        FROM (
+            SELECT
+                Horizon,
+                CreatedAt < Horizon AS Settled,
+                REPLACE(Segmentation, 'default_', '') AS Segment,
+                [{answer_structs}] AS Answered
+            FROM (
+                SELECT CreatedAt, Segmentation, {answer_columns}
+                FROM `{table_id}`
+                WHERE ID = @survey_id
+                AND CreatedAt >= @since
+                AND NOT STARTS_WITH(Response, '1:|')),
+            (SELECT {lift_horizon} AS Horizon)),
+        UNNEST(Answered) AS a,
+        UNNEST(ARRAY_CONCAT([''], SPLIT(a.AnswerId, ''))) AS Option
+        WHERE a.AnswerId IS NOT NULL
+        AND Segment IN ('expose', 'control')
+        GROUP BY 1, 2, 3, 4, 5
+    """,
+    # The answers of several surveys, one survey after the other.
+    'bulk_answers': """
+        SELECT ID, CreatedAt, Segmentation, {answer_columns}
+        FROM `{table_id}`
+        WHERE ID IN UNNEST(@survey_ids)
+        AND NOT STARTS_WITH(Response, '1:|')
+        ORDER BY ID
+    """,
+    'latency': """
+        SELECT * EXCEPT (ID)
+        FROM `{latency_view_id}`
+        WHERE ID = @survey_id
+        ORDER BY Segmentation
+    """,
+    'freshness': """
+        SELECT count(*) AS row_count, max(CreatedAt) AS last_created_at
+        FROM `{table_id}`
+        WHERE ID = @survey_id
+    """,
+}
+
+
+def get_sql(name):
+  """Returns the SQL of the named query for the configured tables."""
+  counters_table_id = os.environ.get('COUNTERS_TABLE_ID')
+  return QUERIES[name].format(
+      table_id=os.environ.get('TABLE_ID'),
+      latency_view_id=os.environ.get('LATENCY_VIEW_ID'),
+      answer_columns=ANSWER_COLUMNS,
+      answer_structs=ANSWER_STRUCTS,
+      lift_horizon=LIFT_HORIZON.format(counters_table_id=counters_table_id)
+      if counters_table_id else '@horizon')
+
+
+def execute(sql, survey_id, client=None, params=None):
+  """Runs sql with @survey_id bound and returns the rows as a DataFrame.
+
+  params are any further query parameters the SQL uses.
+  """
+  if client is None:
+    client = clients.get_bigquery_client()
+  job_config = bigquery.QueryJobConfig(query_parameters=[
+      bigquery.ScalarQueryParameter('survey_id', 'STRING', survey_id),
+  ] + list(params or []))
+  query_job = client.query(sql, job_config=job_config)
+  return query_job.result().to_dataframe(
+      bqstorage_client=clients.get_bqstorage_client())
+
+
+def stream(sql, survey_id, client=None, params=None):
+  """Runs sql like execute() and returns its rows as Arrow record batches.
+
+  The batches are read from the BigQuery Storage API as they are iterated,
+  so the whole result is never held in memory.
+  """
+  if client is None:
+    client = clients.get_bigquery_client()
+  job_config = bigquery.QueryJobConfig(query_parameters=[
+      bigquery.ScalarQueryParameter('survey_id', 'STRING', survey_id),
+  ] + list(params or []))
+  query_job = client.query(sql, job_config=job_config)
+  return query_job.result().to_arrow_iterable(
+      bqstorage_client=clients.get_bqstorage_client())
+
+
+def stream_surveys(sql, survey_ids, client=None):
+  """Like stream(), but binds the list of survey ids as @survey_ids."""
+  if client is None:
+    client = clients.get_bigquery_client()
+  job_config = bigquery.QueryJobConfig(query_parameters=[
+      bigquery.ArrayQueryParameter('survey_ids', 'STRING', survey_ids),
+  ])
+  query_job = client.query(sql, job_config=job_config)
+  return query_job.result().to_arrow_iterable(
+      bqstorage_client=clients.get_bqstorage_client())
+
+
+def freshness_token(survey_id):
+  """Returns a value that changes whenever the survey's responses change."""
+  job_config = bigquery.QueryJobConfig(query_parameters=[
+      bigquery.ScalarQueryParameter('survey_id', 'STRING', survey_id),
+  ])
+  rows = clients.get_bigquery_client().query(
+      get_sql('freshness'), job_config=job_config).result()
+  return tuple(tuple(row.values()) for row in rows)
+
+
+class ResultCache(object):
+  """Bounded LRU of query results, and of freshness tokens for token_ttl.
+
+  Callers get a copy of a cached DataFrame, so they can modify it freely;
+  other results, like brand lift's list of arrays, are copied shallowly.
+  """
+
+  def __init__(self, max_entries=32, token_ttl=30.0):
+    self.max_entries = max_entries
+    self.token_ttl = token_ttl
+    self.hits = 0
+    self.misses = 0
+    self._entries = collections.OrderedDict()
+    self._tokens = collections.OrderedDict()
+    self._lock = threading.Lock()
+
+  def __len__(self):
+    return len(self._entries)
+
+  def get_or_load(self, key, load):
+    """Returns the result cached for key, calling load() on a miss."""
+    with self._lock:
+      if key in self._entries:
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return self._entries[key].copy()
+      self.misses += 1
+
+    # Queries run outside the lock so that other surveys are not held up.
+    result = load()
+    with self._lock:
+      self._entries[key] = result
+      self._entries.move_to_end(key)
+      while len(self._entries) > self.max_entries:
+        self._entries.popitem(last=False)
+    return result.copy()
+
+  def get_token(self, survey_id, load=None):
+    """Returns the survey's freshness token, loading it once per token_ttl.
+
+    A result can be served for up to token_ttl seconds after responses
+    arrive.
+    """
+    with self._lock:
+      entry = self._tokens.get(survey_id)
+      if entry is not None and entry[0] > time.monotonic():
+        return entry[1]
+    token = (load or (lambda: freshness_token(survey_id)))()
+    with self._lock:
+      self._tokens[survey_id] = (time.monotonic() + self.token_ttl, token)
+      self._tokens.move_to_end(survey_id)
+      while len(self._tokens) > self.max_entries:
+        self._tokens.popitem(last=False)
+    return token
+
+  def clear(self):
+    with self._lock:
+      self._entries.clear()
+      self._tokens.clear()
+
+  def stats(self):
+    with self._lock:
+      return {'hits': self.hits, 'misses': self.misses,
+              'size': len(self._entries)}
+
+
+result_cache = ResultCache(
+    max_entries=int(os.environ.get('QUERY_CACHE_MAX_ENTRIES', 32)),
+    token_ttl=float(os.environ.get('QUERY_FRESHNESS_TTL_SECONDS', 30)))
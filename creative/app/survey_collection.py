@@ -12,32 +12,141 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 """Importing Google Firestore for survey storage."""
+import collections
+import os
+import threading
+import time
+
+from google.api_core import exceptions
 from google.cloud import firestore
+from google.cloud.firestore_v1.base_query import FieldFilter
 # from google.cloud import firestore_v1
 
 db = firestore.Client()
 # this creates a global containing ALL surveys from the
 # firebase datastore
 survey_collection = db.collection(u'Surveys')
+# Brand lift counts of settled responses, one document per survey.
+lift_counts_collection = db.collection(u'LiftCounts')
+
+# The fields the dashboard shows. Listing surveys fetches only these, leaving
+# out large fields such as custom_css.
+DASHBOARD_FIELDS = [
+    'surveyname', 'surveytype', 'archived', 'question1', 'question2',
+    'question3', 'question4', 'question5'
+]
+
+
+class DocumentCache(object):
+  """Bounded LRU of survey snapshots that expire after ttl seconds.
+
+  The cache is local to the process, so a survey edited through another App
+  Engine instance can be served stale for up to ttl seconds. Writes made
+  through this module invalidate the entry right away.
+  """
+
+  def __init__(self, max_entries=256, ttl=60.0):
+    self.max_entries = max_entries
+    self.ttl = ttl
+    self.hits = 0
+    self.misses = 0
+    self._entries = collections.OrderedDict()
+    self._lock = threading.Lock()
+
+  def __len__(self):
+    return len(self._entries)
+
+  def get(self, key):
+    """Returns the cached value, or None if it is missing or expired."""
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry is not None and entry[0] > time.monotonic():
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+      if entry is not None:
+        del self._entries[key]
+      self.misses += 1
+      return None
+
+  def put(self, key, value):
+    with self._lock:
+      self._entries[key] = (time.monotonic() + self.ttl, value)
+      self._entries.move_to_end(key)
+      while len(self._entries) > self.max_entries:
+        self._entries.popitem(last=False)
+
+  def invalidate(self, key=None):
+    """Drops one entry, or every entry when key is None."""
+    with self._lock:
+      if key is None:
+        self._entries.clear()
+      else:
+        self._entries.pop(key, None)
+
+  def stats(self):
+    with self._lock:
+      return {'hits': self.hits, 'misses': self.misses,
+              'size': len(self._entries)}
+
+
+document_cache = DocumentCache(
+    max_entries=int(os.environ.get('SURVEY_CACHE_MAX_ENTRIES', 256)),
+    ttl=float(os.environ.get('SURVEY_CACHE_TTL_SECONDS', 60)))
 
 
 def get_all():
   return survey_collection.stream()
 
 
-def get_active():
-  global db, survey_collection
+def get_page(page_size, start_after=None, surveytype=None, archived=None,
+             name_prefix=None, fields=None):
+  """Returns up to page_size surveys ordered by name.
 
-  filter_1 = FieldFilter("archived", "!=", True)
-  # cannot query by a field when it doesn't exist
-  # like in the case of an old Firestore schema being upgraded  :-(
-  # filter_2 = FieldFilter("archived", "!=", True)
+  start_after is the id of the last survey of the previous page. The other
+  arguments, when given, filter the surveys in Firestore and restrict the
+  fields that are fetched.
+  """
+  global survey_collection
 
-  # Create the union filter of the two filters (queries)
-  #or_filter = Or(filters=[filter_1, filter_2])
+  query = survey_collection
+  if surveytype:
+    query = query.where(filter=FieldFilter('surveytype', '==', surveytype))
+  if archived is not None:
+    query = query.where(filter=FieldFilter('archived', '==', archived))
+  if name_prefix:
+    query = query.where(
+        filter=FieldFilter('surveyname', '>=', name_prefix)).where(
+            filter=FieldFilter('surveyname', '<', name_prefix + u'\uf8ff'))
+  query = query.order_by('surveyname')
+  if fields:
+    query = query.select(fields)
+  if start_after:
+    cursor = survey_collection.document(start_after).get()
+    if cursor.exists:
+      query = query.start_after(cursor)
+  return list(query.limit(page_size).stream())
+
+
+def backfill_archived(batch_size=400):
+  """Sets archived=False on surveys without the field; returns the count."""
+  global db, survey_collection
 
-  #(db.collection(u"Surveys").where(filter=or_filter).stream())
-  return (db.collection(u"Surveys").where(filter=filter_1).stream())
+  updated = 0
+  batch = db.batch()
+  for doc in survey_collection.select(['archived']).stream():
+    if 'archived' in doc.to_dict():
+      continue
+    batch.update(doc.reference, {'archived': False})
+    updated += 1
+    # Firestore accepts at most 500 writes per batch.
+    if updated % batch_size == 0:
+      batch.commit()
+      batch = db.batch()
+  if updated % batch_size:
+    batch.commit()
+  document_cache.invalidate()
+  return updated
 
 
 def get_by_id(survey_id):
@@ -47,14 +156,20 @@ def get_by_id(survey_id):
 
 
 def get_doc_by_id(survey_id):
-  ref = get_by_id(survey_id)
-  return ref.get()
+  """Returns the survey's snapshot, from the document cache if possible."""
+  doc = document_cache.get(survey_id)
+  if doc is None:
+    doc = get_by_id(survey_id).get()
+    document_cache.put(survey_id, doc)
+  return doc
 
 
 def delete_by_id(survey_id):
   global survey_collection
 
   survey_collection.document(survey_id).delete()
+  lift_counts_collection.document(survey_id).delete()
+  document_cache.invalidate(survey_id)
 
 
 def update_by_id(survey_id, data):
@@ -62,6 +177,7 @@ def update_by_id(survey_id, data):
 
   ref = survey_collection.document(survey_id)
   ref.update(data)
+  document_cache.invalidate(survey_id)
   return ref
 
 
@@ -70,4 +186,27 @@ def create(data):
 
   ref = survey_collection.document()
   ref.set(data)
+  document_cache.invalidate(ref.id)
   return ref
+
+
+def get_lift_counts(survey_id):
+  return lift_counts_collection.document(survey_id).get()
+
+
+def save_lift_counts(survey_id, data, previous):
+  """Stores data unless the counts changed since previous was read.
+
+  previous is the snapshot returned by get_lift_counts(). Returns False when
+  another request stored counts first; those already include the same rows.
+  """
+  ref = lift_counts_collection.document(survey_id)
+  try:
+    if previous.exists:
+      ref.update(
+          data, option=db.write_option(last_update_time=previous.update_time))
+    else:
+      ref.create(data)
+  except (exceptions.AlreadyExists, exceptions.FailedPrecondition):
+    return False
+  return True
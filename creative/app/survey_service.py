@@ -13,26 +13,76 @@
 # limitations under the License.
 
 """Various imports to be used for survey functionalites."""
+import concurrent.futures
 import datetime
 import io
 import os
 import zipfile
+from flask import current_app
 from flask import flash
 from flask import render_template
 from google.cloud import bigquery
-from google.cloud import bigquery_storage
 import google.cloud.bigquery.magics
+from google.cloud.exceptions import NotFound
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+import answer_columns
+import clients
+import lift_engine
+import queries
 import survey_collection
 from forms import BRAND_TRACK
 from forms import DEFAULT_CSS
 from forms import RESPONSES_AT_END
 
+MAX_QUESTIONS = queries.MAX_QUESTIONS
+# Responses older than this can be final: once an hour the receiver's
+# compactor deletes partial submissions older than two hours. They are only
+# stored once the last compaction has run past them too, as recorded in
+# COUNTERS_TABLE_ID. Without a counters table there is no such record, and
+# LIFT_UNTRACKED_SETTLE_MINUTES gives a day's worth of compactions instead.
+LIFT_SETTLE_MINUTES = 185
+LIFT_UNTRACKED_SETTLE_MINUTES = 24 * 60
+# Stored lift counts are recounted from scratch this often, which picks up
+# responses that arrived late with an old CreatedAt, from a spill file say,
+# and any partials that a late compaction removed after they were stored.
+LIFT_RECOUNT_HOURS = int(os.environ.get('LIFT_RECOUNT_HOURS', 24))
+# Columnar download formats: mimetype, file extension, allowed compressions
+# and the compression used when none is asked for.
+EXPORT_FORMATS = {
+    'parquet': ('application/vnd.apache.parquet', 'parquet',
+                ['none', 'snappy', 'gzip', 'brotli', 'zstd', 'lz4'], 'snappy'),
+    'arrow': ('application/vnd.apache.arrow.stream', 'arrows',
+              ['none', 'lz4', 'zstd'], 'none'),
+}
+# Most surveys one bulk download may include.
+MAX_BULK_EXPORT_SURVEYS = 100
+# Confidence level of the lift intervals on the reporting page.
+LIFT_CONFIDENCE = 0.95
+LIFT_BOOTSTRAP_SAMPLES = int(os.environ.get('LIFT_BOOTSTRAP_SAMPLES', 2000))
+# Bootstrap questions in this many processes; 0 bootstraps in the request.
+LIFT_BOOTSTRAP_PROCESSES = int(os.environ.get('LIFT_BOOTSTRAP_PROCESSES', 0))
+
+
 def get_all():
   return survey_collection.get_all()
 
 
+def get_page(page_size, start_after=None, surveytype=None, archived=None,
+             name_prefix=None):
+  """Returns one page of surveys with only the fields the dashboard shows."""
+  return survey_collection.get_page(
+      page_size,
+      start_after=start_after,
+      surveytype=surveytype,
+      archived=archived,
+      name_prefix=name_prefix,
+      fields=survey_collection.DASHBOARD_FIELDS)
+
+
 def get_doc_by_id(survey_id):
   return survey_collection.get_doc_by_id(survey_id)
 
@@ -46,7 +96,7 @@ def delete_by_id(survey_id):
 
 
 def create(form):
-  doc_ref = survey_collection.create(form.data)
+  doc_ref = survey_collection.create(dict(form.data, archived=False))
   flash(f'{form.surveyname.data} created as {doc_ref.id}')
 
 
@@ -55,18 +105,29 @@ def update_by_id(survey_id, form):
   flash(f'{form.surveyname.data} updated')
 
 
+def set_archived(survey_id, archived):
+  """Archives or restores a survey; archived surveys leave the dashboard."""
+  survey_collection.update_by_id(survey_id, {'archived': archived})
+  flash(f'{survey_id} {"archived" if archived else "restored"}')
+
+
 def set_form_data(form, edit_doc):
   edit_doc_dict = edit_doc.to_dict()
 
   for key, value in edit_doc_dict.items():
-    form[key].data = edit_doc.get(key,)
+    # Skip fields that are not edited in the form, such as archived.
+    if key in form:
+      form[key].data = edit_doc.get(key,)
 
 
 def zip_file(survey_id, survey_dict):
-  """File download function."""
-  # Make these use temp files in '/tmp/' to work around
-  # App Engine read only filesystem
+  """Returns the creative zip's file name and a generator of its bytes.
 
+  The zip holds one nested zip per segment, each with the segment's
+  index.html. Everything is built in memory, so concurrent downloads of the
+  same survey cannot overwrite each other's files. The renders start right
+  away and each nested zip is added as it is done.
+  """
   # Prepare data
   current_datetime = datetime.datetime.now().strftime('%Y%m%d')
   surveyname = survey_dict['surveyname'].replace(' ', '-')
@@ -86,39 +147,41 @@ def zip_file(survey_id, survey_dict):
   # create zip
   template_zips = write_html_template(survey_id, survey_dict, prefix_filename,
                                       seg_types)
-  combined_zip = zip_dir(prefix_filename, template_zips)
-
-  # make data response
-  with open(combined_zip.filename, 'rb') as file:
-    file_data = io.BytesIO(file.read())
-
-  # clean up tmp files
-  delete_tmp_zip_files([combined_zip] + template_zips)
+  return prefix_filename + '.zip', zip_dir(template_zips)
 
-  return os.path.basename(combined_zip.filename), file_data
 
-
-def zip_dir(filename, template_zips):
-  with zipfile.ZipFile('/tmp/' + filename + '.zip', 'w',
-                       zipfile.ZIP_DEFLATED) as zipdir:
-    for zip in template_zips:
-      zipdir.write(zip.filename)
-  return zipdir
+def zip_dir(template_zips):
+  """Yields a zip of the (name, bytes) zips, one chunk per nested zip."""
+  sink = _ChunkSink()
+  # The nested zips are compressed already.
+  with zipfile.ZipFile(sink, 'w', zipfile.ZIP_STORED) as zipdir:
+    for name, data in template_zips:
+      zipdir.writestr(name, data)
+      yield sink.drain()
+  yield sink.drain()
 
 
 def write_html_template(survey_id, survey_dict, prefix_filename, seg_types):
-  template_zips = []
+  """Yields a (name, bytes) zip of index.html for each segment, in order.
+
+  The segments are rendered on a thread each, in the current app context,
+  and every zip is yielded as soon as it and those before it are done.
+  """
+  app = current_app._get_current_object()
 
-  for seg_type in seg_types:
-    dir_name = '/tmp/' + prefix_filename + '_' + seg_type
-    # write html file
-    with zipfile.ZipFile(dir_name + '.zip', 'w',
-                         zipfile.ZIP_DEFLATED) as zip_write_file:
-      zip_write_file.writestr(
-          'index.html', get_html_template(survey_id, survey_dict, seg_type))
-      template_zips.append(zip_write_file)
+  def zip_template(seg_type):
+    with app.app_context():
+      html = get_html_template(survey_id, survey_dict, seg_type)
+    data = io.BytesIO()
+    with zipfile.ZipFile(data, 'w', zipfile.ZIP_DEFLATED) as zip_write_file:
+      zip_write_file.writestr('index.html', html)
+    return prefix_filename + '_' + seg_type + '.zip', data.getvalue()
 
-  return template_zips
+  executor = concurrent.futures.ThreadPoolExecutor(len(seg_types))
+  futures = [executor.submit(zip_template, seg_type) for seg_type in seg_types]
+  # The renders finish on their own; nothing waits for the pool.
+  executor.shutdown(wait=False)
+  return (future.result() for future in futures)
 
 
 def get_html_template(survey_id, survey_dict, seg_type):
@@ -141,11 +204,6 @@ def get_html_template(survey_id, survey_dict, seg_type):
       comment_text=get_comment_text(survey_dict))
 
 
-def delete_tmp_zip_files(zipfiles):
-  for zipfile in zipfiles:
-    os.remove(zipfile.filename)
-
-
 def get_all_question_text(survey):
   all_question_text = []
   for i in range(1, 6):
@@ -185,239 +243,395 @@ def get_question_json(survey):
 
 
 def get_brand_lift_results(surveyid):
-  table_id = os.environ.get('TABLE_ID')
-  query = f"""
-        SELECT CreatedAt, Segmentation, Response
-        FROM `{table_id}`
-        WHERE ID = @survey_id
-        AND NOT STARTS_WITH(Response, '1:|')
-    """
-  df = get_survey_responses(surveyid, query)
-  if df['Response'].any():
-    responselist = df['Response'].str.split(pat=('|'), expand=True)
-  else:
-    responselist = pd.DataFrame()
-  columns = list(responselist)
-  for i in columns:
-    responselist[i] = responselist[i].str.slice(start=2)
-  df = pd.concat([df, responselist], axis=1)
-  df.drop(['CreatedAt', 'Response'], axis=1, inplace=True)
-  df.replace(regex='default_', value='', inplace=True)
-
-  output = []
-  for i in range(len(df.columns) - 1):
-    # aggregate count
-    pivot = df.pivot_table(
-        index='Segmentation', columns=i, aggfunc=len, fill_value=0)
-    # rearrange rows
-    pivot = pivot.reindex(['expose', 'control'])
-    # convert count to percentages
-    pivot = pivot.div(pivot.sum(axis=1), axis=0)
-
-    # compute brand lift
-    matrix = pivot.to_numpy()
-    lift = []
-    for col in matrix.T:
-      lift.append((col[0] - col[1]) / col[1])
-
-    # append brand lift to matrix
-    matrix = np.vstack([matrix, lift])
-    output.append(matrix)
-  return output
-
-
-def get_survey_responses(surveyid, query, client=None):
+  """Brand lift per question, computed from stored and new response counts.
+
+  Counts of settled responses are stored in Firestore with the time up to
+  which they are complete (the watermark). Each call has BigQuery count the
+  responses created since the watermark: the settled counts are folded into
+  the stored ones and the newest are added for this report only. Every
+  LIFT_RECOUNT_HOURS the stored counts are dropped and counted again.
+
+  Each question's rows are the expose and control shares, the lift, and the
+  bounds of its LIFT_CONFIDENCE interval and its p-value. The totals do not
+  depend on where the watermark is, so the result is reused for as long as
+  the survey's responses are unchanged, like get_query_results.
+  """
+  key = ('lift', str(surveyid), queries.result_cache.get_token(str(surveyid)))
+  return queries.result_cache.get_or_load(
+      key, lambda: _count_brand_lift(surveyid))
+
+
+def _count_brand_lift(surveyid):
+  """Computes get_brand_lift_results, advancing the stored counts."""
+  # Firestore returns UTC timestamps; CreatedAt is a UTC DATETIME.
+  now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+  stored = survey_collection.get_lift_counts(surveyid)
+  data = stored.to_dict() if stored.exists else {}
+  answers, respondents = lift_engine.empty_counts()
+  watermark = datetime.datetime(1970, 1, 1)
+  recounted_at = now
+  if data.get('answer_counts') and data.get('recounted_at') and (
+      data['recounted_at'].replace(tzinfo=None) >
+      now - datetime.timedelta(hours=LIFT_RECOUNT_HOURS)):
+    answers = np.array(data['answer_counts'], dtype=np.int64).reshape(
+        lift_engine.SHAPE)
+    respondents = np.array(
+        data['respondent_counts'], dtype=np.int64).reshape(
+            lift_engine.SHAPE[:2])
+    watermark = data['watermark'].replace(tzinfo=None)
+    recounted_at = data['recounted_at'].replace(tzinfo=None)
+
+  settle_minutes = (LIFT_SETTLE_MINUTES if os.environ.get('COUNTERS_TABLE_ID')
+                    else LIFT_UNTRACKED_SETTLE_MINUTES)
+  horizon = max(now - datetime.timedelta(minutes=settle_minutes), watermark)
+  df = get_survey_responses(
+      surveyid, queries.get_sql('lift_counts'),
+      params=[
+          bigquery.ScalarQueryParameter('since', 'DATETIME', watermark),
+          bigquery.ScalarQueryParameter('horizon', 'DATETIME', horizon),
+      ])
+
+  settled = df['Settled'].to_numpy(dtype=bool)
+  new_answers, new_respondents = lift_engine.count_rows(df[settled])
+  answers += new_answers
+  respondents += new_respondents
+  if len(df):
+    # The query caps the horizon at the last compaction.
+    watermark = max(watermark,
+                    pd.Timestamp(df['Horizon'].max()).to_pydatetime())
+  survey_collection.save_lift_counts(surveyid, {
+      'answer_counts': answers.ravel().tolist(),
+      'respondent_counts': respondents.ravel().tolist(),
+      'watermark': watermark,
+      'recounted_at': recounted_at,
+  }, stored)
+
+  tail_answers, tail_respondents = lift_engine.count_rows(df[~settled])
+  answers += tail_answers
+  respondents += tail_respondents
+  # A fixed seed keeps the intervals steady across page loads.
+  significance = lift_engine.bootstrap(
+      answers, respondents, samples=LIFT_BOOTSTRAP_SAMPLES,
+      confidence=LIFT_CONFIDENCE, seed=0,
+      processes=LIFT_BOOTSTRAP_PROCESSES)
+  return lift_engine.lift(answers, respondents, significance)
+
+
+def get_response_latency(surveyid):
+  """Creative latency percentiles for each segmentation of a survey.
+
+  The latency view is optional: without LATENCY_VIEW_ID, or if the view has
+  not been created, there are no rows to show.
+  """
+  if not os.environ.get('LATENCY_VIEW_ID'):
+    return []
+  try:
+    df = get_query_results('latency', surveyid)
+  except NotFound:
+    return []
+  df['Segmentation'] = df['Segmentation'].str.replace('default_', '')
+  df = df.astype(object).where(df.notna(), None)
+  return df.to_dict('records')
+
+
+def get_survey_responses(surveyid, query, client=None, params=None):
   """Get data from survey"""
   google.cloud.bigquery.magics.context.use_bqstorage_api = True
-  project_id = os.environ.get('PROJECT_ID')
-  # table_id = os.environ.get('TABLE_ID')
-
-  if client is None:
-    client = bigquery.Client(project=project_id)
-  bqstorageclient = bigquery_storage.BigQueryReadClient()
-  job_config = bigquery.QueryJobConfig(
-      query_parameters=[bigquery.ScalarQueryParameter(
-          'survey_id','STRING',surveyid)])
-  query_job = client.query(query, job_config=job_config)
-  df = query_job.result().to_dataframe(bqstorage_client=bqstorageclient)
-  return df
+  return queries.execute(query, surveyid, client=client, params=params)
 
 
-def get_survey_responses_context(surveyid, client=None):
- 
-  """Get data from survey"""
-  google.cloud.bigquery.magics.context.use_bqstorage_api = True
-  project_id = os.environ.get('PROJECT_ID')
-  table_id = os.environ.get('TABLE_ID')
+def get_query_results(name, surveyid):
+  """Runs a named query for the survey, reusing the last result.
 
-  if client is None:
-    client = bigquery.Client(project=project_id)
-  bqstorageclient = bigquery_storage.BigQueryReadClient()
-  query = f"""
-        SELECT CreatedAt, Segmentation, Response
-        FROM `{table_id}`
-        WHERE ID = @survey_id
-        AND NOT STARTS_WITH(Response, '1:|')
-    """
-  job_config = bigquery.QueryJobConfig(query_parameters=[
-      bigquery.ScalarQueryParameter('survey_id', 'STRING', surveyid),
-  ])
-  query_job = client.query(query, job_config=job_config)
-  df = query_job.result().to_dataframe(bqstorage_client=bqstorageclient)
+  A cached result is used as long as the survey has neither new nor deleted
+  responses, which is checked at most once per QUERY_FRESHNESS_TTL_SECONDS.
+  """
+  key = (name, str(surveyid), queries.result_cache.get_token(str(surveyid)))
+  return queries.result_cache.get_or_load(
+      key, lambda: get_survey_responses(surveyid, queries.get_sql(name)))
 
-  return df
 
-def get_all_response_counts():
+def get_all_response_counts(survey_ids=None):
+  """Returns response counts per survey and segmentation.
+
+  Only the surveys in survey_ids are counted, if given. When COUNTERS_TABLE_ID
+  is set the counts maintained by the receiver's compaction job are read and
+  only responses newer than their watermark are counted from the responses
+  table. Otherwise the whole table is scanned.
+  """
   google.cloud.bigquery.magics.context.use_bqstorage_api = True
-  project_id = os.environ.get('PROJECT_ID')
   table_id = os.environ.get('TABLE_ID')
-  client = bigquery.Client(project=project_id)
-  bqstorageclient = bigquery_storage.BigQueryReadClient()
-
-  query = f"""
-    SELECT
-    ID,
-    Segmentation,
-    EXTRACT(DATE FROM max(CreatedAt)) as max_date,
-    DATE_DIFF(CURRENT_DATE(), EXTRACT(DATE FROM max(CreatedAt)), DAY) AS days_since_response,
-    count(*) as response_count
-    FROM `{table_id}`
-    WHERE ID is not null
-    GROUP BY 1,2
-    ORDER BY 1,2
-    """
-  query_job = client.query(query)
+  counters_table_id = os.environ.get('COUNTERS_TABLE_ID')
+  client = clients.get_bigquery_client()
+  bqstorageclient = clients.get_bqstorage_client()
+  id_filter = ''
+  job_config = bigquery.QueryJobConfig()
+  if survey_ids is not None:
+    id_filter = 'AND ID IN UNNEST(@survey_ids)'
+    job_config.query_parameters = [
+        bigquery.ArrayQueryParameter('survey_ids', 'STRING', list(survey_ids))
+    ]
+
+  if counters_table_id:
+    query = f"""
+      DECLARE watermark DATETIME DEFAULT (
+          SELECT MAX(CountedThrough) FROM `{counters_table_id}`);
+
+      SELECT
+      ID,
+      Segmentation,
+      EXTRACT(DATE FROM max(LastSeen)) as max_date,
+      DATE_DIFF(CURRENT_DATE(), EXTRACT(DATE FROM max(LastSeen)), DAY) AS days_since_response,
+      sum(ResponseCount) as response_count
+      FROM (
+        SELECT ID, Segmentation, ResponseCount, LastSeen
+        FROM `{counters_table_id}`
+        WHERE true {id_filter}
+        UNION ALL
+        SELECT ID, Segmentation, count(*), max(CreatedAt)
+        FROM `{table_id}`
+        WHERE ID is not null {id_filter}
+        AND (watermark IS NULL OR CreatedAt >= watermark)
+        GROUP BY 1,2
+      )
+      GROUP BY 1,2
+      ORDER BY 1,2
+      """
+  else:
+    query = f"""
+      SELECT
+      ID,
+      Segmentation,
+      EXTRACT(DATE FROM max(CreatedAt)) as max_date,
+      DATE_DIFF(CURRENT_DATE(), EXTRACT(DATE FROM max(CreatedAt)), DAY) AS days_since_response,
+      count(*) as response_count
+      FROM `{table_id}`
+      WHERE ID is not null {id_filter}
+      GROUP BY 1,2
+      ORDER BY 1,2
+      """
+  query_job = client.query(query, job_config=job_config)
   df = query_job.result().to_dataframe(bqstorage_client=bqstorageclient)
   return df
 
 
-def get_response_count_from_survey(survey):
-  """Get response count from survey"""
-  google.cloud.bigquery.magics.context.use_bqstorage_api = True
-  project_id = os.environ.get('PROJECT_ID')
-  table_id = os.environ.get('TABLE_ID')
+class _ChunkSink(object):
+  """A write-only file that hands out what was written since the last drain.
 
-  client = bigquery.Client(project=project_id)
-  bqstorageclient = bigquery_storage.BigQueryReadClient()
-  survey_id = survey.id
-  query = f"""
-        SELECT
-            Segmentation,
-            EXTRACT(DATE FROM max(CreatedAt)) as max_date,
-            DATE_DIFF(CURRENT_DATE(), EXTRACT(DATE FROM max(CreatedAt)), DAY) AS days_since_response,
-            count(*) as response_count
-        FROM `{table_id}`
-        WHERE ID = @survey_id
-        GROUP BY 1
-    """
+  It collects bytes, or str when text is True.
+  """
+
+  def __init__(self, text=False):
+    self.closed = False
+    self._empty = '' if text else b''
+    self._chunks = []
+
+  def write(self, data):
+    self._chunks.append(data if isinstance(data, str) else bytes(data))
+    return len(data)
+
+  def flush(self):
+    pass
+
+  def close(self):
+    self.closed = True
+
+  def drain(self):
+    data = self._empty.join(self._chunks)
+    self._chunks = []
+    return data
+
+
+class _CsvWriter(object):
+  """Writes record batches of responses to a text file as CSV."""
+
+  def __init__(self, file, question_headers):
+    self._file = file
+    self._question_count = len(question_headers)
+    file.write(pd.DataFrame(
+        columns=['Date', 'Control/Expose', 'Dimension 2'] +
+        question_headers).to_csv(index=False))
+
+  def write_batch(self, batch):
+    df = answer_columns.encode_batch(batch, self._question_count).to_pandas()
+    df.insert(2, 'Dimension 2', None)
+    self._file.write(df.to_csv(index=False, header=False))
+
+  def close(self):
+    self._file.close()
+
+
+class _ColumnarWriter(object):
+  """Writes record batches of responses to a binary file, see EXPORT_FORMATS.
+
+  CreatedAt is a timestamp and the segmentation and answers are dictionary
+  encoded, which pandas reads back as categoricals.
+  """
+
+  def __init__(self, file, question_headers, export_format, compression=None):
+    compression = compression or EXPORT_FORMATS[export_format][3]
+    category = answer_columns.CATEGORY
+    self._file = pa.PythonFile(file, mode='w')
+    self._schema = pa.schema([('CreatedAt', pa.timestamp('us')),
+                              ('Segmentation', category)] +
+                             [(header, category) for header in question_headers])
+    if export_format == 'parquet':
+      self._writer = pq.ParquetWriter(self._file, self._schema,
+                                      compression=compression)
+    else:
+      self._writer = pa.ipc.new_stream(
+          self._file, self._schema,
+          options=pa.ipc.IpcWriteOptions(
+              compression=None if compression == 'none' else compression))
+
+  def write_batch(self, batch):
+    encoded = answer_columns.encode_batch(batch, len(self._schema) - 2)
+    self._writer.write_batch(
+        pa.RecordBatch.from_arrays(encoded.columns, schema=self._schema))
+
+  def close(self):
+    self._writer.close()
+    self._file.close()
+
+
+def _open_writer(file, question_headers, export_format, compression=None):
+  if export_format == 'csv':
+    return _CsvWriter(file, question_headers)
+  return _ColumnarWriter(file, question_headers, export_format, compression)
+
+
+def _stream_batches(batches, sink, writer):
+  """Writes each record batch as it is read, yielding what it turned into.
+
+  What the writer wrote before the first batch, such as a CSV header, is
+  sent right away.
+  """
+  head = sink.drain()
+  if head:
+    yield head
+  for batch in batches:
+    writer.write_batch(batch)
+    yield sink.drain()
+  writer.close()
+  tail = sink.drain()
+  if tail:
+    yield tail
+
+
+def iter_responses_csv(surveyid, question_headers):
+  """Yields the survey responses as CSV, one chunk per record batch.
+
+  The query runs before the first chunk is requested; the rows are then read
+  from the BigQuery Storage API one record batch at a time, so memory use
+  does not grow with the number of responses.
+  """
+  batches = queries.stream(queries.get_sql('answers'), surveyid)
+  sink = _ChunkSink(text=True)
+  return _stream_batches(batches, sink, _CsvWriter(sink, question_headers))
+
+
+def iter_responses_columnar(surveyid, question_headers, export_format,
+                            compression=None):
+  """Yields the survey responses as Parquet or an Arrow IPC stream.
+
+  Like iter_responses_csv(), each record batch is written as it arrives.
+  """
+  batches = queries.stream(queries.get_sql('answers'), surveyid)
+  sink = _ChunkSink()
+  return _stream_batches(batches, sink, _ColumnarWriter(
+      sink, question_headers, export_format, compression))
+
+
+def get_question_headers(surveyid, with_context=False):
+  """Returns the download column name of each question of the survey.
+
+  With context the columns are named after the question texts, otherwise
+  they are "Response 1", "Response 2" and so on.
+  """
+  survey_doc = get_doc_by_id(surveyid)
+  survey_info = survey_doc.to_dict() if survey_doc.exists else None
+  headers = []
+  for i in range(1, answer_columns.get_question_count(survey_info) + 1):
+    header = f'Response {i}'
+    if with_context:
+      # Keep the default in case we can't talk to the Firestore DB
+      header = (survey_info or {}).get(f'question{i}') or header
+    headers.append(header)
+  return headers
 
-  job_config = bigquery.QueryJobConfig(query_parameters=[
-      bigquery.ScalarQueryParameter('survey_id', 'STRING', survey_id),
-  ])
-  query_job = client.query(query, job_config=job_config)
-  df = query_job.result().to_dataframe(bqstorage_client=bqstorageclient)
-  converted_dict = df.to_dict('index')
-  return converted_dict
 
 def download_responses(surveyid):
   """Download survey responses in a CSV format file."""
-  table_id = os.environ.get('TABLE_ID')
-  query = f"""
-        SELECT CreatedAt, Segmentation, Response
-        FROM `{table_id}`
-        WHERE ID = @survey_id
-        AND NOT STARTS_WITH(Response, '1:|')
-    """
-  df = get_survey_responses(surveyid, query)
-  output = {'Date': [], 'Control/Expose': [], 'Dimension 2': []}
-  outputdf = pd.DataFrame(data=output)
-  outputdf['Date'] = df['CreatedAt'].values
-  outputdf['Control/Expose'] = df['Segmentation'].values
-  if df['Response'].any():
-    responselist = df['Response'].str.split(pat=('|'), expand=True)
-  else:
-    responselist = pd.DataFrame()
-  columns = list(responselist)
-  for i in columns:
-    responselist[i] = responselist[i].str.slice(start=2)
-  responselist = responselist.rename(
-      columns={
-          0: 'Response 1',
-          1: 'Response 2',
-          2: 'Response 3',
-          3: 'Response 4',
-          4: 'Response 5'
-      })
-  responselist = responselist.reset_index(drop=True)
-  outputdf = pd.concat([outputdf, responselist], axis=1)
-  csv = outputdf.to_csv(index=False)
-  return csv
+  return iter_responses_csv(surveyid, get_question_headers(surveyid))
+
 
 def download_responses_with_context(surveyid):
   """Download survey responses in a CSV format file."""
-  # get a dataframe of the survey responses
-  table_id = os.environ.get('TABLE_ID')
-  query = f"""
-        SELECT CreatedAt, Segmentation, Response
-        FROM `{table_id}`
-        WHERE ID = @survey_id
-        AND NOT STARTS_WITH(Response, '1:|')
-    """
-  df = get_survey_responses(surveyid, query)
-
-  # Set the question texts to default values in case we can't talk to
-  # the Firestore DB
-  question1 = 'Response 1'
-  question2 = 'Response 2'
-  question3 = 'Response 3'
-  question4 = 'Response 4'
-  question5 = 'Response 5'
-
-  # Get the survey document object using the convenience function.
-  survey_doc = get_doc_by_id(surveyid)
-  # Did we get a good document back?
-  if survey_doc.exists:
-    # convert the document into a dictionary
-    survey_info = survey_doc.to_dict()
-
-    # Set variables for question1-5 to the values from the Firestore DB
-    # by walking the dictionary items and looking for well-known named
-    # keys that are used for the questions
-    for key, value in survey_info.items():
-      if key == 'question1':
-        question1 = survey_info.get(key)
-      elif key == 'question2':
-        question2 = survey_info.get(key)
-      elif key == 'question3':
-        question3 = survey_info.get(key)
-      elif key == 'question4':
-        question4 = survey_info.get(key)
-      elif key == 'question5':
-        question5 = survey_info.get(key)
-
-  output = {'Date': [], 'Control/Expose': [], 'Dimension 2': []}
-  outputdf = pd.DataFrame(data=output)
-  outputdf['Date'] = df['CreatedAt'].values
-  outputdf['Control/Expose'] = df['Segmentation'].values
-  if df['Response'].any():
-    responselist = df['Response'].str.split(pat=('|'), expand=True)
+  return iter_responses_csv(
+      surveyid, get_question_headers(surveyid, with_context=True))
+
+
+def export_responses(surveyid, export_format, compression=None,
+                     with_context=False):
+  """Download survey responses in a columnar format, see EXPORT_FORMATS."""
+  return iter_responses_columnar(
+      surveyid, get_question_headers(surveyid, with_context=with_context),
+      export_format, compression)
+
+
+def export_bulk(survey_ids, export_format='csv', compression=None):
+  """Yields a zip of one response file per survey, read by a single query.
+
+  The rows of every survey are read in one query ordered by survey, and each
+  record batch is split where the survey changes, so every file is written
+  in turn while the zip streams out. Surveys without responses get a file
+  with just the header (CSV) or schema.
+  """
+  headers = {
+      survey_id: get_question_headers(survey_id) for survey_id in survey_ids}
+  if export_format == 'csv':
+    extension, compress_type = 'csv', zipfile.ZIP_DEFLATED
   else:
-    responselist = pd.DataFrame()
-  columns = list(responselist)
-  for i in columns:
-    responselist[i] = responselist[i].str.slice(start=2)
-  responselist = responselist.rename(
-      columns={
-          0: question1,
-          1: question2,
-          2: question3,
-          3: question4,
-          4: question5
-      })
-  responselist = responselist.reset_index(drop=True)
-  outputdf = pd.concat([outputdf, responselist], axis=1)
-  csv = outputdf.to_csv(index=False)
-  return csv
+    # Parquet and Arrow files are compressed already.
+    extension, compress_type = (EXPORT_FORMATS[export_format][1],
+                                zipfile.ZIP_STORED)
+  batches = queries.stream_surveys(queries.get_sql('bulk_answers'),
+                                   list(headers))
+
+  def open_writer(archive, survey_id):
+    member = archive.open(f'{survey_id}.{extension}', 'w', force_zip64=True)
+    if export_format == 'csv':
+      member = io.TextIOWrapper(member, encoding='utf-8', newline='')
+    return _open_writer(member, headers[survey_id], export_format, compression)
+
+  def generate():
+    sink = _ChunkSink()
+    archive = zipfile.ZipFile(sink, 'w', compression=compress_type)
+    survey_id, writer = None, None
+    for batch in batches:
+      ids = pc.dictionary_encode(batch.column('ID'))
+      codes = ids.indices.to_numpy(zero_copy_only=False)
+      starts = [0] + list(np.flatnonzero(codes[1:] != codes[:-1]) + 1)
+      for start, end in zip(starts, starts[1:] + [len(batch)]):
+        if ids.dictionary[codes[start]].as_py() != survey_id:
+          if writer:
+            writer.close()
+          survey_id = ids.dictionary[codes[start]].as_py()
+          writer = open_writer(archive, survey_id)
+          headers.pop(survey_id)
+        writer.write_batch(batch.slice(start, end - start))
+      # The deflater of a CSV member may hold small batches back.
+      chunk = sink.drain()
+      if chunk:
+        yield chunk
+    if writer:
+      writer.close()
+    for survey_id in headers:
+      open_writer(archive, survey_id).close()
+    archive.close()
+    yield sink.drain()
+
+  return generate()
 
 
 #def get_thank_you_text(survey):
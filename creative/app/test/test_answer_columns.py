@@ -0,0 +1,62 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import unittest
+
+import pyarrow as pa
+import answer_columns
+
+
+class TestAnswerColumns(unittest.TestCase):
+
+  def test_strips_the_default_prefix_in_the_dictionary(self):
+    segments = answer_columns.encode_segments(
+        ['default_expose', 'expose', 'default_control', None])
+
+    self.assertEqual(segments.to_pylist(),
+                     ['expose', 'expose', 'control', None])
+    self.assertEqual(segments.dictionary.to_pylist(), ['expose', 'control'])
+
+  def test_encodes_answer_columns(self):
+    batch = pa.RecordBatch.from_arrays(
+        [pa.array(2 * [datetime.datetime(2024, 5, 1)]),
+         pa.array(['default_expose', 'control']), pa.array(['A', 'B']),
+         pa.array([None, 'D']), pa.array(['C', None])],
+        names=['CreatedAt', 'Segmentation', 'Answer1', 'Answer2', 'Answer3'])
+
+    encoded = answer_columns.encode_batch(batch, 2)
+
+    self.assertEqual(encoded.schema.names,
+                     ['CreatedAt', 'Segmentation', 'Answer1', 'Answer2'])
+    self.assertEqual(encoded.column('Answer2').to_pylist(), [None, 'D'])
+    self.assertTrue(pa.types.is_dictionary(encoded.schema.field('Answer1').type))
+    self.assertEqual(encoded.schema.field('CreatedAt').type,
+                     pa.timestamp('us'))
+    self.assertEqual(encoded.to_pylist()[0]['Segmentation'], 'default_expose')
+    self.assertEqual(
+        answer_columns.encode_batch(
+            batch, 2, strip_default=True).column('Segmentation').to_pylist(),
+        ['expose', 'control'])
+
+  def test_question_count(self):
+    self.assertEqual(answer_columns.get_question_count(
+        {'question1': 'Q1?', 'question2': '', 'question3': 'Q3?'}), 3)
+    self.assertEqual(answer_columns.get_question_count({}), 0)
+    self.assertEqual(answer_columns.get_question_count(None),
+                     answer_columns.MAX_QUESTIONS)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,58 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import concurrent.futures
+import os
+import unittest
+from unittest import mock
+
+import clients
+
+
+class TestClients(unittest.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    clients.reset()
+    self.addCleanup(clients.reset)
+
+  @mock.patch.object(clients.bigquery, 'Client')
+  def test_bigquery_client_is_created_once(self, client_class):
+    with mock.patch.dict(os.environ, {'PROJECT_ID': 'my-project'}):
+      with concurrent.futures.ThreadPoolExecutor(8) as executor:
+        results = list(executor.map(
+            lambda _: clients.get_bigquery_client(), range(32)))
+
+    client_class.assert_called_once_with(project='my-project')
+    self.assertTrue(all(result is client_class.return_value
+                        for result in results))
+
+  @mock.patch.object(clients.bigquery_storage, 'BigQueryReadClient')
+  def test_bqstorage_client_is_created_once(self, client_class):
+    clients.get_bqstorage_client()
+    clients.get_bqstorage_client()
+
+    client_class.assert_called_once_with()
+
+  def test_set_clients_injects_fakes(self):
+    fake_bigquery, fake_bqstorage = mock.Mock(), mock.Mock()
+
+    clients.set_clients(fake_bigquery, fake_bqstorage)
+
+    self.assertIs(clients.get_bigquery_client(), fake_bigquery)
+    self.assertIs(clients.get_bqstorage_client(), fake_bqstorage)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,140 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import math
+import unittest
+
+import numpy as np
+import pandas
+import lift_engine
+
+
+def make_rows(*rows):
+  """Builds 'lift_counts' query rows from (segment, question, option, count)."""
+  return pandas.DataFrame(
+      rows, columns=['Segment', 'Question', 'Option', 'Responses'])
+
+
+class TestCountRows(unittest.TestCase):
+
+  def test_counts_every_question_and_segment(self):
+    answers, respondents = lift_engine.count_rows(make_rows(
+        ('expose', 1, '', 2), ('expose', 1, 'A', 2),
+        ('control', 1, '', 1), ('control', 1, 'C', 1),
+        ('expose', 2, '', 1), ('expose', 2, 'B', 1),
+        ('control', 2, '', 1), ('control', 2, 'B', 1)))
+
+    self.assertEqual(respondents[:2].tolist(), [[2, 1], [1, 1]])
+    self.assertEqual(answers[0].tolist(), [[2, 0, 0, 0], [0, 0, 1, 0]])
+    self.assertEqual(answers[1].tolist(), [[0, 1, 0, 0], [0, 1, 0, 0]])
+    self.assertFalse(answers[2:].any())
+
+  def test_multiple_option_answers_count_towards_each_option(self):
+    # The query splits "AC" into a row for A and one for C.
+    answers, respondents = lift_engine.count_rows(make_rows(
+        ('expose', 1, '', 2), ('expose', 1, 'A', 1), ('expose', 1, 'C', 2)))
+
+    self.assertEqual(respondents[0].tolist(), [2, 0])
+    self.assertEqual(answers[0, 0].tolist(), [1, 0, 2, 0])
+
+  def test_skips_rows_outside_the_report(self):
+    answers, respondents = lift_engine.count_rows(make_rows(
+        ('other', 1, '', 1), ('expose', 1, 'E', 1),
+        ('expose', lift_engine.MAX_QUESTIONS + 1, '', 1), ('expose', 0, '', 1)))
+
+    self.assertFalse(answers.any())
+    self.assertFalse(respondents.any())
+
+
+class TestLift(unittest.TestCase):
+
+  def test_shares_and_lift(self):
+    answers, respondents = lift_engine.empty_counts()
+    answers[0] = [[2, 0, 0, 0], [1, 1, 0, 0]]
+    respondents[0] = [2, 2]
+
+    (matrix,) = lift_engine.lift(answers, respondents)
+
+    np.testing.assert_array_equal(matrix, [[1, 0], [0.5, 0.5], [1, -1]])
+
+  def test_zero_control_and_unanswered_options(self):
+    answers, respondents = lift_engine.empty_counts()
+    answers[0] = [[1, 0, 1, 0], [0, 0, 1, 0]]
+    respondents[0] = [1, 1]
+
+    (matrix,) = lift_engine.lift(answers, respondents)
+
+    self.assertEqual(matrix[2, 0], math.inf)
+    self.assertTrue(math.isnan(matrix[2, 1]))
+    self.assertEqual(matrix[2, 2], 0)
+
+  def test_question_without_a_segment(self):
+    answers, respondents = lift_engine.empty_counts()
+    answers[1, 0, 0] = respondents[1, 0] = 1
+
+    first, second = lift_engine.lift(answers, respondents)
+
+    self.assertEqual(first.shape, (3, 0))
+    self.assertTrue(np.isnan(second[1:]).all())
+
+  def test_no_responses(self):
+    self.assertEqual(lift_engine.lift(*lift_engine.empty_counts()), [])
+
+
+class TestBootstrap(unittest.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    self.answers, self.respondents = lift_engine.empty_counts()
+    self.answers[0] = [[6000, 4000, 0, 0], [5000, 5000, 0, 0]]
+    self.respondents[0] = [10000, 10000]
+
+  def test_interval_covers_lift_and_difference_is_significant(self):
+    significance = lift_engine.bootstrap(
+        self.answers, self.respondents, samples=1000, seed=0)
+
+    low, high, p_value = significance[0, :, 0]
+    self.assertLess(low, 0.2)
+    self.assertGreater(high, 0.2)
+    self.assertLess(p_value, 0.01)
+    # Never chosen options show no difference.
+    self.assertEqual(significance[0, 2, 2], 1)
+
+  def test_no_comparison_without_both_segments(self):
+    self.answers[0, 1] = self.respondents[0, 1] = 0
+
+    significance = lift_engine.bootstrap(
+        self.answers, self.respondents, samples=100, seed=0)
+
+    self.assertTrue(np.isnan(significance[0]).all())
+
+  def test_process_pool_gives_the_same_intervals(self):
+    in_process = lift_engine.bootstrap(
+        self.answers, self.respondents, samples=100, seed=1)
+    pooled = lift_engine.bootstrap(
+        self.answers, self.respondents, samples=100, seed=1, processes=2)
+
+    np.testing.assert_array_equal(in_process, pooled)
+
+  def test_rows_are_appended_to_the_lift(self):
+    significance = lift_engine.bootstrap(
+        self.answers, self.respondents, samples=100, seed=0)
+
+    (matrix,) = lift_engine.lift(self.answers, self.respondents, significance)
+
+    self.assertEqual(matrix.shape, (6, 2))
+
+
+if __name__ == '__main__':
+  unittest.main()
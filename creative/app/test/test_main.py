@@ -0,0 +1,262 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import base64
+import unittest
+from unittest import mock
+
+import numpy
+import pandas
+import main
+import survey_service
+
+
+class FakeSurvey(object):
+
+  def __init__(self, survey_id, **fields):
+    self.id = survey_id
+    self._fields = dict(surveyname=survey_id, question1='Q1', **fields)
+
+  def to_dict(self):
+    return self._fields
+
+  def get(self, field, default=None):
+    return self._fields.get(field, default)
+
+
+def make_counts(rows):
+  return pandas.DataFrame(
+      rows, columns=['ID', 'Segmentation', 'response_count',
+                     'days_since_response'])
+
+
+class TestIndex(unittest.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    main.app.config['BASIC_AUTH_USERNAME'] = 'user'
+    main.app.config['BASIC_AUTH_PASSWORD'] = 'password'
+    self.client = main.app.test_client()
+    self.headers = {
+        'Authorization':
+            'Basic ' + base64.b64encode(b'user:password').decode('ascii')
+    }
+
+  def test_get_survey_stats_groups_by_survey(self):
+    stats = main.get_survey_stats(make_counts([
+        ('s1', 'default_control', 10, 20),
+        ('s2', 'default_expose', 5, 1),
+        ('s1', 'default_expose', 12, 8),
+    ]))
+
+    self.assertEqual(set(stats), {'s1', 's2'})
+    self.assertEqual(
+        [seg['response_count'] for seg in stats['s1']['stats']], [10, 12])
+    self.assertEqual(stats['s1']['last_change'], 8)
+    self.assertEqual(stats['s1']['status'], main.WARNING_TEXT)
+    self.assertEqual(stats['s2']['color'], main.ACTIVE_COLOR)
+
+  def test_survey_without_responses(self):
+    status = main.survey_status([])
+
+    self.assertEqual(status['last_change'], -1)
+    self.assertEqual(status['status'], main.OLD_TEXT)
+
+  @mock.patch.object(survey_service, 'get_all_response_counts')
+  @mock.patch.object(survey_service, 'get_page')
+  def test_index_shows_stats_of_each_survey(self, get_page, counts):
+    get_page.return_value = [FakeSurvey('s1'), FakeSurvey('s2')]
+    counts.return_value = make_counts([('s1', 'default_expose', 42, 1)])
+
+    response = self.client.get('/index', headers=self.headers)
+
+    html = response.get_data(as_text=True)
+    self.assertEqual(response.status_code, 200)
+    self.assertIn('default_expose', html)
+    self.assertIn('42', html)
+    self.assertIn(main.ACTIVE_TEXT, html)
+    self.assertIn(main.OLD_TEXT, html)
+    self.assertNotIn('Next page', html)
+    self.assertFalse(get_page.call_args.kwargs['archived'])
+    counts.assert_called_once_with(['s1', 's2'])
+
+  @mock.patch.object(survey_service, 'get_all_response_counts')
+  @mock.patch.object(survey_service, 'get_page')
+  def test_index_pages_through_filtered_surveys(self, get_page, counts):
+    get_page.return_value = [FakeSurvey('s1'), FakeSurvey('s2'),
+                             FakeSurvey('s3')]
+    counts.return_value = make_counts([])
+
+    response = self.client.get(
+        '/index?page_size=2&start_after=s0&name=Sum&archived=false',
+        headers=self.headers)
+
+    get_page.assert_called_once_with(
+        3, start_after='s0', surveytype=None, archived=False,
+        name_prefix='Sum')
+    html = response.get_data(as_text=True)
+    self.assertNotIn('s3', html)
+    self.assertIn('start_after=s2', html)
+    self.assertIn('First page', html)
+
+
+  @mock.patch.object(survey_service, 'set_archived')
+  def test_archive_and_restore(self, set_archived):
+    self.client.post('/survey/archive/s1', headers=self.headers)
+    self.client.post('/survey/unarchive/s1', headers=self.headers)
+
+    self.assertEqual(set_archived.call_args_list,
+                     [mock.call('s1', True), mock.call('s1', False)])
+
+  @mock.patch.object(survey_service, 'set_archived')
+  def test_archive_does_not_change_state_on_get(self, set_archived):
+    response = self.client.get('/survey/archive/s1', headers=self.headers)
+
+    self.assertEqual(response.status_code, 405)
+    set_archived.assert_not_called()
+
+  @mock.patch.object(survey_service, 'get_brand_lift_results')
+  @mock.patch.object(survey_service, 'get_doc_by_id')
+  def test_reporting_skips_archived_surveys(self, get_doc_by_id, results):
+    get_doc_by_id.return_value = mock.Mock(
+        exists=True, to_dict=lambda: {'archived': True})
+
+    response = self.client.get('/survey/reporting/s1', headers=self.headers)
+
+    self.assertEqual(response.status_code, 302)
+    results.assert_not_called()
+
+  @mock.patch.object(survey_service, 'zip_file')
+  @mock.patch.object(survey_service, 'get_doc_by_id')
+  def test_download_zip_streams_chunks(self, get_doc_by_id, zip_file):
+    get_doc_by_id.return_value = mock.Mock(
+        to_dict=lambda: {'surveyname': 'name'})
+    zip_file.return_value = ('20240501_name.zip', iter([b'PK', b'PK']))
+
+    response = self.client.get('/survey/download_zip/s1', headers=self.headers)
+
+    self.assertTrue(response.is_streamed)
+    self.assertEqual(response.get_data(), b'PKPK')
+    self.assertIn('20240501_name.zip', response.headers['Content-disposition'])
+
+  @mock.patch.object(survey_service, 'zip_file')
+  @mock.patch.object(survey_service, 'get_doc_by_id')
+  def test_download_zip_encodes_non_ascii_names(self, get_doc_by_id, zip_file):
+    get_doc_by_id.return_value = mock.Mock(to_dict=dict)
+    zip_file.return_value = ('20240501_ブランド-調査;"x".zip', iter([b'PK']))
+
+    response = self.client.get('/survey/download_zip/s1', headers=self.headers)
+
+    disposition = response.headers['Content-disposition']
+    disposition.encode('latin-1')
+    self.assertIn('filename="20240501_-;\\"x\\".zip"', disposition)
+    self.assertIn("filename*=UTF-8''20240501_%E3%83%96", disposition)
+    self.assertEqual(main.content_disposition('a b;c.zip'),
+                     'attachment; filename="a b;c.zip"')
+
+  @mock.patch.object(survey_service, 'download_responses')
+  def test_download_responses_streams_chunks(self, download):
+    download.return_value = iter(['Date,Response 1\n', '2024-05-01,A\n'])
+
+    response = self.client.get('/survey/download_responses/s1',
+                               headers=self.headers)
+
+    self.assertTrue(response.is_streamed)
+    self.assertEqual(response.get_data(as_text=True),
+                     'Date,Response 1\n2024-05-01,A\n')
+    self.assertEqual(response.mimetype, 'text/csv')
+
+  @mock.patch.object(survey_service, 'export_responses')
+  def test_download_responses_as_parquet(self, export):
+    export.return_value = iter([b'PAR1', b'PAR1'])
+
+    response = self.client.get(
+        '/survey/download_responses/s1?format=parquet&compression=gzip',
+        headers=self.headers)
+
+    export.assert_called_once_with('s1', 'parquet', 'gzip', with_context=False)
+    self.assertEqual(response.get_data(), b'PAR1PAR1')
+    self.assertIn('surveydata.parquet',
+                  response.headers['Content-disposition'])
+
+  @mock.patch.object(survey_service, 'export_responses')
+  def test_download_responses_rejects_unknown_formats(self, export):
+    for url in ['/survey/download_responses/s1?format=xlsx',
+                '/survey/download_responses_context/s1?format=arrow'
+                '&compression=gzip']:
+      response = self.client.get(url, headers=self.headers)
+      self.assertEqual(response.status_code, 400)
+    export.assert_not_called()
+
+  @mock.patch.object(survey_service, 'export_bulk')
+  def test_download_responses_bulk(self, export):
+    export.return_value = iter([b'PK', b'PK'])
+
+    response = self.client.get(
+        '/survey/download_responses_bulk?survey_id=s1&survey_id=s2'
+        '&survey_id=s1&format=parquet', headers=self.headers)
+
+    export.assert_called_once_with(['s1', 's2'], 'parquet', None)
+    self.assertEqual(response.get_data(), b'PKPK')
+    self.assertEqual(response.mimetype, 'application/zip')
+
+  @mock.patch.object(survey_service, 'export_bulk')
+  def test_download_responses_bulk_rejects_bad_requests(self, export):
+    too_many = '&'.join(
+        f'survey_id=s{i}'
+        for i in range(survey_service.MAX_BULK_EXPORT_SURVEYS + 1))
+    for query in ['', 'survey_id=s1&format=xlsx',
+                  'survey_id=s1&compression=gzip', too_many]:
+      response = self.client.get('/survey/download_responses_bulk?' + query,
+                                 headers=self.headers)
+      self.assertEqual(response.status_code, 400)
+    export.assert_not_called()
+
+  @mock.patch.object(survey_service, 'get_response_latency', return_value=[])
+  @mock.patch.object(survey_service, 'get_brand_lift_results')
+  @mock.patch.object(survey_service, 'get_doc_by_id')
+  def test_reporting_shows_intervals_and_p_values(self, get_doc_by_id, results,
+                                                  latency):
+    get_doc_by_id.return_value = mock.Mock(
+        exists=True, to_dict=lambda: {'question1': 'Question?'})
+    results.return_value = [numpy.array([
+        [0.6, 0.4], [0.5, 0.5], [0.2, -0.2],
+        [0.1, -0.3], [0.3, -0.1], [0.01, float('nan')]])]
+
+    response = self.client.get('/survey/reporting/s1', headers=self.headers)
+
+    html = response.get_data(as_text=True)
+    self.assertIn('Lift 95% interval', html)
+    self.assertIn('10.00% to 30.00%', html)
+    self.assertIn('0.010', html)
+    self.assertIn('-30.00% to -10.00%', html)
+
+  @mock.patch.dict('os.environ', {'LATENCY_VIEW_ID': ''})
+  @mock.patch.object(survey_service, 'get_survey_responses')
+  @mock.patch.object(survey_service, 'get_brand_lift_results', return_value=[])
+  @mock.patch.object(survey_service, 'get_doc_by_id')
+  def test_reporting_without_latency_view(self, get_doc_by_id, results,
+                                          responses):
+    get_doc_by_id.return_value = mock.Mock(
+        exists=True, to_dict=lambda: {'question1': 'Question?'})
+
+    response = self.client.get('/survey/reporting/s1', headers=self.headers)
+
+    self.assertEqual(response.status_code, 200)
+    self.assertNotIn('Response Times', response.get_data(as_text=True))
+    responses.assert_not_called()
+
+
+if __name__ == '__main__':
+  unittest.main()
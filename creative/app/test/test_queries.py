@@ -0,0 +1,133 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import unittest
+from unittest import mock
+
+from google.cloud import bigquery
+import pandas
+import clients
+import queries
+
+
+class TestQueries(unittest.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    self.client = mock.create_autospec(bigquery.Client, instance=True)
+    clients.set_clients(self.client, mock.Mock())
+    self.addCleanup(clients.reset)
+
+  @mock.patch.dict(os.environ, {'TABLE_ID': 'p.responses.responses'})
+  def test_every_query_filters_on_the_survey(self):
+    for name in queries.QUERIES:
+      if name != 'latency':
+        self.assertIn('FROM `p.responses.responses`', queries.get_sql(name))
+      if name == 'bulk_answers':
+        self.assertIn('WHERE ID IN UNNEST(@survey_ids)', queries.get_sql(name))
+      else:
+        self.assertIn('WHERE ID = @survey_id', queries.get_sql(name))
+
+  def test_lift_counts_groups_one_row_per_option(self):
+    sql = queries.get_sql('lift_counts')
+
+    self.assertIn('STRUCT(5 AS Question, Answer5 AS AnswerId)', sql)
+    self.assertIn("SPLIT(a.AnswerId, '')", sql)
+    self.assertIn('GROUP BY 1, 2, 3, 4, 5', sql)
+    self.assertIn('SELECT @horizon AS Horizon', sql)
+
+  @mock.patch.dict(os.environ, {
+      'COUNTERS_TABLE_ID': 'p.responses.response_counts'})
+  def test_lift_counts_settle_no_later_than_the_last_compaction(self):
+    sql = queries.get_sql('lift_counts')
+
+    self.assertIn(
+        'SELECT MAX(CountedThrough) FROM `p.responses.response_counts`', sql)
+    self.assertIn('CreatedAt < Horizon AS Settled', sql)
+
+  def test_execute_binds_the_survey_id(self):
+    queries.execute('SELECT 1', 'survey-1')
+
+    param = self.client.query.call_args.kwargs['job_config'].query_parameters[0]
+    self.assertEqual((param.name, param.value), ('survey_id', 'survey-1'))
+
+  def test_stream_reads_record_batches(self):
+    result = self.client.query.return_value.result.return_value
+
+    batches = queries.stream('SELECT 1', 'survey-1')
+
+    self.assertIs(batches, result.to_arrow_iterable.return_value)
+    self.assertIs(result.to_arrow_iterable.call_args.kwargs['bqstorage_client'],
+                  clients.get_bqstorage_client())
+
+  def test_stream_surveys_binds_the_survey_ids(self):
+    queries.stream_surveys('SELECT 1', ['s1', 's2'])
+
+    param = self.client.query.call_args.kwargs['job_config'].query_parameters[0]
+    self.assertEqual((param.name, param.values), ('survey_ids', ['s1', 's2']))
+
+  def test_freshness_token_is_row_count_and_last_response(self):
+    row = bigquery.Row((12, '2024-05-01T10:00:00'),
+                       {'row_count': 0, 'last_created_at': 1})
+    self.client.query.return_value.result.return_value = [row]
+
+    token = queries.freshness_token('survey-1')
+
+    self.assertEqual(token, ((12, '2024-05-01T10:00:00'),))
+    self.assertIn('count(*)', self.client.query.call_args.args[0])
+
+
+class TestResultCache(unittest.TestCase):
+
+  def test_loads_once_and_returns_copies(self):
+    cache = queries.ResultCache()
+    load = mock.Mock(return_value=pandas.DataFrame({'a': [1]}))
+
+    first = cache.get_or_load('key', load)
+    first['a'] = 2
+    second = cache.get_or_load('key', load)
+
+    load.assert_called_once_with()
+    self.assertEqual(second['a'].tolist(), [1])
+    self.assertEqual(cache.stats(), {'hits': 1, 'misses': 1, 'size': 1})
+
+  def test_reuses_freshness_token_until_it_expires(self):
+    cache = queries.ResultCache(token_ttl=30)
+    load = mock.Mock(side_effect=[((1, 'first'),), ((2, 'second'),)])
+
+    with mock.patch.object(queries.time, 'monotonic', return_value=100):
+      cache.get_token('s1', load)
+      self.assertEqual(cache.get_token('s1', load), ((1, 'first'),))
+    with mock.patch.object(queries.time, 'monotonic', return_value=131):
+      self.assertEqual(cache.get_token('s1', load), ((2, 'second'),))
+    self.assertEqual(load.call_count, 2)
+
+  def test_evicts_least_recently_used(self):
+    cache = queries.ResultCache(max_entries=2)
+    frame = pandas.DataFrame()
+
+    cache.get_or_load('a', lambda: frame)
+    cache.get_or_load('b', lambda: frame)
+    cache.get_or_load('a', lambda: frame)
+    cache.get_or_load('c', lambda: frame)
+    load = mock.Mock(return_value=frame)
+    cache.get_or_load('b', load)
+
+    load.assert_called_once_with()
+    self.assertEqual(len(cache), 2)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,147 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+from unittest import mock
+
+import survey_collection
+
+
+class TestGetPage(unittest.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    patcher = mock.patch.object(survey_collection, 'survey_collection')
+    self.collection = patcher.start()
+    self.addCleanup(patcher.stop)
+
+  def test_filters_projects_and_resumes_after_cursor(self):
+    cursor = self.collection.document.return_value.get.return_value
+    cursor.exists = True
+    query = self.collection.where.return_value.order_by.return_value
+    page = query.select.return_value.start_after.return_value.limit.return_value
+    page.stream.return_value = iter(['s2', 's3'])
+
+    surveys = survey_collection.get_page(
+        2, start_after='s1', surveytype='brand_lift', fields=['surveyname'])
+
+    self.assertEqual(surveys, ['s2', 's3'])
+    field_filter = self.collection.where.call_args.kwargs['filter']
+    self.assertEqual((field_filter.field_path, field_filter.op_string,
+                      field_filter.value), ('surveytype', '==', 'brand_lift'))
+    self.collection.where.return_value.order_by.assert_called_once_with(
+        'surveyname')
+    query.select.assert_called_once_with(['surveyname'])
+    self.collection.document.assert_called_once_with('s1')
+    query.select.return_value.start_after.assert_called_once_with(cursor)
+    (query.select.return_value.start_after.return_value.limit
+     .assert_called_once_with(2))
+
+  def test_first_page_is_unfiltered(self):
+    survey_collection.get_page(10)
+
+    self.collection.where.assert_not_called()
+    self.collection.document.assert_not_called()
+    self.collection.order_by.return_value.limit.assert_called_once_with(10)
+
+  def test_name_prefix_is_a_range_on_surveyname(self):
+    survey_collection.get_page(10, name_prefix='Summer')
+
+    lower = self.collection.where.call_args.kwargs['filter']
+    upper = self.collection.where.return_value.where.call_args.kwargs['filter']
+    self.assertEqual((lower.op_string, lower.value), ('>=', 'Summer'))
+    self.assertEqual((upper.op_string, upper.value), ('<', 'Summer\uf8ff'))
+
+
+
+class TestArchived(unittest.TestCase):
+
+  @mock.patch.object(survey_collection, 'db')
+  @mock.patch.object(survey_collection, 'survey_collection')
+  def test_backfill_stamps_only_surveys_without_the_field(self, collection, db):
+    docs = [
+        mock.Mock(reference='s1', to_dict=lambda: {}),
+        mock.Mock(reference='s2', to_dict=lambda: {'archived': True}),
+        mock.Mock(reference='s3', to_dict=lambda: {}),
+        mock.Mock(reference='s4', to_dict=lambda: {}),
+    ]
+    collection.select.return_value.stream.return_value = iter(docs)
+
+    updated = survey_collection.backfill_archived(batch_size=2)
+
+    self.assertEqual(updated, 3)
+    collection.select.assert_called_once_with(['archived'])
+    batch = db.batch.return_value
+    self.assertEqual(batch.update.call_args_list, [
+        mock.call('s1', {'archived': False}),
+        mock.call('s3', {'archived': False}),
+        mock.call('s4', {'archived': False}),
+    ])
+    self.assertEqual(batch.commit.call_count, 2)
+
+
+
+class TestDocumentCache(unittest.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    patcher = mock.patch.object(survey_collection, 'survey_collection')
+    self.collection = patcher.start()
+    self.addCleanup(patcher.stop)
+    patcher = mock.patch.object(survey_collection, 'lift_counts_collection')
+    patcher.start()
+    self.addCleanup(patcher.stop)
+    self.cache = survey_collection.DocumentCache(max_entries=2, ttl=60)
+    patcher = mock.patch.object(survey_collection, 'document_cache', self.cache)
+    patcher.start()
+    self.addCleanup(patcher.stop)
+
+  def test_reads_each_document_once(self):
+    first = survey_collection.get_doc_by_id('s1')
+    second = survey_collection.get_doc_by_id('s1')
+
+    self.assertIs(first, second)
+    self.collection.document.return_value.get.assert_called_once_with()
+    self.assertEqual(self.cache.stats(), {'hits': 1, 'misses': 1, 'size': 1})
+
+  def test_writes_invalidate_the_document(self):
+    survey_collection.get_doc_by_id('s1')
+    survey_collection.update_by_id('s1', {'archived': True})
+    survey_collection.get_doc_by_id('s1')
+    survey_collection.delete_by_id('s1')
+    survey_collection.get_doc_by_id('s1')
+
+    self.assertEqual(self.collection.document.return_value.get.call_count, 3)
+
+  def test_entries_expire(self):
+    with mock.patch.object(survey_collection.time, 'monotonic') as monotonic:
+      monotonic.return_value = 100
+      self.cache.put('s1', 'doc')
+      self.assertEqual(self.cache.get('s1'), 'doc')
+      monotonic.return_value = 161
+      self.assertIsNone(self.cache.get('s1'))
+    self.assertEqual(len(self.cache), 0)
+
+  def test_evicts_least_recently_used(self):
+    self.cache.put('s1', 'doc1')
+    self.cache.put('s2', 'doc2')
+    self.cache.get('s1')
+    self.cache.put('s3', 'doc3')
+
+    self.assertIsNone(self.cache.get('s2'))
+    self.assertEqual(self.cache.get('s1'), 'doc1')
+
+
+if __name__ == '__main__':
+  unittest.main()
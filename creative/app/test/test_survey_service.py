@@ -12,21 +12,66 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import collections
 import csv
 import datetime
+import io
 import math
 import os
-import tempfile
 import unittest
 from unittest import mock
 import zipfile
 
+import flask
 from google.cloud import bigquery
+from google.cloud.exceptions import NotFound
 from mockfirestore import MockFirestore
+import numpy
 import pandas
+import pyarrow
+import pyarrow.ipc
+import pyarrow.parquet
+import clients
+import queries
 import survey_collection
 import survey_service
 
+LATENCY_VIEW_ID = 'p.responses.response_latency'
+
+
+def make_responses(created_at, segmentation, responses):
+  """Builds the frame returned by the AnswerN queries from "1:A|2:B" strings."""
+  frame = pandas.DataFrame({
+      'CreatedAt': created_at,
+      'Segmentation': segmentation,
+  })
+  for i in range(1, survey_service.MAX_QUESTIONS + 1):
+    frame[f'Answer{i}'] = [
+        dict(part.split(':', 1) for part in response.split('|')
+             if ':' in part).get(str(i)) or None for response in responses
+    ]
+  return frame
+
+
+HORIZON = datetime.datetime(2024, 5, 1, 8, 0, 0)
+
+
+def make_lift_counts(segmentation, responses, settled=None, horizon=HORIZON):
+  """Builds the 'lift_counts' query result for "1:A|2:B" strings."""
+  counts = collections.Counter()
+  for i, (segment, response) in enumerate(zip(segmentation, responses)):
+    for part in response.split('|'):
+      question, _, answer = part.partition(':')
+      if not answer:
+        continue
+      for option in [''] + list(answer):
+        counts[(bool(settled and settled[i]), segment.replace('default_', ''),
+                int(question), option)] += 1
+  return pandas.DataFrame(
+      [(horizon,) + key + (count,) for key, count in counts.items()],
+      columns=['Horizon', 'Settled', 'Segment', 'Question', 'Option',
+               'Responses'])
+
 
 class TestSurveyService(unittest.TestCase):
 
@@ -34,6 +79,21 @@ class TestSurveyService(unittest.TestCase):
     super().setUp()
     self.client = MockFirestore()
     self.collection = self.client.collection('test_surveys')
+    self.bigquery_client = mock.create_autospec(
+        bigquery.Client, instance=True)
+    clients.set_clients(self.bigquery_client, mock.Mock())
+    self.addCleanup(clients.reset)
+    patcher = mock.patch.object(queries, 'freshness_token', return_value=())
+    patcher.start()
+    self.addCleanup(patcher.stop)
+    self.addCleanup(queries.result_cache.clear)
+    patcher = mock.patch.object(survey_collection, 'get_lift_counts',
+                                return_value=mock.Mock(exists=False))
+    self.get_lift_counts = patcher.start()
+    self.addCleanup(patcher.stop)
+    patcher = mock.patch.object(survey_collection, 'save_lift_counts')
+    self.save_lift_counts = patcher.start()
+    self.addCleanup(patcher.stop)
 
   def tearDown(self):
     self.client.reset()
@@ -87,7 +147,36 @@ class TestSurveyService(unittest.TestCase):
     self.assertEqual(form['field2'].data, 'new_value2')
     self.assertEqual(form['field3'].data, 'untouched')
 
+  def test_set_form_data_skips_fields_missing_from_the_form(self):
+    form = {'field1': mock.Mock(data=None)}
+
+    ref = self.collection.document()
+    ref.set({'field1': 'something', 'archived': False})
+
+    survey_service.set_form_data(form, ref.get())
+    self.assertEqual(form['field1'].data, 'something')
+
+  @mock.patch.object(survey_service, 'flash')
+  @mock.patch.object(survey_collection, 'create')
+  def test_create_marks_survey_active(self, create, _):
+    form = mock.Mock(data={'surveyname': 'name'})
+
+    survey_service.create(form)
+
+    create.assert_called_once_with({'surveyname': 'name', 'archived': False})
+
+  def render_creatives(self):
+    """Renders creatives with a placeholder inside an app context."""
+    patcher = mock.patch.object(survey_service, 'render_template',
+                                return_value='<html>placeholder</html>')
+    self.render_template = patcher.start()
+    self.addCleanup(patcher.stop)
+    context = flask.Flask(__name__).app_context()
+    context.push()
+    self.addCleanup(context.pop)
+
   def test_zip_file_returns_user_readable_filename(self):
+    self.render_creatives()
     survey_id = 'some_test_id'
     survey_dict = {
         'surveyname': 'test survey',
@@ -98,6 +187,7 @@ class TestSurveyService(unittest.TestCase):
     self.assertRegex(filename, '.*_test-survey.zip$')
 
   def test_zip_file_returns_nested_zips_with_content(self):
+    self.render_creatives()
     survey_id = 'some_test_id'
     survey_dict = {
         'surveyname': 'test survey',
@@ -105,36 +195,31 @@ class TestSurveyService(unittest.TestCase):
     }
 
     _, data = survey_service.zip_file(survey_id, survey_dict)
-    zf = zipfile.ZipFile(data)
+    chunks = list(data)
+    zf = zipfile.ZipFile(io.BytesIO(b''.join(chunks)))
     names = sorted([nzf.filename for nzf in zf.filelist])
-    self.assertRegex(names[0], '.*_test-survey_default_control.zip$')
-    self.assertRegex(names[1], '.*_test-survey_default_expose.zip$')
+    self.assertRegex(names[0], '^[0-9]{8}_test-survey_default_control.zip$')
+    self.assertRegex(names[1], '^[0-9]{8}_test-survey_default_expose.zip$')
+    # One chunk per nested zip, then the central directory.
+    self.assertEqual(len(chunks), 3)
+    nested = zipfile.ZipFile(io.BytesIO(zf.read(names[0])))
+    self.assertEqual(nested.read('index.html'), b'<html>placeholder</html>')
 
   def test_write_html_template(self):
+    self.render_creatives()
     segments = ['segment1', 'segment2', 'segment3']
-    survey_dict = {'question1': 'q1 text', 'answer1a': 'a1a test'}
-    survey_service.render_template = mock.Mock(
-        return_value='<html>placeholder</html>')
-
-    zips = survey_service.write_html_template('id1', survey_dict, 'test_prefix',
-                                              segments)
-
-    self.assertEqual(len(zips), len(segments))
-    self.assertEqual(zips[0].filename, '/tmp/test_prefix_segment1.zip')
-    self.assertEqual(zips[1].filename, '/tmp/test_prefix_segment2.zip')
-    self.assertEqual(zips[2].filename, '/tmp/test_prefix_segment3.zip')
+    survey_dict = {'question1': 'q1 text', 'answer1a': 'a1a test',
+                   'responsetype': survey_service.RESPONSES_AT_END}
 
-  def test_delete_tmp_zip_files(self):
-    os.remove = mock.Mock()
-    with tempfile.TemporaryDirectory() as tmpdir:
-      zip1 = zipfile.ZipFile(tmpdir + 'mock-file-name.zip', 'w')
-      zip2 = zipfile.ZipFile(tmpdir + 'mock-file-name2.zip', 'w')
+    zips = list(survey_service.write_html_template(
+        'id1', survey_dict, 'test_prefix', segments))
 
-      survey_service.delete_tmp_zip_files([zip1, zip2])
-
-      expected_calls = [mock.call(zip1.filename), mock.call(zip2.filename)]
-      os.remove.assert_has_calls(expected_calls)
-      assert os.remove.call_count == 2
+    self.assertEqual([name for name, _ in zips], [
+        'test_prefix_segment1.zip', 'test_prefix_segment2.zip',
+        'test_prefix_segment3.zip'])
+    self.assertEqual(
+        sorted(call.kwargs['seg'] for call in self.render_template.mock_calls),
+        segments)
 
   def test_get_all_question_text(self):
     survey_dict = {
@@ -235,7 +320,8 @@ class TestSurveyService(unittest.TestCase):
   def test_get_survey_responses_limits_to_given_survey(self):
     mock_bigquery_client = mock.create_autospec(bigquery.Client)
 
-    survey_service.get_survey_responses(12345, client=mock_bigquery_client)
+    survey_service.get_survey_responses(
+        12345, queries.get_sql('answers'), client=mock_bigquery_client)
 
     query_call = mock_bigquery_client.query.mock_calls[0]
     sql = query_call.args[0]
@@ -244,63 +330,262 @@ class TestSurveyService(unittest.TestCase):
     self.assertEqual(survey_param.name, 'survey_id')
     self.assertEqual(survey_param.value, 12345)
 
-  @mock.patch.object(survey_service, 'get_survey_responses')
-  def test_download_responses(self, responses_mock):
+  def stream_responses(self, frame, survey=None):
+    """Serves frame as record batches of two rows, survey as the document."""
+    table = pyarrow.Table.from_pandas(frame, preserve_index=False)
+    patcher = mock.patch.object(
+        queries, 'stream', return_value=iter(table.to_batches(max_chunksize=2)))
+    self.stream = patcher.start()
+    self.addCleanup(patcher.stop)
+    patcher = mock.patch.object(
+        survey_service, 'get_doc_by_id',
+        return_value=mock.Mock(exists=survey is not None,
+                               to_dict=lambda: survey))
+    patcher.start()
+    self.addCleanup(patcher.stop)
+
+  def test_download_responses(self):
     t1 = datetime.datetime.now()
     t2 = t1 + datetime.timedelta(hours=-1)
-    responses_mock.return_value = pandas.DataFrame({
-        'CreatedAt': [t1, t2],
-        'Segmentation': ['seg1', 'seg2'],
-        'Response': ['1:r1a', '1:r2b']
-    })
+    self.stream_responses(make_responses(
+        [t1, t2, t2],
+        ['seg1', 'seg2', 'seg3'],
+        ['1:r1a', '1:r2b', '1:r3c']), survey={'question1': 'Q1?'})
 
-    raw_csv = survey_service.download_responses(1)
-    responses = list(csv.DictReader(raw_csv.splitlines()))
+    chunks = list(survey_service.download_responses(1))
+    responses = list(csv.DictReader(''.join(chunks).splitlines()))
 
+    # A header, then one chunk per record batch.
+    self.assertEqual(len(chunks), 3)
     self.assertEqual(responses[0]['Date'], str(t1))
     self.assertEqual(responses[0]['Control/Expose'], 'seg1')
     self.assertEqual(responses[0]['Response 1'], 'r1a')
     self.assertEqual(responses[1]['Date'], str(t2))
     self.assertEqual(responses[1]['Control/Expose'], 'seg2')
     self.assertEqual(responses[1]['Response 1'], 'r2b')
-
-  @mock.patch.object(survey_service, 'get_survey_responses')
-  def test_download_responses_with_multi_question_responses(
-      self, responses_mock):
-    responses_mock.return_value = pandas.DataFrame({
-        'CreatedAt': [datetime.datetime.now()],
-        'Segmentation': ['seg1'],
-        'Response': ['1:r1a|2:r1b||4:r1e|']
-    })
-
-    raw_csv = survey_service.download_responses(surveyid=1234)
+    self.assertEqual(responses[2]['Response 1'], 'r3c')
+    self.assertEqual(self.stream.call_args.args[1], 1)
+    self.assertIn('Answer1', self.stream.call_args.args[0])
+
+  def test_download_responses_with_multi_question_responses(self):
+    self.stream_responses(make_responses(
+        [datetime.datetime.now()],
+        ['seg1'],
+        ['1:r1a|2:r1b||4:r1e|']),
+        survey={'question1': 'Q1?', 'question2': 'Q2?', 'question3': 'Q3?',
+                'question4': 'Q4?', 'question5': ''})
+
+    raw_csv = ''.join(survey_service.download_responses(surveyid=1234))
     responses = list(csv.DictReader(raw_csv.splitlines()))
 
     self.assertEqual(responses[0]['Response 1'], 'r1a')
     self.assertEqual(responses[0]['Response 2'], 'r1b')
     self.assertEqual(responses[0]['Response 3'], '')
     self.assertEqual(responses[0]['Response 4'], 'r1e')
-    self.assertEqual(responses[0]['Response 5'], '')
+    # The survey has no question 5, so there is no column for it.
+    self.assertNotIn('Response 5', responses[0])
+
+  def test_download_responses_returns_header_with_no_responses(self):
+    self.stream_responses(make_responses([], [], []))
 
+    raw_csv = ''.join(survey_service.download_responses(surveyid=1234))
+
+    # Unknown surveys get a column for every possible question.
+    self.assertEqual(
+        raw_csv.strip(), 'Date,Control/Expose,Dimension 2,' +
+        ','.join(f'Response {i}' for i in range(1, 6)))
+
+  def test_download_responses_with_context_names_columns_after_questions(
+      self):
+    self.stream_responses(make_responses(
+        [datetime.datetime.now()], ['expose'], ['1:A|2:B']),
+        survey={'question1': 'Seen us?', 'question2': 'Like us, really?'})
+
+    raw_csv = ''.join(survey_service.download_responses_with_context(1))
+    responses = list(csv.DictReader(raw_csv.splitlines()))
+
+    self.assertEqual(responses[0]['Seen us?'], 'A')
+    self.assertEqual(responses[0]['Like us, really?'], 'B')
+
+  def test_export_responses_as_parquet(self):
+    t1 = datetime.datetime(2024, 5, 1, 10, 0, 0, 123456)
+    self.stream_responses(make_responses(
+        3 * [t1], ['expose', 'control', 'expose'], ['1:A|2:B', '1:A', '1:C']),
+        survey={'question1': 'Q1?', 'question2': 'Q2?'})
+
+    data = b''.join(survey_service.export_responses(1, 'parquet', 'zstd'))
+    table = pyarrow.parquet.read_table(io.BytesIO(data))
+
+    self.assertEqual(table.column_names, ['CreatedAt', 'Segmentation',
+                                          'Response 1', 'Response 2'])
+    self.assertEqual(table.schema.field('CreatedAt').type,
+                     pyarrow.timestamp('us'))
+    df = table.to_pandas()
+    self.assertEqual(df['CreatedAt'][0], t1)
+    self.assertEqual(df['Segmentation'].dtype, 'category')
+    self.assertEqual(df['Response 1'].tolist(), ['A', 'A', 'C'])
+    self.assertEqual(table.column('Response 2').to_pylist(), ['B', None, None])
+    metadata = pyarrow.parquet.ParquetFile(io.BytesIO(data)).metadata
+    self.assertEqual(metadata.row_group(0).column(0).compression, 'ZSTD')
+
+  def test_export_responses_as_arrow_stream(self):
+    self.stream_responses(make_responses(
+        3 * [datetime.datetime.now()], ['expose', 'control', 'expose'],
+        ['1:A', '1:B', '1:A']), survey={'question1': 'Seen us?'})
+
+    chunks = list(survey_service.export_responses(
+        1, 'arrow', with_context=True))
+    table = pyarrow.ipc.open_stream(b''.join(chunks)).read_all()
+
+    # One chunk per record batch, then the end of the stream.
+    self.assertEqual(len(chunks), 3)
+    self.assertEqual(table.column_names,
+                     ['CreatedAt', 'Segmentation', 'Seen us?'])
+    self.assertEqual(table.column('Seen us?').to_pylist(), ['A', 'B', 'A'])
+    self.assertTrue(
+        pyarrow.types.is_dictionary(table.schema.field('Segmentation').type))
+
+  def stream_surveys(self, frames, surveys):
+    """Serves the frames, by survey id, as one stream of two row batches."""
+    table = pyarrow.Table.from_pandas(
+        pandas.concat([frame.assign(ID=survey_id)
+                       for survey_id, frame in frames.items()]),
+        preserve_index=False)
+    patcher = mock.patch.object(
+        queries, 'stream_surveys',
+        return_value=iter(table.to_batches(max_chunksize=2)))
+    self.stream = patcher.start()
+    self.addCleanup(patcher.stop)
+    patcher = mock.patch.object(
+        survey_service, 'get_doc_by_id',
+        side_effect=lambda survey_id: mock.Mock(
+            exists=True, to_dict=lambda: surveys[survey_id]))
+    patcher.start()
+    self.addCleanup(patcher.stop)
+
+  def test_export_bulk_writes_one_csv_per_survey(self):
+    now = datetime.datetime.now()
+    self.stream_surveys({
+        's1': make_responses(3 * [now], ['expose', 'control', 'expose'],
+                             ['1:A', '1:B', '1:C']),
+        's2': make_responses([now], ['default_control'], ['1:D|2:A']),
+    }, {'s1': {'question1': 'Q1?'},
+        's2': {'question1': 'Q1?', 'question2': 'Q2?'},
+        's3': {'question1': 'Q1?'}})
+
+    chunks = list(survey_service.export_bulk(['s1', 's2', 's3']))
+    archive = zipfile.ZipFile(io.BytesIO(b''.join(chunks)))
+
+    self.assertEqual(self.stream.call_args.args[1], ['s1', 's2', 's3'])
+    self.assertNotIn(b'', chunks)
+    self.assertEqual(archive.namelist(), ['s1.csv', 's2.csv', 's3.csv'])
+    s1 = list(csv.DictReader(archive.read('s1.csv').decode().splitlines()))
+    self.assertEqual([row['Response 1'] for row in s1], ['A', 'B', 'C'])
+    s2 = list(csv.DictReader(archive.read('s2.csv').decode().splitlines()))
+    self.assertEqual((s2[0]['Control/Expose'], s2[0]['Response 2']),
+                     ('default_control', 'A'))
+    self.assertEqual(archive.read('s3.csv').decode().splitlines(),
+                     ['Date,Control/Expose,Dimension 2,Response 1'])
+
+  def test_export_bulk_as_parquet(self):
+    now = datetime.datetime.now()
+    self.stream_surveys({
+        's1': make_responses([now], ['expose'], ['1:A']),
+        's2': make_responses(2 * [now], ['control', 'expose'], ['1:B', '1:C']),
+    }, {'s1': {'question1': 'Q1?'}, 's2': {'question1': 'Q1?'}})
+
+    data = b''.join(survey_service.export_bulk(['s1', 's2'], 'parquet'))
+    archive = zipfile.ZipFile(io.BytesIO(data))
+
+    self.assertEqual(archive.getinfo('s2.parquet').compress_type,
+                     zipfile.ZIP_STORED)
+    table = pyarrow.parquet.read_table(io.BytesIO(archive.read('s2.parquet')))
+    self.assertEqual(table.column('Response 1').to_pylist(), ['B', 'C'])
+
+  def test_get_all_response_counts_reads_counters_table(self):
+    with mock.patch.dict(os.environ, {
+        'TABLE_ID': 'p.responses.responses',
+        'COUNTERS_TABLE_ID': 'p.responses.response_counts'
+    }):
+      survey_service.get_all_response_counts()
+
+    sql = self.bigquery_client.query.call_args.args[0]
+    self.assertIn('FROM `p.responses.response_counts`', sql)
+    self.assertIn('CreatedAt >= watermark', sql)
+
+  def test_get_all_response_counts_for_given_surveys(self):
+    survey_service.get_all_response_counts(['s1', 's2'])
+
+    query = self.bigquery_client.query
+    self.assertIn('ID IN UNNEST(@survey_ids)', query.call_args.args[0])
+    param = query.call_args.kwargs['job_config'].query_parameters[0]
+    self.assertEqual((param.name, param.values), ('survey_ids', ['s1', 's2']))
+
+  def test_get_all_response_counts_without_counters_table(self):
+    with mock.patch.dict(os.environ, {'TABLE_ID': 'p.responses.responses'}):
+      os.environ.pop('COUNTERS_TABLE_ID', None)
+      survey_service.get_all_response_counts()
+
+    sql = self.bigquery_client.query.call_args.args[0]
+    self.assertNotIn('response_counts', sql)
+    self.assertIn('count(*) as response_count', sql)
+
+  @mock.patch.dict(os.environ, {'LATENCY_VIEW_ID': LATENCY_VIEW_ID})
   @mock.patch.object(survey_service, 'get_survey_responses')
-  def test_download_responses_returns_empty_csv_with_no_responses(
+  def test_query_results_are_reused_until_responses_change(
       self, responses_mock):
+    responses_mock.return_value = pandas.DataFrame(
+        {'Segmentation': ['expose'], 'responses': [1]})
+
+    with mock.patch.object(queries, 'freshness_token') as token:
+      token.return_value = ((1, 'first'),)
+      survey_service.get_response_latency(1)
+      survey_service.get_response_latency(1)
+      token.return_value = ((2, 'second'),)
+      survey_service.get_response_latency(1)
+      # The token is only checked again once it has expired.
+      self.assertEqual((token.call_count, responses_mock.call_count), (1, 1))
+      with mock.patch.object(queries.time, 'monotonic',
+                             return_value=queries.time.monotonic() + 60):
+        survey_service.get_response_latency(1)
+
+    self.assertEqual((token.call_count, responses_mock.call_count), (2, 2))
+
+  @mock.patch.dict(os.environ, {'LATENCY_VIEW_ID': LATENCY_VIEW_ID})
+  @mock.patch.object(survey_service, 'get_survey_responses')
+  def test_get_response_latency(self, responses_mock):
     responses_mock.return_value = pandas.DataFrame({
-        'CreatedAt': [],
-        'Segmentation': [],
-        'Response': []
+        'Segmentation': ['default_control', 'default_expose'],
+        'responses': [10, 12],
+        'first_answer_p50_ms': pandas.array([1500, None], dtype='Int64'),
     })
 
-    raw_csv = survey_service.download_responses(surveyid=1234)
-    self.assertEqual(raw_csv.strip(), 'Date,Control/Expose,Dimension 2')
+    latency = survey_service.get_response_latency(1)
+
+    sql = responses_mock.call_args.args[1]
+    self.assertRegex(sql, 'WHERE ID = @survey_id')
+    self.assertEqual(latency[0], {
+        'Segmentation': 'control',
+        'responses': 10,
+        'first_answer_p50_ms': 1500
+    })
+    self.assertIsNone(latency[1]['first_answer_p50_ms'])
+
+  @mock.patch.dict(os.environ, {'LATENCY_VIEW_ID': LATENCY_VIEW_ID})
+  @mock.patch.object(survey_service, 'get_survey_responses')
+  def test_get_response_latency_without_the_view(self, responses_mock):
+    responses_mock.side_effect = NotFound('response_latency')
+
+    self.assertEqual(survey_service.get_response_latency(1), [])
+    with mock.patch.dict(os.environ, {'LATENCY_VIEW_ID': ''}):
+      self.assertEqual(survey_service.get_response_latency(2), [])
+    self.assertEqual(responses_mock.call_count, 1)
 
   @mock.patch.object(survey_service, 'get_survey_responses')
   def test_get_brand_lift_results(self, responses_mock):
-    responses_mock.return_value = pandas.DataFrame({
-        'CreatedAt': 4 * [datetime.datetime.now()],
-        'Segmentation': ['expose', 'expose', 'control', 'control'],
-        'Response': ['1:A', '1:A', '1:A', '1:B']
-    })
+    responses_mock.return_value = make_lift_counts(
+        ['expose', 'expose', 'control', 'control'],
+        ['1:A', '1:A', '1:A', '1:B'])
 
     results = survey_service.get_brand_lift_results(1)
     q1_expose_lift = results[0][0]
@@ -322,14 +607,28 @@ class TestSurveyService(unittest.TestCase):
     # Answer B is 100% less likely in expose group
     self.assertEqual(-1, q1_lift[1])
 
+  @mock.patch.object(survey_service, 'get_survey_responses')
+  def test_brand_lift_is_reused_until_responses_change(self, responses_mock):
+    responses_mock.return_value = make_lift_counts(
+        ['expose', 'control'], ['1:A', '1:B'])
+
+    with mock.patch.object(queries, 'freshness_token') as token:
+      token.return_value = ((2, 'first'),)
+      survey_service.get_brand_lift_results(1)
+      survey_service.get_brand_lift_results(1)
+      self.assertEqual(responses_mock.call_count, 1)
+      queries.result_cache.clear()
+      token.return_value = ((3, 'second'),)
+      survey_service.get_brand_lift_results(1)
+
+    self.assertEqual(responses_mock.call_count, 2)
+
   @mock.patch.object(survey_service, 'get_survey_responses')
   def test_get_brand_lift_results_with_multi_question_responses(
       self, responses_mock):
-    responses_mock.return_value = pandas.DataFrame({
-        'CreatedAt': 4 * [datetime.datetime.now()],
-        'Segmentation': ['expose', 'expose', 'control', 'control'],
-        'Response': ['1:A|2:A', '1:A|2:B', '1:A|2:B', '1:B|2:B']
-    })
+    responses_mock.return_value = make_lift_counts(
+        ['expose', 'expose', 'control', 'control'],
+        ['1:A|2:A', '1:A|2:B', '1:A|2:B', '1:B|2:B'])
 
     results = survey_service.get_brand_lift_results(1)
     q2_expose_lift = results[1][0]
@@ -353,23 +652,128 @@ class TestSurveyService(unittest.TestCase):
 
   @mock.patch.object(survey_service, 'get_survey_responses')
   def test_get_brand_lift_results_with_no_responses(self, responses_mock):
-    responses_mock.return_value = pandas.DataFrame({
-        'CreatedAt': [],
-        'Segmentation': [],
-        'Response': []
-    })
+    responses_mock.return_value = make_lift_counts(
+        [],
+        [])
 
     results = survey_service.get_brand_lift_results(1)
 
     self.assertEqual(results, [])
 
+  @mock.patch.object(survey_service, 'get_survey_responses')
+  def test_get_brand_lift_results_counts_each_chosen_option(
+      self, responses_mock):
+    responses_mock.return_value = make_lift_counts(
+        ['expose', 'control'],
+        ['1:AC', '1:C'])
+
+    results = survey_service.get_brand_lift_results(1)
+
+    # Shares are of respondents, so they add up to more than 1 for "AC".
+    self.assertEqual(list(results[0][0]), [1, 0, 1])
+    self.assertEqual(list(results[0][1]), [0, 0, 1])
+
+  @mock.patch.object(survey_service, 'get_survey_responses')
+  def test_get_brand_lift_results_folds_settled_responses(
+      self, responses_mock):
+    responses_mock.return_value = make_lift_counts(
+        ['expose', 'control'], ['1:A', '1:B'], settled=[True, False])
+
+    results = survey_service.get_brand_lift_results(1)
+
+    # Both responses are reported, but only the settled one is stored.
+    self.assertEqual(list(results[0][0]), [1, 0])
+    self.assertEqual(list(results[0][1]), [0, 1])
+    survey_id, data, previous = self.save_lift_counts.call_args.args
+    self.assertEqual((survey_id, previous),
+                     (1, self.get_lift_counts.return_value))
+    self.assertEqual(sum(data['answer_counts']), 1)
+    self.assertEqual(sum(data['respondent_counts']), 1)
+    params = responses_mock.call_args.kwargs['params']
+    self.assertEqual([param.name for param in params], ['since', 'horizon'])
+    self.assertLess(
+        params[1].value, datetime.datetime.utcnow() - datetime.timedelta(
+            minutes=survey_service.LIFT_UNTRACKED_SETTLE_MINUTES - 1))
+    # The watermark is the horizon the query settled the responses at.
+    self.assertEqual(data['watermark'], HORIZON)
+
+  @mock.patch.object(survey_service, 'get_survey_responses')
+  def test_get_brand_lift_results_waits_for_compaction(self, responses_mock):
+    # A respondent's partial and complete responses are both past the settle
+    # window, but compaction has not run past them yet, so the query put the
+    # horizon before them.
+    responses_mock.return_value = make_lift_counts(
+        ['expose', 'expose'], ['1:A', '1:A|2:B'], settled=[False, False])
+
+    with mock.patch.dict(os.environ, {'COUNTERS_TABLE_ID': 'p.r.counts'}):
+      results = survey_service.get_brand_lift_results(1)
+
+    horizon = responses_mock.call_args.kwargs['params'][1].value
+    self.assertGreater(horizon, datetime.datetime.utcnow() - datetime.timedelta(
+        minutes=survey_service.LIFT_SETTLE_MINUTES + 1))
+    data = self.save_lift_counts.call_args.args[1]
+    # Nothing is stored, so the partial is never counted for good ...
+    self.assertEqual(sum(data['respondent_counts']), 0)
+    self.assertEqual(data['watermark'], HORIZON)
+    # ... though this report counts both until compaction removes it.
+    self.assertEqual(list(results[0][0]), [1])
+
+  @mock.patch.object(survey_service, 'get_survey_responses')
+  def test_get_brand_lift_results_recounts_stale_counts(self, responses_mock):
+    self.get_lift_counts.return_value = mock.Mock(exists=True)
+    self.get_lift_counts.return_value.to_dict.return_value = {
+        'answer_counts': [1] * (survey_service.MAX_QUESTIONS * 2 * 4),
+        'respondent_counts': [1] * (survey_service.MAX_QUESTIONS * 2),
+        'watermark': HORIZON.replace(tzinfo=datetime.timezone.utc),
+        'recounted_at': datetime.datetime.now(datetime.timezone.utc) -
+                        datetime.timedelta(
+                            hours=survey_service.LIFT_RECOUNT_HOURS + 1),
+    }
+    responses_mock.return_value = make_lift_counts(
+        ['expose', 'control'], ['1:A', '1:B'], settled=[True, True])
+
+    survey_service.get_brand_lift_results(1)
+
+    since = responses_mock.call_args.kwargs['params'][0]
+    self.assertEqual(since.value, datetime.datetime(1970, 1, 1))
+    data = self.save_lift_counts.call_args.args[1]
+    self.assertEqual(sum(data['respondent_counts']), 2)
+    self.assertGreater(data['recounted_at'], datetime.datetime.utcnow() -
+                       datetime.timedelta(minutes=1))
+
+  @mock.patch.object(survey_service, 'get_survey_responses')
+  def test_get_brand_lift_results_reads_from_watermark(self, responses_mock):
+    watermark = datetime.datetime.utcnow() - datetime.timedelta(hours=1)
+    answers = numpy.zeros((survey_service.MAX_QUESTIONS, 2, 4), dtype=int)
+    respondents = numpy.zeros((survey_service.MAX_QUESTIONS, 2), dtype=int)
+    answers[0, 1, 1] = respondents[0, 1] = 3
+    self.get_lift_counts.return_value = mock.Mock(exists=True)
+    self.get_lift_counts.return_value.to_dict.return_value = {
+        'answer_counts': answers.ravel().tolist(),
+        'respondent_counts': respondents.ravel().tolist(),
+        'watermark': watermark.replace(tzinfo=datetime.timezone.utc),
+        'recounted_at': datetime.datetime.now(datetime.timezone.utc),
+    }
+    responses_mock.return_value = make_lift_counts(
+        ['expose'], ['1:A'], horizon=watermark)
+
+    results = survey_service.get_brand_lift_results(1)
+
+    since, horizon = responses_mock.call_args.kwargs['params']
+    self.assertEqual((since.name, since.value), ('since', watermark))
+    # The watermark never moves back.
+    self.assertEqual(horizon.value, watermark)
+    self.assertIn('CreatedAt >= @since', responses_mock.call_args.args[1])
+    self.assertEqual(list(results[0][0]), [1, 0])
+    self.assertEqual(list(results[0][1]), [0, 1])
+    data = self.save_lift_counts.call_args.args[1]
+    self.assertEqual(data['answer_counts'], answers.ravel().tolist())
+
   @mock.patch.object(survey_service, 'get_survey_responses')
   def test_get_brand_lift_results_corrects_segment_names(self, responses_mock):
-    responses_mock.return_value = pandas.DataFrame({
-        'CreatedAt': 3 * [datetime.datetime.now()],
-        'Segmentation': ['default_expose', 'default_expose', 'default_control'],
-        'Response': ['1:A', '1:A', '1:B']
-    })
+    responses_mock.return_value = make_lift_counts(
+        ['default_expose', 'default_expose', 'default_control'],
+        ['1:A', '1:A', '1:B'])
 
     results = survey_service.get_brand_lift_results(1)
     q1_expose_lift = results[0][0]
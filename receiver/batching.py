@@ -0,0 +1,222 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""In-process row buffer used by the receiver's batching mode.
+
+Rows are collected in memory and handed to a flush function in groups. A
+group is flushed when it reaches a row count, an estimated payload size or an
+age limit. When the flush function fails (for example because BigQuery is
+slow and the insert times out) the rows are written to a bounded spill file
+on local disk and replayed after the next successful flush.
+"""
+
+import atexit
+import json
+import logging
+import os
+import signal
+import threading
+import time
+
+
+class RowBuffer(object):
+  """Thread-safe buffer that flushes rows to `flush_fn` in batches.
+
+  `flush_fn` takes a list of JSON-serialisable rows and returns a list of
+  per-row errors in the format used by `Client.insert_rows_json`. Raising an
+  exception means the whole batch failed and it is spilled to disk.
+
+  If `key_fn` is given, a row whose key matches a row that is still buffered
+  replaces it instead of being appended. `key_fn` returns None for rows that
+  should never be replaced.
+  """
+
+  def __init__(self,
+               flush_fn,
+               max_rows=500,
+               max_bytes=1000000,
+               max_age=5.0,
+               max_pending_rows=10000,
+               spill_path='/tmp/receiver_spill.jsonl',
+               spill_max_bytes=50000000,
+               key_fn=None):
+    self._flush_fn = flush_fn
+    self._key_fn = key_fn
+    self.max_rows = max_rows
+    self.max_bytes = max_bytes
+    self.max_age = max_age
+    self.max_pending_rows = max_pending_rows
+    self.spill_path = spill_path
+    self.spill_max_bytes = spill_max_bytes
+
+    # Reentrant, as the SIGTERM handler may interrupt add() or flush() on
+    # the main thread while it holds them, and then flushes itself.
+    self._lock = threading.RLock()
+    self._spill_lock = threading.RLock()
+    self._rows = []
+    self._positions = {}
+    self._bytes = 0
+    self._oldest = None
+    self._closed = False
+    self._stop = threading.Event()
+    self._ticker = None
+
+    self.flushed_rows = 0
+    self.replaced_rows = 0
+    self.spilled_rows = 0
+    self.dropped_rows = 0
+
+  def __len__(self):
+    with self._lock:
+      return len(self._rows)
+
+  def add(self, row):
+    """Buffers a row, flushing the current batch if a limit is reached."""
+    size = len(json.dumps(row, default=str))
+    key = self._key_fn(row) if self._key_fn else None
+    overflow = None
+    batch = None
+    with self._lock:
+      position = self._positions.get(key) if key is not None else None
+      if position is not None:
+        replaced = self._rows[position]
+        self._rows[position] = row
+        self._bytes += size - len(json.dumps(replaced, default=str))
+        self.replaced_rows += 1
+      elif len(self._rows) >= self.max_pending_rows:
+        # A flush is stuck behind a slow backend; keep memory bounded.
+        overflow = [row]
+      else:
+        if not self._rows:
+          self._oldest = time.monotonic()
+        if key is not None:
+          self._positions[key] = len(self._rows)
+        self._rows.append(row)
+        self._bytes += size
+        if self._is_due():
+          batch = self._take()
+    if overflow:
+      self._spill(overflow)
+    if batch and self._flush(batch):
+      self._drain_spill()
+
+  def flush(self):
+    """Flushes everything currently buffered, then replays spilled rows."""
+    with self._lock:
+      batch = self._take()
+    if not batch or self._flush(batch):
+      self._drain_spill()
+
+  def close(self):
+    """Stops the age ticker and flushes remaining rows."""
+    if self._closed:
+      return
+    self._closed = True
+    self._stop.set()
+    self.flush()
+
+  def start(self):
+    """Starts a daemon thread that flushes batches older than `max_age`."""
+    if self._ticker is None and self.max_age:
+      self._ticker = threading.Thread(
+          target=self._tick, name='receiver-flush', daemon=True)
+      self._ticker.start()
+
+  def install_shutdown_hooks(self):
+    """Flushes the buffer on interpreter exit and on SIGTERM."""
+    atexit.register(self.close)
+    try:
+      previous = signal.getsignal(signal.SIGTERM)
+
+      def _on_sigterm(signum, frame):
+        self.close()
+        if callable(previous):
+          previous(signum, frame)
+        elif previous == signal.SIG_DFL:
+          raise SystemExit(128 + signum)
+
+      signal.signal(signal.SIGTERM, _on_sigterm)
+    except ValueError:
+      # Signal handlers can only be installed from the main thread; atexit
+      # still covers a normal shutdown.
+      logging.warning('Not on the main thread, buffered rows are not flushed '
+                      'on SIGTERM.')
+
+  def _is_due(self):
+    return (len(self._rows) >= self.max_rows or
+            self._bytes >= self.max_bytes or
+            (self.max_age is not None and self._oldest is not None and
+             time.monotonic() - self._oldest >= self.max_age))
+
+  def _take(self):
+    batch = self._rows
+    self._rows = []
+    self._positions = {}
+    self._bytes = 0
+    self._oldest = None
+    return batch
+
+  def _tick(self):
+    while not self._stop.wait(self.max_age):
+      with self._lock:
+        batch = self._take() if self._rows and self._is_due() else None
+      if batch and self._flush(batch):
+        self._drain_spill()
+
+  def _flush(self, batch):
+    try:
+      errors = self._flush_fn(batch)
+    except Exception:  # pylint: disable=broad-except
+      logging.exception('Flush of %d rows failed, spilling to disk.',
+                        len(batch))
+      self._spill(batch)
+      return False
+    if errors:
+      logging.error('Rows rejected on insert: %s', errors)
+    self.flushed_rows += len(batch)
+    return True
+
+  def _spill(self, rows):
+    """Appends rows to the spill file, dropping them if it is full."""
+    with self._spill_lock:
+      try:
+        size = os.path.getsize(self.spill_path)
+      except OSError:
+        size = 0
+      lines = ''.join(json.dumps(row, default=str) + '\n' for row in rows)
+      if size + len(lines) > self.spill_max_bytes:
+        self.dropped_rows += len(rows)
+        logging.error('Spill file %s is full, dropped %d rows.',
+                      self.spill_path, len(rows))
+        return
+      with open(self.spill_path, 'a') as spill:
+        spill.write(lines)
+      self.spilled_rows += len(rows)
+
+  def _drain_spill(self):
+    """Replays spilled rows in batches of `max_rows`."""
+    replay_path = '%s.%d.replay' % (self.spill_path, threading.get_ident())
+    with self._spill_lock:
+      if not os.path.exists(self.spill_path):
+        return
+      os.replace(self.spill_path, replay_path)
+    with open(replay_path) as replay:
+      rows = [json.loads(line) for line in replay if line.strip()]
+    os.remove(replay_path)
+    for start in range(0, len(rows), self.max_rows):
+      if not self._flush(rows[start:start + self.max_rows]):
+        # Still failing; whatever is left was re-spilled by _flush or
+        # goes back on disk here.
+        self._spill(rows[start + self.max_rows:])
+        return
@@ -0,0 +1,189 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measures how much traffic one receiver instance can sustain.
+
+Synthetic creative traffic is sent through a Flask app that serves the
+receiver the way the Functions Framework does, from several threads at once,
+against the fake BigQuery client. Run from the receiver directory:
+
+  PYTHONPATH=. python benchmark/bench_load.py --requests 5000 --threads 16
+  PYTHONPATH=. python benchmark/bench_load.py --batch-mode
+
+The traffic mixes single GET pixels, respondents that submit after every
+question and sendBeacon POSTs of several responses. Throughput, per-request
+latency, rows that reached the fake table and peak traced memory are
+reported. Memory tracing slows Python down, so compare runs with the same
+--no-trace-memory setting. With --min-throughput the script exits non-zero
+when the instance falls below the given requests per second.
+"""
+
+import argparse
+import concurrent.futures
+import json
+import os
+import random
+import resource
+import statistics
+import sys
+import threading
+import time
+import tracemalloc
+from unittest import mock
+
+import flask
+from google.cloud import bigquery
+
+from benchmark import fake_bigquery
+import main
+
+TABLE_ID = 'bench-project.responses.responses'
+SURVEYS = 20
+QUESTIONS = 3
+ANSWERS = 'ABCD'
+
+
+def make_app():
+  """Serves the receiver on / like the Functions Framework does."""
+  app = flask.Flask(__name__)
+  app.add_url_rule(
+      '/', 'receiver', lambda: main.receiver(flask.request),
+      methods=['GET', 'POST'])
+  return app
+
+
+def make_response(rng, i, answered=QUESTIONS):
+  """Returns the parameters a creative sends for one respondent."""
+  response = '|'.join(
+      '%d:%s' % (question, rng.choice(ANSWERS) if question <= answered else '')
+      for question in range(1, QUESTIONS + 1))
+  return {
+      'type': 'survey',
+      'id': 'survey-%d' % rng.randrange(SURVEYS),
+      'seg': rng.choice(['default_expose', 'default_control']),
+      'response': response,
+      'visual': response,
+      'creative_size': rng.choice(['300x250', '320x50', '728x90']),
+      'bomid': 'bom-%d' % i,
+      'times': '%d|%d' % (rng.randint(500, 5000), rng.randint(3000, 30000)),
+  }
+
+
+def make_traffic(count, seed=0):
+  """Returns `count` (method, query string, body) requests.
+
+  About 70% are single GET pixels, 20% are growing partial submissions and
+  10% are sendBeacon POSTs of one to three responses.
+  """
+  rng = random.Random(seed)
+  traffic = []
+  i = 0
+  while len(traffic) < count:
+    i += 1
+    kind = rng.random()
+    if kind < 0.7:
+      traffic.append(('GET', make_response(rng, i), None))
+    elif kind < 0.9:
+      params = make_response(rng, i)
+      for answered in range(1, QUESTIONS + 1):
+        partial = dict(params, response=make_response(rng, i, answered)[
+            'response'])
+        traffic.append(('GET', partial, None))
+    else:
+      body = [make_response(rng, i * 10 + n) for n in range(rng.randint(1, 3))]
+      traffic.append(('POST', None, json.dumps(body)))
+  return traffic[:count]
+
+
+def run(app, traffic, threads):
+  """Sends `traffic` from `threads` threads; returns (seconds, timings)."""
+  local = threading.local()
+
+  def send(request):
+    if not hasattr(local, 'client'):
+      local.client = app.test_client()
+    method, query_string, body = request
+    start = time.perf_counter()
+    response = local.client.open(
+        '/', method=method, query_string=query_string, data=body,
+        content_type='text/plain;charset=UTF-8')
+    elapsed = time.perf_counter() - start
+    if response.status_code >= 400:
+      raise RuntimeError('%s returned %s' % (method, response.status))
+    return elapsed
+
+  start = time.perf_counter()
+  with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+    timings = list(executor.map(send, traffic))
+  return time.perf_counter() - start, timings
+
+
+def run_benchmark():
+  parser = argparse.ArgumentParser(
+      description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+  parser.add_argument('--requests', type=int, default=2000)
+  parser.add_argument('--threads', type=int, default=8)
+  parser.add_argument('--batch-mode', action='store_true')
+  parser.add_argument('--insert-latency-ms', type=float, default=20)
+  parser.add_argument('--insert-jitter-ms', type=float, default=30)
+  parser.add_argument('--no-trace-memory', action='store_true')
+  parser.add_argument('--min-throughput', type=float, default=0,
+                      help='fail below this many requests per second')
+  parser.add_argument('--seed', type=int, default=0)
+  args = parser.parse_args()
+
+  os.environ['TABLE_ID'] = TABLE_ID
+  backend = fake_bigquery.FakeBackend(
+      insert_latency=args.insert_latency_ms / 1000,
+      insert_jitter=args.insert_jitter_ms / 1000)
+  traffic = make_traffic(args.requests, args.seed)
+  app = make_app()
+
+  if not args.no_trace_memory:
+    tracemalloc.start()
+  with mock.patch.object(bigquery, 'Client', backend.client), \
+      mock.patch.object(main, 'BATCH_MODE', args.batch_mode), \
+      mock.patch.object(main, 'SINK', 'bigquery'):
+    main._client = None  # pylint: disable=protected-access
+    main._sink = None  # pylint: disable=protected-access
+    main._buffer = None  # pylint: disable=protected-access
+    seconds, timings = run(app, traffic, args.threads)
+    if args.batch_mode:
+      main.get_buffer().close()
+  if not args.no_trace_memory:
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+  throughput = len(timings) / seconds
+  quantiles = statistics.quantiles(timings, n=100)
+  print('requests    %d from %d threads in %.2f s (batch mode %s)' %
+        (len(timings), args.threads, seconds, args.batch_mode))
+  print('throughput  %.1f requests/s, %.1f rows/s stored' %
+        (throughput, len(backend.rows(TABLE_ID)) / seconds))
+  print('latency     p50 %.2f ms  p99 %.2f ms  max %.2f ms' %
+        (1000 * quantiles[49], 1000 * quantiles[98], 1000 * max(timings)))
+  if not args.no_trace_memory:
+    print('memory      peak traced %.1f MiB' % (peak / 2**20))
+  # ru_maxrss is in KiB on Linux.
+  print('            max RSS %.1f MiB' %
+        (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+  print('calls       %s' % dict(backend.calls))
+
+  if throughput < args.min_throughput:
+    print('throughput below %.1f requests/s' % args.min_throughput)
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+  run_benchmark()
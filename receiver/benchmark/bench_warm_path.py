@@ -0,0 +1,129 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compares per-request overhead of the old and the warm receiver paths.
+
+The old path built a client and looked the table up before every insert. Run
+from the receiver directory:
+
+  PYTHONPATH=. python benchmark/bench_warm_path.py --requests 200
+"""
+
+import argparse
+import datetime
+import hashlib
+import os
+import statistics
+import time
+from unittest import mock
+
+from flask import Request
+from google.cloud import bigquery
+from google.cloud.exceptions import NotFound
+from werkzeug.test import EnvironBuilder
+
+from benchmark import fake_bigquery
+import main
+
+TABLE_ID = 'bench-project.responses.responses'
+
+
+def legacy_receiver(request):
+  """The receiver as it was before the warm path, kept for comparison."""
+  params = {}
+  params.update(request.args or {})
+  client = bigquery.Client()
+  table_id = os.environ.get('TABLE_ID')
+
+  try:
+    client.get_table(table_id)
+  except NotFound:
+    table = bigquery.Table(table_id, schema=main.SCHEMA)
+    client.create_table(table)
+
+  row_to_insert = {
+      'CreatedAt': datetime.datetime.now().isoformat(),
+      'Type': params.get('type'),
+      'ID': params.get('id'),
+      'Segmentation': params.get('seg'),
+      'Response': params.get('response'),
+      'Visual': params.get('visual'),
+      'CreativeSize': params.get('creative_size'),
+      'RandomTimeStamp': hashlib.sha256(
+          f'{request.remote_addr}'.encode('utf-8')).hexdigest(),
+      'BomID': params.get('bomid'),
+  }
+  errors = client.insert_rows_json(table_id, [row_to_insert])
+  return ({'errors': errors}, 200, {})
+
+
+def make_request(i):
+  builder = EnvironBuilder(
+      path='/',
+      query_string={
+          'type': 'survey',
+          'id': 'survey-%d' % (i % 20),
+          'seg': 'default_expose' if i % 2 else 'default_control',
+          'response': '1:A|2:B|3:C',
+          'visual': '1:A|2:B|3:C',
+          'creative_size': '300x250',
+          'bomid': 'bom-%d' % i,
+      },
+      environ_base={'REMOTE_ADDR': '10.0.0.%d' % (i % 255)})
+  return Request(builder.get_environ())
+
+
+def run(handler, backend, requests):
+  timings = []
+  with mock.patch.object(bigquery, 'Client', backend.client):
+    for request in requests:
+      start = time.perf_counter()
+      handler(request)
+      timings.append(time.perf_counter() - start)
+  return timings
+
+
+def report(name, timings, backend):
+  print('%-8s mean %7.2f ms  p50 %7.2f ms  p99 %7.2f ms  calls %s' %
+        (name, 1000 * statistics.mean(timings),
+         1000 * statistics.median(timings),
+         1000 * statistics.quantiles(timings, n=100)[98], dict(backend.calls)))
+
+
+def run_benchmark():
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument('--requests', type=int, default=200)
+  parser.add_argument('--construct-latency-ms', type=float, default=5)
+  parser.add_argument('--metadata-latency-ms', type=float, default=40)
+  parser.add_argument('--insert-latency-ms', type=float, default=20)
+  args = parser.parse_args()
+
+  os.environ['TABLE_ID'] = TABLE_ID
+  requests = [make_request(i) for i in range(args.requests)]
+  latencies = dict(
+      construct_latency=args.construct_latency_ms / 1000,
+      metadata_latency=args.metadata_latency_ms / 1000,
+      insert_latency=args.insert_latency_ms / 1000)
+
+  backend = fake_bigquery.FakeBackend(**latencies)
+  report('before', run(legacy_receiver, backend, requests), backend)
+
+  backend = fake_bigquery.FakeBackend(**latencies)
+  main._client = None  # pylint: disable=protected-access
+  main._sink = None  # pylint: disable=protected-access
+  report('after', run(main.receiver, backend, requests), backend)
+
+
+if __name__ == '__main__':
+  run_benchmark()
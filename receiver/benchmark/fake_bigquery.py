@@ -0,0 +1,93 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Local stand-in for `bigquery.Client` used by the receiver benchmarks.
+
+Every API call sleeps for a configurable latency so the benchmarks can show
+how many round trips a request pays for, without talking to Google Cloud.
+"""
+
+import collections
+import random
+import threading
+import time
+
+from google.cloud.exceptions import NotFound
+
+
+class FakeBackend(object):
+  """In-memory tables shared by all clients created from one factory."""
+
+  def __init__(self,
+               construct_latency=0.0,
+               metadata_latency=0.0,
+               insert_latency=0.0,
+               insert_jitter=0.0):
+    self.construct_latency = construct_latency
+    self.metadata_latency = metadata_latency
+    self.insert_latency = insert_latency
+    # Up to this much extra latency is added to each insert at random, to
+    # mimic the long tail of streaming inserts.
+    self.insert_jitter = insert_jitter
+    self.tables = {}
+    self.calls = collections.Counter()
+    self._lock = threading.Lock()
+
+  def client(self, *args, **kwargs):
+    """Drop-in replacement for the `bigquery.Client` constructor."""
+    del args, kwargs  # Unused.
+    self.count('Client')
+    time.sleep(self.construct_latency)
+    return FakeClient(self)
+
+  def count(self, call):
+    with self._lock:
+      self.calls[call] += 1
+
+  def rows(self, table):
+    return self.tables.get(str(table), [])
+
+
+class FakeClient(object):
+  """Implements the subset of `bigquery.Client` used by the receiver."""
+
+  def __init__(self, backend):
+    self._backend = backend
+
+  def get_table(self, table):
+    self._backend.count('get_table')
+    time.sleep(self._backend.metadata_latency)
+    if str(table) not in self._backend.tables:
+      raise NotFound(f'Table {table} not found')
+    return table
+
+  def create_table(self, table, exists_ok=False):
+    self._backend.count('create_table')
+    time.sleep(self._backend.metadata_latency)
+    table_id = '{}.{}.{}'.format(table.project, table.dataset_id,
+                                 table.table_id)
+    with self._backend._lock:  # pylint: disable=protected-access
+      self._backend.tables.setdefault(table_id, [])
+    return table
+
+  def insert_rows_json(self, table, json_rows, timeout=None, **kwargs):
+    del timeout, kwargs  # Unused.
+    self._backend.count('insert_rows_json')
+    time.sleep(self._backend.insert_latency +
+               random.uniform(0, self._backend.insert_jitter))
+    with self._backend._lock:  # pylint: disable=protected-access
+      if str(table) not in self._backend.tables:
+        raise NotFound(f'Table {table} not found')
+      self._backend.tables[str(table)].extend(json_rows)
+    return []
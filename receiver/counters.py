@@ -0,0 +1,94 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Maintains the per-survey response counts shown on the dashboard.
+
+The counters table holds one row per survey and segmentation with the number
+of responses and the time of the latest one. Each refresh merges in the
+responses created since the previous refresh (the watermark, stored as
+`CountedThrough`) up to the settle horizon, so only a few hours of partitions
+are scanned. Readers add the responses newer than the watermark themselves.
+
+Refreshes run right after compaction, so the rows they count are final.
+"""
+
+import json
+import os
+
+from google.cloud import bigquery
+
+import dedup
+
+# Counted rows must be older than the compaction horizon; the extra minutes
+# cover the time between the compaction query and the refresh.
+SETTLE_MINUTES = dedup.SETTLE_MINUTES + 5
+
+SCHEMA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           "counters_schema.json")
+with open(SCHEMA_PATH) as schema_file:
+  SCHEMA = [bigquery.SchemaField.from_api_repr(field)
+            for field in json.load(schema_file)]
+CLUSTERING_FIELDS = ["ID", "Segmentation"]
+
+REFRESH_QUERY = """
+    DECLARE watermark DATETIME DEFAULT (
+        SELECT MAX(CountedThrough) FROM `{counters_table_id}`);
+    DECLARE horizon DATETIME DEFAULT
+        DATETIME_SUB(CURRENT_DATETIME(), INTERVAL @settle_minutes MINUTE);
+
+    MERGE `{counters_table_id}` AS c
+    USING (
+        SELECT
+            ID,
+            Segmentation,
+            COUNT(*) AS ResponseCount,
+            MAX(CreatedAt) AS LastSeen
+        FROM `{table_id}`
+        WHERE ID IS NOT NULL
+        AND CreatedAt < horizon
+        AND (watermark IS NULL OR CreatedAt >= watermark)
+        GROUP BY 1, 2) AS n
+    ON c.ID = n.ID AND c.Segmentation = n.Segmentation
+    WHEN MATCHED THEN UPDATE SET
+        ResponseCount = c.ResponseCount + n.ResponseCount,
+        LastSeen = GREATEST(c.LastSeen, n.LastSeen),
+        CountedThrough = horizon
+    WHEN NOT MATCHED THEN
+        INSERT (ID, Segmentation, ResponseCount, LastSeen, CountedThrough)
+        VALUES (n.ID, n.Segmentation, n.ResponseCount, n.LastSeen, horizon)
+"""
+
+
+def create_table(client, counters_table_id):
+  table = bigquery.Table(counters_table_id, schema=SCHEMA)
+  table.clustering_fields = CLUSTERING_FIELDS
+  client.create_table(table, exists_ok=True)
+
+
+def refresh(client, table_id, counters_table_id,
+            settle_minutes=SETTLE_MINUTES):
+  """Adds newly settled responses to the counters; returns rows merged."""
+  create_table(client, counters_table_id)
+  job_config = bigquery.QueryJobConfig(query_parameters=[
+      bigquery.ScalarQueryParameter("settle_minutes", "INT64", settle_minutes),
+  ])
+  job = client.query(
+      REFRESH_QUERY.format(
+          table_id=table_id, counters_table_id=counters_table_id),
+      job_config=job_config)
+  job.result()
+  # The script's own job has no DML statistics; the MERGE runs as a child.
+  return sum(child.num_dml_affected_rows or 0
+             for child in client.list_jobs(parent_job=job)
+             if child.statement_type == "MERGE")
@@ -0,0 +1,120 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Collapses partial submissions into one row per respondent.
+
+With "Submit Responses after each Question" the creative re-sends the growing
+response string after every answer, all under the same BomID. Each submission
+contains every answer given so far, so only the longest one per survey and
+respondent is worth keeping.
+
+`ResponseTracker` drops submissions an instance has already seen a more
+complete version of. Partials that still reach the table, for example because
+they were handled by different instances, are deleted by the compaction query.
+"""
+
+import collections
+import threading
+
+from google.cloud import bigquery
+
+# Rows older than this are no longer in BigQuery's streaming buffer and can be
+# deleted with DML. It also leaves time for buffered and spilled rows to land.
+SETTLE_MINUTES = 120
+
+# Deletes every row for which a more complete (longer response) or, for equal
+# lengths, a later row exists for the same survey and respondent. Only
+# partitions inside the lookback window are scanned.
+COMPACTION_QUERY = """
+    DELETE FROM `{table_id}` AS t
+    WHERE t.CreatedAt >= DATETIME_SUB(CURRENT_DATETIME(), INTERVAL @lookback_days DAY)
+    AND t.CreatedAt < DATETIME_SUB(CURRENT_DATETIME(), INTERVAL @settle_minutes MINUTE)
+    AND t.BomID != ''
+    AND EXISTS (
+        SELECT 1
+        FROM `{table_id}` AS n
+        WHERE n.CreatedAt >= DATETIME_SUB(CURRENT_DATETIME(), INTERVAL @lookback_days DAY)
+        AND n.ID = t.ID
+        AND n.BomID = t.BomID
+        AND (LENGTH(n.Response) > LENGTH(t.Response)
+             OR (LENGTH(n.Response) = LENGTH(t.Response)
+                 AND n.CreatedAt > t.CreatedAt)))
+"""
+
+
+def dedup_key(row):
+  """Returns the (survey, respondent) key of a row, or None without a BomID."""
+  if not row.get("BomID"):
+    return None
+  return (row.get("ID"), row["BomID"])
+
+
+class ResponseTracker(object):
+  """Bounded LRU of the most complete submission seen per respondent."""
+
+  def __init__(self, max_entries=100000):
+    self.max_entries = max_entries
+    self._seen = collections.OrderedDict()
+    self._lock = threading.Lock()
+    self.dropped_rows = 0
+
+  def __len__(self):
+    return len(self._seen)
+
+  def accept(self, row):
+    """Records `row` and returns False if it is not newer than what we saw.
+
+    A submission is stale when it is no longer than one already seen for the
+    same survey and respondent, for example a repeat of the same partial.
+    """
+    key = dedup_key(row)
+    if key is None:
+      return True
+    size = len(row.get("Response") or "")
+    with self._lock:
+      seen = self._seen.get(key)
+      if seen is not None:
+        self._seen.move_to_end(key)
+        if size <= seen:
+          self.dropped_rows += 1
+          return False
+      self._seen[key] = size
+      if len(self._seen) > self.max_entries:
+        self._seen.popitem(last=False)
+    return True
+
+  def forget(self, row):
+    """Undoes `accept` for a row that could not be written.
+
+    The respondent's key is only dropped while it still records this row, so
+    a longer submission accepted in the meantime is kept.
+    """
+    key = dedup_key(row)
+    if key is None:
+      return
+    with self._lock:
+      if self._seen.get(key) == len(row.get("Response") or ""):
+        del self._seen[key]
+
+
+def compact(client, table_id, lookback_days=2, settle_minutes=SETTLE_MINUTES):
+  """Deletes superseded partial rows and returns how many were removed."""
+  job_config = bigquery.QueryJobConfig(query_parameters=[
+      bigquery.ScalarQueryParameter("lookback_days", "INT64", lookback_days),
+      bigquery.ScalarQueryParameter("settle_minutes", "INT64", settle_minutes),
+  ])
+  job = client.query(
+      COMPACTION_QUERY.format(table_id=table_id), job_config=job_config)
+  job.result()
+  return job.num_dml_affected_rows or 0
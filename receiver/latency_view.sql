@@ -0,0 +1,21 @@
+-- Creative latency percentiles per survey and segmentation.
+--
+-- FirstAnswerMs is the time from the creative rendering to the first answer,
+-- CompletionMs the time from the first answer to the last one. Comparing them
+-- across segmentations shows whether slow creatives are costing completions.
+-- The deploy script fills in {{PROJECT_ID}} and creates the view.
+CREATE OR REPLACE VIEW `{{PROJECT_ID}}.responses.response_latency` AS
+SELECT
+  ID,
+  Segmentation,
+  COUNT(*) AS responses,
+  COUNT(CompletionMs) AS completed_responses,
+  APPROX_QUANTILES(FirstAnswerMs, 100)[SAFE_OFFSET(50)] AS first_answer_p50_ms,
+  APPROX_QUANTILES(FirstAnswerMs, 100)[SAFE_OFFSET(90)] AS first_answer_p90_ms,
+  APPROX_QUANTILES(FirstAnswerMs, 100)[SAFE_OFFSET(99)] AS first_answer_p99_ms,
+  APPROX_QUANTILES(CompletionMs, 100)[SAFE_OFFSET(50)] AS completion_p50_ms,
+  APPROX_QUANTILES(CompletionMs, 100)[SAFE_OFFSET(90)] AS completion_p90_ms,
+  APPROX_QUANTILES(CompletionMs, 100)[SAFE_OFFSET(99)] AS completion_p99_ms
+FROM `{{PROJECT_ID}}.responses.responses`
+WHERE ID IS NOT NULL
+GROUP BY ID, Segmentation
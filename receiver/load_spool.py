@@ -0,0 +1,60 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Loads a receiver spool file into BigQuery with a batch load job.
+
+Usage:
+
+  python load_spool.py /path/to/spool.jsonl PROJECT_ID.responses.responses
+
+The spool is first moved aside so the receiver keeps appending to a fresh
+file, then loaded with a single load job. Load jobs are free, unlike
+streaming inserts. The moved file is deleted once the job succeeds.
+"""
+
+import argparse
+import logging
+import os
+
+from google.cloud import bigquery
+
+import main
+import sinks
+
+
+def load_spool(client, path, table_id):
+  """Loads the spool at `path` into `table_id`; returns the finished job."""
+  loading_path = sinks.rotate_spool(path)
+  job_config = bigquery.LoadJobConfig(
+      source_format=bigquery.SourceFormat.NEWLINE_DELIMITED_JSON,
+      write_disposition=bigquery.WriteDisposition.WRITE_APPEND,
+      ignore_unknown_values=True,
+      schema=main.SCHEMA)
+  with open(loading_path, 'rb') as spool:
+    job = client.load_table_from_file(spool, table_id, job_config=job_config)
+  job.result()
+  logging.info('Loaded %s rows from %s into %s.', job.output_rows, path,
+               table_id)
+  os.remove(loading_path)
+  return job
+
+
+if __name__ == '__main__':
+  logging.basicConfig(level=logging.INFO)
+  parser = argparse.ArgumentParser(
+      description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+  parser.add_argument('spool', help='spool file written by the receiver')
+  parser.add_argument('table_id', help='e.g. my-project.responses.responses')
+  args = parser.parse_args()
+  load_spool(bigquery.Client(), args.spool, args.table_id)
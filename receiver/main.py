@@ -29,43 +29,216 @@ import logging
 import datetime
 import os
 import hashlib
+import json
+import threading
 
 from google.cloud import bigquery
-from google.cloud.exceptions import NotFound
 
+import batching
+import counters
+import dedup
+import sinks
+
+# Where rows are written: "bigquery" streams them into TABLE_ID, "spool"
+# appends them to a JSONL file for load_spool.py and "sqlite" writes them to a
+# local database.
+SINK = os.environ.get("SINK", "bigquery")
+SPOOL_PATH = os.environ.get("SPOOL_PATH", "/tmp/receiver_spool.jsonl")
+SQLITE_PATH = os.environ.get("SQLITE_PATH", "/tmp/receiver.sqlite3")
+
+# Batching mode buffers rows in the instance and streams them to BigQuery in
+# groups instead of issuing one insert per request.
+BATCH_MODE = os.environ.get("BATCH_MODE", "").lower() in ("1", "true", "yes")
+BATCH_MAX_ROWS = int(os.environ.get("BATCH_MAX_ROWS", 500))
+BATCH_MAX_BYTES = int(os.environ.get("BATCH_MAX_BYTES", 1000000))
+BATCH_MAX_AGE_SECONDS = float(os.environ.get("BATCH_MAX_AGE_SECONDS", 5))
+BATCH_MAX_PENDING_ROWS = int(os.environ.get("BATCH_MAX_PENDING_ROWS", 10000))
+BATCH_INSERT_TIMEOUT_SECONDS = float(
+    os.environ.get("BATCH_INSERT_TIMEOUT_SECONDS", 10))
+SPILL_PATH = os.environ.get("SPILL_PATH", "/tmp/receiver_spill.jsonl")
+SPILL_MAX_BYTES = int(os.environ.get("SPILL_MAX_BYTES", 50000000))
+DEDUP_MAX_ENTRIES = int(os.environ.get("DEDUP_MAX_ENTRIES", 100000))
+COMPACTION_LOOKBACK_DAYS = int(os.environ.get("COMPACTION_LOOKBACK_DAYS", 2))
+# Per-survey response counts refreshed after every compaction, if set.
+COUNTERS_TABLE_ID = os.environ.get("COUNTERS_TABLE_ID")
+
+# Schema and layout used when the receiver has to create the responses table.
+# schema.json is shared with the deploy script and migrate_table.py.
+SCHEMA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           "schema.json")
+with open(SCHEMA_PATH) as schema_file:
+  SCHEMA = [bigquery.SchemaField.from_api_repr(field)
+            for field in json.load(schema_file)]
+PARTITION_FIELD = "CreatedAt"
+CLUSTERING_FIELDS = ["ID", "Segmentation"]
+CREATE_RETRY_DELAYS_SECONDS = (1, 2, 4)
+
+# Upper bound on the responses accepted in one POST body.
+MAX_BATCH_RESPONSES = 50
+
+# Latencies above a day come from broken clocks rather than slow respondents.
+MAX_LATENCY_MS = 24 * 60 * 60 * 1000
+
+# The client and table reference are created once per instance and reused by
+# every warm request.
+_client = None
+_table_ref = None
+_client_lock = threading.Lock()
+_sink = None
+_sink_lock = threading.Lock()
+_buffer = None
+_buffer_lock = threading.Lock()
+_tracker = dedup.ResponseTracker(max_entries=DEDUP_MAX_ENTRIES)
+
+
+def get_client():
+  """Returns the instance-wide BigQuery client and table reference."""
+  global _client, _table_ref
+
+  if _client is None:
+    with _client_lock:
+      if _client is None:
+        _table_ref = bigquery.TableReference.from_string(
+            os.environ.get("TABLE_ID"))
+        _client = bigquery.Client()
+  return _client, _table_ref
+
+
+def new_table(table_ref):
+  """Returns the responses table, partitioned by day and clustered by survey.
+
+  Reports always filter on a single survey id, so clustering on ID lets
+  BigQuery read only that survey's blocks instead of the whole table.
+  """
+  table = bigquery.Table(table_ref, schema=SCHEMA)
+  table.time_partitioning = bigquery.TimePartitioning(
+      type_=bigquery.TimePartitioningType.DAY, field=PARTITION_FIELD)
+  table.clustering_fields = CLUSTERING_FIELDS
+  return table
 
-def receiver(request):
-  params = {}
-  # params.update(request.get_json(force=True, silent=False) or {})
-  params.update(request.args or {})
-  client = bigquery.Client()
-  table_id = os.environ.get("TABLE_ID")
 
+def create_table(client, table_ref):
+  logging.info("Table %s is not found- creating.", table_ref)
+  client.create_table(new_table(table_ref), exists_ok=True)
+
+
+def new_sink(name):
+  """Creates the sink named by the SINK environment variable."""
+  if name == "bigquery":
+    client, table_ref = get_client()
+    return sinks.BigQuerySink(client, table_ref, create_table,
+                              CREATE_RETRY_DELAYS_SECONDS)
+  if name == "spool":
+    return sinks.SpoolSink(SPOOL_PATH)
+  if name == "sqlite":
+    return sinks.SQLiteSink(SQLITE_PATH, SCHEMA)
+  raise ValueError("Unknown SINK {!r}".format(name))
+
+
+def get_sink():
+  """Returns the instance-wide sink, creating it on first use."""
+  global _sink
+
+  if _sink is None:
+    with _sink_lock:
+      if _sink is None:
+        _sink = new_sink(SINK)
+  return _sink
+
+
+def insert_rows(rows, timeout=None):
+  """Writes rows to the configured sink, BigQuery by default."""
+  return get_sink().write(rows, timeout=timeout)
+
+
+def insert_batch(rows):
+  """Streams a batch of buffered rows into BigQuery."""
+  return insert_rows(rows, timeout=BATCH_INSERT_TIMEOUT_SECONDS)
+
+
+def write_accepted(rows):
+  """Inserts rows the tracker accepted, forgetting those that failed.
+
+  A respondent whose row was not written must be able to retry, so the
+  tracker only keeps the rows that made it into the sink.
+  """
   try:
-    client.get_table(table_id)  # Make an API request.
-    print("Table {} already exists.".format(table_id))
-  except NotFound:
-    print("Table {} is not found- creating.".format(table_id))
-    # Create the table.
-    schema = [
-        bigquery.SchemaField("CreatedAt", "DATETIME", mode="REQUIRED"),
-        bigquery.SchemaField("Type", "String", mode="REQUIRED"),
-        bigquery.SchemaField("ID", "String", mode="REQUIRED"),
-        bigquery.SchemaField("Segmentation", "String", mode="REQUIRED"),
-        bigquery.SchemaField("Response", "String", mode="REQUIRED"),
-        bigquery.SchemaField("Visual", "String", mode="REQUIRED"),
-        bigquery.SchemaField("CreativeSize", "String", mode="REQUIRED"),
-        bigquery.SchemaField("RandomTimeStamp", "String", mode="REQUIRED"),
-        bigquery.SchemaField("BomID", "String", mode="REQUIRED"),
-    ]
-    table = bigquery.Table(table_id, schema=schema)
-    table = client.create_table(table)
-    print("Created table {}.{}.{}".format(table.project, table.dataset_id,
-                                          table.table_id))
+    errors = insert_rows(rows)
+  except Exception:
+    for row in rows:
+      _tracker.forget(row)
+    raise
+  failed = {error.get("index") for error in errors or []}
+  for index, row in enumerate(rows):
+    if index in failed or None in failed:
+      _tracker.forget(row)
+  return errors
 
-  # Writing parameters into bigquery table.
 
-  row_to_insert = {
+def get_buffer():
+  """Returns the instance-wide row buffer, creating it on first use."""
+  global _buffer
+
+  with _buffer_lock:
+    if _buffer is None:
+      _buffer = batching.RowBuffer(
+          insert_batch,
+          max_rows=BATCH_MAX_ROWS,
+          max_bytes=BATCH_MAX_BYTES,
+          max_age=BATCH_MAX_AGE_SECONDS,
+          max_pending_rows=BATCH_MAX_PENDING_ROWS,
+          spill_path=SPILL_PATH,
+          spill_max_bytes=SPILL_MAX_BYTES,
+          key_fn=dedup.dedup_key)
+      _buffer.install_shutdown_hooks()
+      _buffer.start()
+    return _buffer
+
+
+if BATCH_MODE:
+  # The SIGTERM flush can only be installed from the main thread, which runs
+  # this import after the server has set up its own handlers; the first
+  # request would run on a worker thread.
+  get_buffer()
+
+
+def parse_answers(response):
+  """Parses a "1:A|2:B|3:" response string into Answers records.
+
+  Skipped questions (an empty answer) and malformed parts are left out, so
+  readers get one record per answered question.
+  """
+  answers = []
+  for part in (response or "").split("|"):
+    question_id, separator, answer_id = part.partition(":")
+    if separator and answer_id and question_id.isdigit():
+      answers.append({"QuestionId": int(question_id), "AnswerId": answer_id})
+  return answers
+
+
+def parse_times(times):
+  """Parses the creative's "first_answer_ms|completion_ms" measurement.
+
+  Returns a (first answer, completion) pair. Timers that never started reach
+  us as negative numbers or NaN; those, and implausibly large values, become
+  None.
+  """
+  values = []
+  for part in (times or "").split("|")[:2]:
+    try:
+      value = int(float(part))
+    except (ValueError, OverflowError):
+      value = None
+    if value is not None and not 0 <= value <= MAX_LATENCY_MS:
+      value = None
+    values.append(value)
+  values += [None] * (2 - len(values))
+  return tuple(values)
+
+
+def build_row(request, params):
+  first_answer_ms, completion_ms = parse_times(params.get("times"))
+  return {
       "CreatedAt": datetime.datetime.now().isoformat(),
       "Type": params.get("type"),
       "ID": params.get("id"),
@@ -75,7 +248,81 @@ def receiver(request):
       "CreativeSize": params.get("creative_size"),
       "RandomTimeStamp": hashlib.sha256(f"{request.remote_addr}".encode('utf-8')).hexdigest(),
       "BomID": params.get("bomid"),
+      "Answers": parse_answers(params.get("response")),
+      "FirstAnswerMs": first_answer_ms,
+      "CompletionMs": completion_ms,
   }
 
-  errors = client.insert_rows_json(table_id, [row_to_insert])
+
+def parse_batch(request):
+  """Returns the list of response parameters in a POST body.
+
+  The creative sends a JSON array with navigator.sendBeacon, which uses a
+  text/plain content type, so the body is parsed regardless of its type.
+  Returns None if the body is not a list of objects.
+  """
+  body = request.get_json(force=True, silent=True)
+  if not isinstance(body, list) or len(body) > MAX_BATCH_RESPONSES:
+    return None
+  if not all(isinstance(params, dict) for params in body):
+    return None
+  return body
+
+
+def receive_batch(request):
+  """Writes every response in a POST body with a single insert."""
+  batch = parse_batch(request)
+  if batch is None:
+    return ("", 400, {})
+
+  rows = [build_row(request, params) for params in batch]
+  rows = [row for row in rows if _tracker.accept(row)]
+  if BATCH_MODE:
+    buffer = get_buffer()
+    for row in rows:
+      buffer.add(row)
+  elif rows:
+    errors = write_accepted(rows)
+    if errors:
+      logging.error("Rows rejected on insert: %s", errors)
+  return ("", 204, {})
+
+
+def receiver(request):
+  if request.method == "POST":
+    return receive_batch(request)
+
+  params = {}
+  params.update(request.args or {})
+
+  # Writing parameters into bigquery table.
+  row_to_insert = build_row(request, params)
+
+  if not _tracker.accept(row_to_insert):
+    # A more complete submission from this respondent was already written.
+    return ({"errors": []}, 200, {})
+
+  if BATCH_MODE:
+    get_buffer().add(row_to_insert)
+    return ({"errors": []}, 200, {})
+
+  errors = write_accepted([row_to_insert])
   return ({"errors": errors}, 200, {})
+
+
+def compact(request):
+  """Entry point for the scheduled job that deletes superseded partials.
+
+  Once the partials are gone the per-survey counters are brought up to date.
+  """
+  del request  # Unused.
+  client, table_ref = get_client()
+  deleted = dedup.compact(
+      client, str(table_ref), lookback_days=COMPACTION_LOOKBACK_DAYS)
+  logging.info("Compaction deleted %d superseded rows.", deleted)
+  result = {"deleted": deleted}
+  if COUNTERS_TABLE_ID:
+    result["counted"] = counters.refresh(
+        client, str(table_ref), COUNTERS_TABLE_ID)
+    logging.info("Merged %d counter rows.", result["counted"])
+  return (result, 200, {})
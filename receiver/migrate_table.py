@@ -0,0 +1,131 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Brings an existing responses table up to the layout the receiver creates.
+
+Usage:
+
+  python migrate_table.py PROJECT_ID.responses.responses
+
+* Columns in schema.json that the table lacks are added.
+* A table that is partitioned but not clustered gets clustered in place.
+* A table that is not partitioned is rebuilt: a new table is created from
+  schema.json, partitioned on CreatedAt and clustered on ID, Segmentation,
+  the rows are copied into it and it is renamed into place. The original
+  table is kept, renamed to <table>_unpartitioned_YYYYMMDD.
+  BigQuery cannot copy rows that are still in the streaming buffer, so stop
+  the receiver (or wait ~90 minutes after the last response) before running
+  the rebuild; it refuses to run while the buffer is not empty.
+"""
+
+import argparse
+import datetime
+import logging
+
+from google.cloud import bigquery
+from google.cloud.exceptions import NotFound
+
+import main
+
+COPY_ROWS_QUERY = """
+    INSERT INTO `{new_table_id}` ({columns})
+    SELECT {columns} FROM `{table_id}`
+"""
+RENAME_QUERY = "ALTER TABLE `{table_id}` RENAME TO `{new_name}`"
+
+
+def _addable(field):
+  # Columns added to a table that already has rows cannot be REQUIRED.
+  if field.mode != 'REQUIRED':
+    return field
+  return bigquery.SchemaField(
+      field.name, field.field_type, mode='NULLABLE', fields=field.fields)
+
+
+def add_missing_columns(client, table):
+  existing = {field.name for field in table.schema}
+  missing = [field for field in main.SCHEMA if field.name not in existing]
+  if not missing:
+    return table
+  logging.info('Adding columns %s to %s.', [field.name for field in missing],
+               table.reference)
+  table.schema = list(table.schema) + [_addable(field) for field in missing]
+  return client.update_table(table, ['schema'])
+
+
+def _rename(client, table_id, new_name):
+  client.query(
+      RENAME_QUERY.format(table_id=table_id, new_name=new_name)).result()
+
+
+def repartition(client, table):
+  """Rebuilds the table partitioned and clustered, keeping the original."""
+  if table.streaming_buffer is not None:
+    raise RuntimeError(
+        '{} has rows in its streaming buffer; stop the receiver and wait '
+        'about 90 minutes before rebuilding it.'.format(table.reference))
+  dataset = '{}.{}'.format(table.project, table.dataset_id)
+  table_id = '{}.{}'.format(dataset, table.table_id)
+  suffix = datetime.date.today().strftime('%Y%m%d')
+  new_name = '{}_partitioned_{}'.format(table.table_id, suffix)
+  backup_name = '{}_unpartitioned_{}'.format(table.table_id, suffix)
+
+  logging.info('Copying %s into %s.%s partitioned on %s.', table_id, dataset,
+               new_name, main.PARTITION_FIELD)
+  client.create_table(main.new_table(
+      bigquery.TableReference.from_string('{}.{}'.format(dataset, new_name))))
+  client.query(COPY_ROWS_QUERY.format(
+      new_table_id='{}.{}'.format(dataset, new_name), table_id=table_id,
+      columns=', '.join(field.name for field in main.SCHEMA))).result()
+
+  logging.info('Swapping in %s.%s; the original becomes %s.%s.', dataset,
+               new_name, dataset, backup_name)
+  _rename(client, table_id, backup_name)
+  try:
+    _rename(client, '{}.{}'.format(dataset, new_name), table.table_id)
+  except Exception:
+    logging.exception('Could not rename %s.%s to %s, restoring the original.',
+                      dataset, new_name, table_id)
+    _rename(client, '{}.{}'.format(dataset, backup_name), table.table_id)
+    raise
+  return client.get_table(table.reference)
+
+
+def migrate(client, table_id):
+  """Creates, extends or re-lays-out the responses table as needed."""
+  try:
+    table = client.get_table(table_id)
+  except NotFound:
+    logging.info('Table %s is not found- creating.', table_id)
+    return client.create_table(
+        main.new_table(bigquery.TableReference.from_string(table_id)))
+
+  table = add_missing_columns(client, table)
+  if table.time_partitioning is None:
+    table = repartition(client, table)
+  elif table.clustering_fields != main.CLUSTERING_FIELDS:
+    logging.info('Clustering %s on %s.', table.reference,
+                 main.CLUSTERING_FIELDS)
+    table.clustering_fields = main.CLUSTERING_FIELDS
+    table = client.update_table(table, ['clustering_fields'])
+  return table
+
+
+if __name__ == '__main__':
+  logging.basicConfig(level=logging.INFO)
+  parser = argparse.ArgumentParser(
+      description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+  parser.add_argument('table_id', help='e.g. my-project.responses.responses')
+  args = parser.parse_args()
+  migrate(bigquery.Client(), args.table_id)
@@ -0,0 +1,146 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Destinations the receiver can write response rows to.
+
+* `BigQuerySink` streams rows into the responses table.
+* `SpoolSink` appends rows to a newline-delimited JSON file. A spool can be
+  loaded into BigQuery with a batch load job (see load_spool.py), which is
+  far cheaper than streaming inserts at high volumes.
+* `SQLiteSink` writes rows to a local SQLite database, which is handy for
+  load-testing the receiver offline.
+
+Every sink implements `write(rows, timeout=None)`, which returns a list of
+per-row errors in the format used by `Client.insert_rows_json`, and `close()`.
+"""
+
+import abc
+import functools
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from google.cloud.exceptions import NotFound
+
+
+class Sink(abc.ABC):
+  """Base class for row destinations."""
+
+  @abc.abstractmethod
+  def write(self, rows, timeout=None):
+    """Writes rows, returning the per-row errors."""
+
+  def close(self):
+    pass
+
+
+class BigQuerySink(Sink):
+  """Streams rows into BigQuery, creating the table when it is missing.
+
+  The table is not looked up beforehand; `create_table(client, table_ref)` is
+  only called when the insert itself reports that it does not exist. Columns
+  the table does not have yet are ignored so older tables keep accepting rows
+  until they are migrated.
+  """
+
+  def __init__(self, client, table_ref, create_table,
+               create_retry_delays=(1, 2, 4)):
+    self.client = client
+    self.table_ref = table_ref
+    self._create_table = create_table
+    self._create_retry_delays = create_retry_delays
+
+  def write(self, rows, timeout=None):
+    insert = functools.partial(
+        self.client.insert_rows_json, self.table_ref, rows,
+        ignore_unknown_values=True, timeout=timeout)
+    try:
+      return insert()
+    except NotFound:
+      self._create_table(self.client, self.table_ref)
+
+    # A freshly created table can take a moment before it accepts streaming
+    # inserts.
+    for delay in self._create_retry_delays:
+      try:
+        return insert()
+      except NotFound:
+        time.sleep(delay)
+    return insert()
+
+
+class SpoolSink(Sink):
+  """Appends rows to a newline-delimited JSON spool file."""
+
+  def __init__(self, path):
+    self.path = path
+    self._lock = threading.Lock()
+
+  def write(self, rows, timeout=None):
+    del timeout  # Unused.
+    lines = ''.join(json.dumps(row, default=str) + '\n' for row in rows)
+    with self._lock:
+      # Reopened for every batch so that load_spool.py can rotate the file.
+      with open(self.path, 'a') as spool:
+        spool.write(lines)
+    return []
+
+
+class SQLiteSink(Sink):
+  """Writes rows to a `responses` table in a SQLite database.
+
+  Columns follow `schema`; repeated and record fields are stored as JSON text.
+  """
+
+  def __init__(self, path, schema):
+    self.path = path
+    self._columns = [field.name for field in schema]
+    self._json_columns = {
+        field.name for field in schema
+        if field.mode == 'REPEATED' or field.field_type == 'RECORD'
+    }
+    self._lock = threading.Lock()
+    self._connection = sqlite3.connect(path, check_same_thread=False)
+    definitions = ', '.join(
+        '{} {}'.format(field.name,
+                       'INTEGER' if field.field_type == 'INTEGER' else 'TEXT')
+        for field in schema)
+    with self._lock, self._connection:
+      self._connection.execute(
+          f'CREATE TABLE IF NOT EXISTS responses ({definitions})')
+
+  def write(self, rows, timeout=None):
+    del timeout  # Unused.
+    values = [[
+        json.dumps(row.get(column)) if column in self._json_columns else
+        row.get(column) for column in self._columns
+    ] for row in rows]
+    statement = 'INSERT INTO responses ({}) VALUES ({})'.format(
+        ', '.join(self._columns), ', '.join('?' * len(self._columns)))
+    with self._lock, self._connection:
+      self._connection.executemany(statement, values)
+    return []
+
+  def close(self):
+    with self._lock:
+      self._connection.close()
+
+
+def rotate_spool(path):
+  """Moves a spool aside so writers start a new file; returns the new path."""
+  loading_path = '{}.{}.loading'.format(path, int(time.time()))
+  os.replace(path, loading_path)
+  return loading_path
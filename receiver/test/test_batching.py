@@ -0,0 +1,146 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import signal
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+import batching
+
+
+class TestRowBuffer(unittest.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    self.tmpdir = tempfile.TemporaryDirectory()
+    self.spill_path = os.path.join(self.tmpdir.name, 'spill.jsonl')
+    self.flush_fn = mock.Mock(return_value=[])
+
+  def tearDown(self):
+    self.tmpdir.cleanup()
+    super().tearDown()
+
+  def create_buffer(self, **kwargs):
+    kwargs.setdefault('max_age', None)
+    return batching.RowBuffer(
+        self.flush_fn, spill_path=self.spill_path, **kwargs)
+
+  def test_flushes_when_row_limit_is_reached(self):
+    buffer = self.create_buffer(max_rows=3)
+
+    buffer.add({'ID': '1'})
+    buffer.add({'ID': '2'})
+    self.flush_fn.assert_not_called()
+    buffer.add({'ID': '3'})
+
+    self.flush_fn.assert_called_once_with(
+        [{'ID': '1'}, {'ID': '2'}, {'ID': '3'}])
+    self.assertEqual(len(buffer), 0)
+
+  def test_flushes_when_byte_limit_is_reached(self):
+    buffer = self.create_buffer(max_bytes=40)
+
+    buffer.add({'Response': '1:A'})
+    self.flush_fn.assert_not_called()
+    buffer.add({'Response': '1:B|2:C'})
+
+    self.assertEqual(self.flush_fn.call_count, 1)
+
+  def test_flushes_when_oldest_row_is_too_old(self):
+    buffer = self.create_buffer(max_age=10)
+
+    with mock.patch.object(batching.time, 'monotonic', return_value=100):
+      buffer.add({'ID': '1'})
+    with mock.patch.object(batching.time, 'monotonic', return_value=111):
+      buffer.add({'ID': '2'})
+
+    self.flush_fn.assert_called_once_with([{'ID': '1'}, {'ID': '2'}])
+
+  def test_close_flushes_remaining_rows(self):
+    buffer = self.create_buffer()
+    buffer.add({'ID': '1'})
+
+    buffer.close()
+
+    self.flush_fn.assert_called_once_with([{'ID': '1'}])
+
+  def test_close_while_holding_the_lock_does_not_deadlock(self):
+    buffer = self.create_buffer()
+    buffer.add({'ID': '1'})
+
+    # As when SIGTERM arrives on the main thread inside add() or flush().
+    with buffer._lock, buffer._spill_lock:
+      buffer.close()
+
+    self.flush_fn.assert_called_once_with([{'ID': '1'}])
+
+  @mock.patch('atexit.register')
+  def test_shutdown_hooks_flush_on_sigterm(self, register):
+    self.addCleanup(signal.signal, signal.SIGTERM,
+                    signal.getsignal(signal.SIGTERM))
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    buffer = self.create_buffer()
+    buffer.add({'ID': '1'})
+
+    buffer.install_shutdown_hooks()
+    signal.getsignal(signal.SIGTERM)(signal.SIGTERM, None)
+
+    register.assert_called_once_with(buffer.close)
+    self.flush_fn.assert_called_once_with([{'ID': '1'}])
+
+  @mock.patch('atexit.register')
+  def test_shutdown_hooks_warn_off_the_main_thread(self, register):
+    buffer = self.create_buffer()
+
+    with self.assertLogs(level='WARNING'):
+      thread = threading.Thread(target=buffer.install_shutdown_hooks)
+      thread.start()
+      thread.join()
+
+    register.assert_called_once_with(buffer.close)
+
+  def test_failed_flush_spills_and_replays_rows(self):
+    buffer = self.create_buffer(max_rows=1)
+    self.flush_fn.side_effect = [TimeoutError(), [], []]
+
+    buffer.add({'ID': '1'})
+    self.assertTrue(os.path.exists(self.spill_path))
+    buffer.add({'ID': '2'})
+
+    self.assertEqual(self.flush_fn.mock_calls[1], mock.call([{'ID': '2'}]))
+    self.assertEqual(self.flush_fn.mock_calls[2], mock.call([{'ID': '1'}]))
+    self.assertFalse(os.path.exists(self.spill_path))
+    self.assertEqual(buffer.spilled_rows, 1)
+
+  def test_spill_file_is_bounded(self):
+    buffer = self.create_buffer(max_rows=1, spill_max_bytes=20)
+    self.flush_fn.side_effect = TimeoutError()
+
+    buffer.add({'ID': '1'})
+    buffer.add({'ID': '2'})
+
+    self.assertEqual(buffer.spilled_rows, 1)
+    self.assertEqual(buffer.dropped_rows, 1)
+
+  def test_pending_rows_beyond_limit_go_to_spill(self):
+    buffer = self.create_buffer(max_rows=10, max_pending_rows=2)
+
+    for i in range(3):
+      buffer.add({'ID': str(i)})
+
+    self.assertEqual(len(buffer), 2)
+    self.assertEqual(buffer.spilled_rows, 1)
@@ -0,0 +1,56 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+from unittest import mock
+
+from google.cloud import bigquery
+
+import counters
+import dedup
+
+
+class TestRefresh(unittest.TestCase):
+
+  def test_merges_settled_rows_since_the_watermark(self):
+    client = mock.create_autospec(bigquery.Client, instance=True)
+    script = client.query.return_value
+    script.num_dml_affected_rows = None
+    client.list_jobs.return_value = [
+        mock.Mock(statement_type='SELECT', num_dml_affected_rows=None),
+        mock.Mock(statement_type='MERGE', num_dml_affected_rows=4),
+    ]
+
+    merged = counters.refresh(client, 'p.responses.responses',
+                              'p.responses.counts')
+
+    self.assertEqual(merged, 4)
+    client.list_jobs.assert_called_once_with(parent_job=script)
+    table = client.create_table.call_args.args[0]
+    self.assertEqual(table.table_id, 'counts')
+    self.assertEqual(table.clustering_fields, ['ID', 'Segmentation'])
+    self.assertTrue(client.create_table.call_args.kwargs['exists_ok'])
+    sql = client.query.call_args.args[0]
+    self.assertIn('MERGE `p.responses.counts`', sql)
+    self.assertIn('FROM `p.responses.responses`', sql)
+    self.assertIn('CreatedAt >= watermark', sql)
+    params = client.query.call_args.kwargs['job_config'].query_parameters
+    self.assertEqual(params[0].value, dedup.SETTLE_MINUTES + 5)
+
+  def test_counts_only_rows_older_than_compaction(self):
+    self.assertGreater(counters.SETTLE_MINUTES, dedup.SETTLE_MINUTES)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,114 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+from unittest import mock
+
+from google.cloud import bigquery
+
+import batching
+import dedup
+
+
+def row(response, bomid='b1', survey_id='s1'):
+  return {'ID': survey_id, 'BomID': bomid, 'Response': response}
+
+
+class TestResponseTracker(unittest.TestCase):
+
+  def test_accepts_growing_partials_and_drops_stale_ones(self):
+    tracker = dedup.ResponseTracker()
+
+    self.assertTrue(tracker.accept(row('1:A|2:|3:')))
+    self.assertTrue(tracker.accept(row('1:A|2:B|3:')))
+    self.assertFalse(tracker.accept(row('1:A|2:|3:')))
+    self.assertFalse(tracker.accept(row('1:A|2:B|3:')))
+    self.assertEqual(tracker.dropped_rows, 2)
+
+  def test_tracks_respondents_and_surveys_separately(self):
+    tracker = dedup.ResponseTracker()
+
+    self.assertTrue(tracker.accept(row('1:A', bomid='b1')))
+    self.assertTrue(tracker.accept(row('1:A', bomid='b2')))
+    self.assertTrue(tracker.accept(row('1:A', survey_id='s2')))
+
+  def test_rows_without_bomid_are_always_accepted(self):
+    tracker = dedup.ResponseTracker()
+
+    self.assertTrue(tracker.accept(row('1:A', bomid='')))
+    self.assertTrue(tracker.accept(row('1:A', bomid='')))
+    self.assertEqual(len(tracker), 0)
+
+  def test_is_bounded(self):
+    tracker = dedup.ResponseTracker(max_entries=2)
+
+    for bomid in ['b1', 'b2', 'b3']:
+      tracker.accept(row('1:A', bomid=bomid))
+
+    self.assertEqual(len(tracker), 2)
+    # b1 was evicted, so it is accepted again.
+    self.assertTrue(tracker.accept(row('1:A', bomid='b1')))
+
+  def test_forgotten_row_is_accepted_again(self):
+    tracker = dedup.ResponseTracker()
+
+    tracker.accept(row('1:A|2:'))
+    tracker.forget(row('1:A|2:'))
+
+    self.assertTrue(tracker.accept(row('1:A|2:')))
+
+  def test_forget_keeps_a_longer_row_accepted_since(self):
+    tracker = dedup.ResponseTracker()
+
+    tracker.accept(row('1:A|2:'))
+    tracker.accept(row('1:A|2:B'))
+    tracker.forget(row('1:A|2:'))
+
+    self.assertFalse(tracker.accept(row('1:A|2:B')))
+
+
+class TestBufferCollapsesPartials(unittest.TestCase):
+
+  def test_later_partial_replaces_buffered_row(self):
+    flush_fn = mock.Mock(return_value=[])
+    buffer = batching.RowBuffer(
+        flush_fn, max_age=None, key_fn=dedup.dedup_key)
+
+    buffer.add(row('1:A|2:', bomid='b1'))
+    buffer.add(row('1:C|2:', bomid='b2'))
+    buffer.add(row('1:A|2:B', bomid='b1'))
+    buffer.flush()
+
+    flush_fn.assert_called_once_with(
+        [row('1:A|2:B', bomid='b1'), row('1:C|2:', bomid='b2')])
+    self.assertEqual(buffer.replaced_rows, 1)
+
+
+class TestCompact(unittest.TestCase):
+
+  def test_compact_deletes_superseded_rows_in_window(self):
+    client = mock.create_autospec(bigquery.Client, instance=True)
+    client.query.return_value.num_dml_affected_rows = 7
+
+    deleted = dedup.compact(client, 'p.responses.responses', lookback_days=3)
+
+    self.assertEqual(deleted, 7)
+    sql = client.query.call_args.args[0]
+    self.assertIn('DELETE FROM `p.responses.responses`', sql)
+    params = {
+        param.name: param.value
+        for param in client.query.call_args.kwargs['job_config']
+        .query_parameters
+    }
+    self.assertEqual(params, {'lookback_days': 3, 'settle_minutes': 120})
@@ -0,0 +1,220 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import importlib
+import json
+import os
+import unittest
+from unittest import mock
+
+from flask import Request
+from google.cloud import bigquery
+from werkzeug.test import EnvironBuilder
+
+from benchmark import fake_bigquery
+import batching
+import counters
+import dedup
+import main
+
+TABLE_ID = 'test-project.responses.responses'
+
+
+def make_request(**params):
+  builder = EnvironBuilder(path='/', query_string=params)
+  return Request(builder.get_environ())
+
+
+def make_post(data):
+  builder = EnvironBuilder(
+      path='/', method='POST', data=data,
+      content_type='text/plain;charset=UTF-8')
+  return Request(builder.get_environ())
+
+
+class TestReceiver(unittest.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    self.backend = fake_bigquery.FakeBackend()
+    patcher = mock.patch.object(bigquery, 'Client', self.backend.client)
+    patcher.start()
+    self.addCleanup(patcher.stop)
+    env = mock.patch.dict(os.environ, {'TABLE_ID': TABLE_ID})
+    env.start()
+    self.addCleanup(env.stop)
+    main._client = None
+    main._sink = None
+    main._tracker = dedup.ResponseTracker()
+
+  def test_receiver_writes_row_from_query_parameters(self):
+    self.backend.tables[TABLE_ID] = []
+
+    body, status, _ = main.receiver(
+        make_request(type='survey', id='s1', seg='default_expose',
+                     response='1:A|2:B', bomid='b1'))
+
+    self.assertEqual(status, 200)
+    self.assertEqual(body, {'errors': []})
+    row = self.backend.rows(TABLE_ID)[0]
+    self.assertEqual(row['ID'], 's1')
+    self.assertEqual(row['Segmentation'], 'default_expose')
+    self.assertEqual(row['Response'], '1:A|2:B')
+    self.assertEqual(row['BomID'], 'b1')
+
+  def test_warm_requests_reuse_client_and_skip_table_lookup(self):
+    self.backend.tables[TABLE_ID] = []
+
+    for _ in range(3):
+      main.receiver(make_request(id='s1', response='1:A'))
+
+    self.assertEqual(self.backend.calls['Client'], 1)
+    self.assertEqual(self.backend.calls['get_table'], 0)
+    self.assertEqual(self.backend.calls['insert_rows_json'], 3)
+
+  def test_table_is_created_when_insert_reports_not_found(self):
+    main.receiver(make_request(id='s1', response='1:A'))
+    main.receiver(make_request(id='s1', response='1:B'))
+
+    self.assertEqual(self.backend.calls['create_table'], 1)
+    self.assertEqual(len(self.backend.rows(TABLE_ID)), 2)
+
+  def test_receiver_writes_parsed_answers(self):
+    self.backend.tables[TABLE_ID] = []
+
+    main.receiver(make_request(id='s1', response='1:A|2:|3:BC'))
+
+    row = self.backend.rows(TABLE_ID)[0]
+    self.assertEqual(row['Answers'], [
+        {'QuestionId': 1, 'AnswerId': 'A'},
+        {'QuestionId': 3, 'AnswerId': 'BC'},
+    ])
+
+
+  def test_receiver_writes_latency_columns(self):
+    self.backend.tables[TABLE_ID] = []
+
+    main.receiver(make_request(id='s1', response='1:A', times='1520|8301'))
+
+    row = self.backend.rows(TABLE_ID)[0]
+    self.assertEqual(row['FirstAnswerMs'], 1520)
+    self.assertEqual(row['CompletionMs'], 8301)
+
+  def test_post_writes_all_responses_in_one_insert(self):
+    self.backend.tables[TABLE_ID] = []
+
+    body, status, _ = main.receiver(make_post(json.dumps([
+        {'type': 'survey', 'id': 's1', 'response': '1:A', 'bomid': 'b1'},
+        {'type': 'survey', 'id': 's1', 'response': '1:B', 'bomid': 'b2'},
+    ])))
+
+    self.assertEqual((body, status), ('', 204))
+    self.assertEqual(self.backend.calls['insert_rows_json'], 1)
+    rows = self.backend.rows(TABLE_ID)
+    self.assertEqual([row['BomID'] for row in rows], ['b1', 'b2'])
+    self.assertEqual(rows[1]['Answers'], [{'QuestionId': 1, 'AnswerId': 'B'}])
+
+  def test_post_rejects_malformed_body(self):
+    for data in ['not json', '{"id": "s1"}', '[1, 2]',
+                 json.dumps((main.MAX_BATCH_RESPONSES + 1) * [{}])]:
+      _, status, _ = main.receiver(make_post(data))
+      self.assertEqual(status, 400)
+    self.assertEqual(self.backend.calls['insert_rows_json'], 0)
+
+  def test_stale_partial_submission_is_not_written(self):
+    self.backend.tables[TABLE_ID] = []
+
+    main.receiver(make_request(id='s1', bomid='b1', response='1:A|2:B'))
+    main.receiver(make_request(id='s1', bomid='b1', response='1:A|2:'))
+
+    rows = self.backend.rows(TABLE_ID)
+    self.assertEqual([row['Response'] for row in rows], ['1:A|2:B'])
+
+  def test_rejected_submission_can_be_retried(self):
+    rejected = [{'index': 0, 'errors': [{'reason': 'backendError'}]}]
+    request = dict(id='s1', bomid='b1', response='1:A|2:B')
+
+    with mock.patch.object(main, 'insert_rows',
+                           side_effect=[rejected, []]) as insert:
+      body, _, _ = main.receiver(make_request(**request))
+      self.assertEqual(body, {'errors': rejected})
+      main.receiver(make_request(**request))
+
+    self.assertEqual(insert.call_count, 2)
+
+  def test_failed_post_can_be_retried(self):
+    data = json.dumps([{'id': 's1', 'response': '1:A', 'bomid': 'b1'}])
+
+    with mock.patch.object(main, 'insert_rows',
+                           side_effect=[TimeoutError(), []]) as insert:
+      with self.assertRaises(TimeoutError):
+        main.receiver(make_post(data))
+      main.receiver(make_post(data))
+
+    self.assertEqual(insert.call_count, 2)
+
+  def test_compact_entry_point_reports_deleted_rows(self):
+    with mock.patch.object(dedup, 'compact', return_value=3) as compact:
+      body, status, _ = main.compact(make_request())
+
+    self.assertEqual((body, status), ({'deleted': 3}, 200))
+    self.assertEqual(compact.call_args.args[1], TABLE_ID)
+
+  def test_compact_entry_point_refreshes_counters(self):
+    with mock.patch.object(dedup, 'compact', return_value=3), \
+        mock.patch.object(counters, 'refresh', return_value=2) as refresh, \
+        mock.patch.object(main, 'COUNTERS_TABLE_ID', 'p.responses.counts'):
+      body, _, _ = main.compact(make_request())
+
+    self.assertEqual(body, {'deleted': 3, 'counted': 2})
+    self.assertEqual(refresh.call_args.args[1:],
+                     (TABLE_ID, 'p.responses.counts'))
+
+
+  @mock.patch.object(batching.RowBuffer, 'start')
+  @mock.patch.object(batching.RowBuffer, 'install_shutdown_hooks')
+  def test_batch_mode_installs_shutdown_hooks_at_import(self, install, start):
+    self.addCleanup(importlib.reload, main)
+    with mock.patch.dict(os.environ, {'BATCH_MODE': 'true'}):
+      importlib.reload(main)
+
+    install.assert_called_once_with()
+    start.assert_called_once_with()
+    self.assertIsNotNone(main._buffer)
+
+
+class TestParseTimes(unittest.TestCase):
+
+  def test_parse_times(self):
+    self.assertEqual(main.parse_times('1520|8301'), (1520, 8301))
+
+  def test_parse_times_drops_timers_that_never_started(self):
+    self.assertEqual(main.parse_times('1520|-1712345678901'), (1520, None))
+    self.assertEqual(main.parse_times('NaN|NaN'), (None, None))
+
+  def test_parse_times_handles_missing_values(self):
+    self.assertEqual(main.parse_times(None), (None, None))
+    self.assertEqual(main.parse_times('1520'), (1520, None))
+
+
+class TestParseAnswers(unittest.TestCase):
+
+  def test_parse_answers_skips_empty_and_malformed_parts(self):
+    self.assertEqual(
+        main.parse_answers('1:A||x:B|4|5:D'),
+        [{'QuestionId': 1, 'AnswerId': 'A'},
+         {'QuestionId': 5, 'AnswerId': 'D'}])
+
+  def test_parse_answers_handles_missing_response(self):
+    self.assertEqual(main.parse_answers(None), [])
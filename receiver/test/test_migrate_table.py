@@ -0,0 +1,114 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+from unittest import mock
+
+from google.cloud import bigquery
+from google.cloud.exceptions import NotFound
+
+import main
+import migrate_table
+
+TABLE_ID = 'test-project.responses.responses'
+
+
+class TestMigrateTable(unittest.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    self.client = mock.create_autospec(bigquery.Client, instance=True)
+    self.client.update_table.side_effect = lambda table, fields: table
+
+  def existing_table(self, schema=None, partitioned=True, clustered=True):
+    table = bigquery.Table(
+        TABLE_ID, schema=main.SCHEMA if schema is None else schema)
+    if partitioned:
+      table.time_partitioning = bigquery.TimePartitioning(field='CreatedAt')
+    if clustered:
+      table.clustering_fields = ['ID', 'Segmentation']
+    return table
+
+  def test_missing_table_is_created_partitioned_and_clustered(self):
+    self.client.get_table.side_effect = NotFound('missing')
+
+    migrate_table.migrate(self.client, TABLE_ID)
+
+    table = self.client.create_table.call_args.args[0]
+    self.assertEqual(table.time_partitioning.field, 'CreatedAt')
+    self.assertEqual(table.clustering_fields, ['ID', 'Segmentation'])
+
+  def test_unpartitioned_table_is_rebuilt_from_the_schema(self):
+    self.client.get_table.return_value = self.existing_table(
+        partitioned=False, clustered=False)
+
+    migrate_table.migrate(self.client, TABLE_ID)
+
+    table = self.client.create_table.call_args.args[0]
+    self.assertRegex(table.table_id, r'^responses_partitioned_\d{8}$')
+    self.assertEqual(table.time_partitioning.field, 'CreatedAt')
+    self.assertEqual(table.clustering_fields, ['ID', 'Segmentation'])
+    self.assertEqual(table.schema[0].mode, 'REQUIRED')
+    copy, rename_old, rename_new = [
+        call.args[0] for call in self.client.query.call_args_list]
+    self.assertRegex(copy, r'INSERT INTO `test-project.responses.responses_'
+                     r'partitioned_\d{8}` \(CreatedAt, Type, ID,')
+    self.assertIn('FROM `%s`' % TABLE_ID, copy)
+    self.assertRegex(rename_old, r'^ALTER TABLE `%s` RENAME TO '
+                     r'`responses_unpartitioned_\d{8}`$' % TABLE_ID)
+    self.assertRegex(rename_new, r'RENAME TO `responses`$')
+    self.client.delete_table.assert_not_called()
+
+  def test_table_with_streaming_buffer_is_not_rebuilt(self):
+    table = self.existing_table(partitioned=False, clustered=False)
+    table._properties['streamingBuffer'] = {'estimatedRows': '3'}
+    self.client.get_table.return_value = table
+
+    with self.assertRaises(RuntimeError):
+      migrate_table.migrate(self.client, TABLE_ID)
+
+    self.client.create_table.assert_not_called()
+    self.client.query.assert_not_called()
+
+  def test_original_is_restored_when_the_swap_fails(self):
+    self.client.get_table.return_value = self.existing_table(
+        partitioned=False, clustered=False)
+    self.client.query.side_effect = [
+        mock.Mock(), mock.Mock(), Exception('Already exists'), mock.Mock()]
+
+    with self.assertLogs(level='ERROR'), self.assertRaises(Exception):
+      migrate_table.migrate(self.client, TABLE_ID)
+
+    restore = self.client.query.call_args.args[0]
+    self.assertRegex(restore, r'^ALTER TABLE `test-project.responses.'
+                     r'responses_unpartitioned_\d{8}` RENAME TO `responses`$')
+
+  def test_partitioned_table_without_clustering_is_clustered_in_place(self):
+    self.client.get_table.return_value = self.existing_table(clustered=False)
+
+    table = migrate_table.migrate(self.client, TABLE_ID)
+
+    self.client.copy_table.assert_not_called()
+    self.client.query.assert_not_called()
+    self.assertEqual(table.clustering_fields, ['ID', 'Segmentation'])
+
+  def test_missing_columns_are_added_as_nullable(self):
+    self.client.get_table.return_value = self.existing_table(
+        schema=[field for field in main.SCHEMA if field.name != 'BomID'])
+
+    table = migrate_table.migrate(self.client, TABLE_ID)
+
+    added = table.schema[-1]
+    self.assertEqual(added.name, 'BomID')
+    self.assertEqual(added.mode, 'NULLABLE')
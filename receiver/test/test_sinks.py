@@ -0,0 +1,132 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from google.cloud import bigquery
+from google.cloud.exceptions import NotFound
+
+import load_spool
+import main
+import sinks
+
+ROWS = [
+    {'ID': 's1', 'BomID': 'b1', 'Response': '1:A',
+     'Answers': [{'QuestionId': 1, 'AnswerId': 'A'}], 'CompletionMs': 10},
+    {'ID': 's1', 'BomID': 'b2', 'Response': '1:B',
+     'Answers': [{'QuestionId': 1, 'AnswerId': 'B'}], 'CompletionMs': None},
+]
+
+
+class TestBigQuerySink(unittest.TestCase):
+
+  def test_creates_missing_table_and_retries(self):
+    client = mock.Mock()
+    client.insert_rows_json.side_effect = [NotFound('table'), []]
+    create_table = mock.Mock()
+    sink = sinks.BigQuerySink(client, 'p.d.t', create_table,
+                              create_retry_delays=())
+
+    self.assertEqual(sink.write(ROWS, timeout=3), [])
+    create_table.assert_called_once_with(client, 'p.d.t')
+    client.insert_rows_json.assert_called_with(
+        'p.d.t', ROWS, ignore_unknown_values=True, timeout=3)
+
+
+class TestSpoolSink(unittest.TestCase):
+
+  def setUp(self):
+    self.dir = tempfile.TemporaryDirectory()
+    self.path = os.path.join(self.dir.name, 'spool.jsonl')
+
+  def tearDown(self):
+    self.dir.cleanup()
+
+  def test_appends_json_lines(self):
+    sink = sinks.SpoolSink(self.path)
+
+    self.assertEqual(sink.write(ROWS[:1]), [])
+    sink.write(ROWS[1:])
+
+    with open(self.path) as spool:
+      self.assertEqual([json.loads(line) for line in spool], ROWS)
+
+  def test_writes_to_a_new_file_after_rotation(self):
+    sink = sinks.SpoolSink(self.path)
+    sink.write(ROWS[:1])
+
+    loading_path = sinks.rotate_spool(self.path)
+    sink.write(ROWS[1:])
+
+    with open(loading_path) as spool:
+      self.assertEqual(len(spool.readlines()), 1)
+    with open(self.path) as spool:
+      self.assertEqual(json.loads(spool.read()), ROWS[1])
+
+  def test_load_spool_loads_and_removes_the_rotated_file(self):
+    sinks.SpoolSink(self.path).write(ROWS)
+    client = mock.Mock()
+    loaded = []
+    client.load_table_from_file.side_effect = (
+        lambda spool, table_id, job_config: loaded.append(spool.read()) or
+        mock.Mock(output_rows=2))
+
+    load_spool.load_spool(client, self.path, 'p.d.t')
+
+    self.assertEqual(len(loaded[0].splitlines()), 2)
+    job_config = client.load_table_from_file.call_args.kwargs['job_config']
+    self.assertEqual(job_config.source_format,
+                     bigquery.SourceFormat.NEWLINE_DELIMITED_JSON)
+    self.assertEqual(os.listdir(self.dir.name), [])
+
+
+class TestSQLiteSink(unittest.TestCase):
+
+  def test_writes_rows(self):
+    sink = sinks.SQLiteSink(':memory:', main.SCHEMA)
+
+    self.assertEqual(sink.write(ROWS), [])
+
+    rows = sink._connection.execute(  # pylint: disable=protected-access
+        'SELECT BomID, Answers, CompletionMs FROM responses ORDER BY BomID'
+    ).fetchall()
+    sink.close()
+    self.assertEqual(rows, [
+        ('b1', '[{"QuestionId": 1, "AnswerId": "A"}]', 10),
+        ('b2', '[{"QuestionId": 1, "AnswerId": "B"}]', None),
+    ])
+
+
+class TestGetSink(unittest.TestCase):
+
+  def tearDown(self):
+    main._sink = None
+
+  def test_selects_sink_from_environment(self):
+    with mock.patch.object(main, 'SINK', 'sqlite'), \
+        mock.patch.object(main, 'SQLITE_PATH', ':memory:'):
+      main._sink = None
+      self.assertIsInstance(main.get_sink(), sinks.SQLiteSink)
+
+  def test_rejects_unknown_sink(self):
+    with self.assertRaises(ValueError):
+      main.new_sink('kafka')
+
+
+if __name__ == '__main__':
+  unittest.main()